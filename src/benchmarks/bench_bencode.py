@@ -0,0 +1,92 @@
+"""
+Decoding a large torrent and a large non compact tracker response, and
+getting a torrent's info hash, with `bencoder` against `bencode`.
+
+Run from src/: python -m benchmarks.bench_bencode
+"""
+import hashlib
+import random
+import timeit
+
+import bencoder
+
+import bencode
+from torrent import LAZY_STRING_SIZE
+
+PIECES = 200000
+PEERS = 20000
+
+
+def make_torrent() -> bytes:
+    return bencoder.encode({
+        b'announce': b'http://tracker.example.org/announce',
+        b'info': {
+            b'name': b'big.iso',
+            b'length': PIECES * 2**18,
+            b'piece length': 2**18,
+            b'pieces': random.getrandbits(PIECES * 160).to_bytes(PIECES * 20, 'big'),
+        },
+    })
+
+
+def make_tracker_response() -> bytes:
+    return bencoder.encode({
+        b'interval': 1800,
+        b'peers': [
+            {b'ip': '10.0.{}.{}'.format(i // 256 % 256, i % 256).encode(),
+             b'port': 6881 + i % 1000,
+             b'peer id': random.getrandbits(160).to_bytes(20, 'big')}
+            for i in range(PEERS)
+        ],
+    })
+
+
+def old_info_hash(data : bytes) -> bytes:
+    return hashlib.sha1(bencoder.encode(bencoder.decode(data)[b'info'])).digest()
+
+
+def new_info_hash(data : bytes) -> bytes:
+    _, spans = bencode.decode_with_spans(data, (b'info',), LAZY_STRING_SIZE)
+    start, end = spans[b'info']
+    return hashlib.sha1(memoryview(data)[start:end]).digest()
+
+
+def streamed(data : bytes):
+    decoder = bencode.Decoder()
+    for i in range(0, len(data), 65536):
+        decoder.feed(data[i:i + 65536])
+    return decoder.finish()
+
+
+def report(name, old, new, repeat=5):
+    old = timeit.timeit(old, number=repeat) / repeat
+    new = timeit.timeit(new, number=repeat) / repeat
+    print('{:34} old {:8.2f} ms  new {:8.2f} ms ({:5.1f}x)'.format(
+        name, old * 1e3, new * 1e3, old / new))
+
+
+def main():
+    random.seed(1)
+    torrent = make_torrent()
+    response = make_tracker_response()
+    assert old_info_hash(torrent) == new_info_hash(torrent)
+    assert bencoder.decode(response) == streamed(response)
+
+    print('torrent {:.1f} MB, tracker response {:.1f} MB'.format(
+        len(torrent) / 2**20, len(response) / 2**20))
+    report('torrent decode',
+           lambda: bencoder.decode(torrent),
+           lambda: bencode.decode(torrent, lazy_threshold=LAZY_STRING_SIZE))
+    report('torrent info hash',
+           lambda: old_info_hash(torrent), lambda: new_info_hash(torrent))
+    report('tracker response decode',
+           lambda: bencoder.decode(response), lambda: bencode.decode(response))
+    report('tracker response, 64 KiB chunks',
+           lambda: bencoder.decode(response), lambda: streamed(response))
+    value = bencoder.decode(response)
+    report('tracker response encode',
+           lambda: bencoder.encode(value), lambda: bencode.encode(value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Compares the old `buf += resp` framing loop from `Peer._download` with
+`messages.MessageParser` on a stream of PIECE messages.
+
+Run from src/: python -m benchmarks.bench_messages
+"""
+import struct
+import time
+
+from messages import Have, MessageParser, Piece
+from util import REQUEST_SIZE
+
+
+def make_stream(number_of_blocks : int) -> bytes:
+    block = b'\xab' * REQUEST_SIZE
+    messages = []
+    for i in range(number_of_blocks):
+        messages.append(Piece(i // 16, (i % 16) * REQUEST_SIZE, block).encode())
+        if i % 16 == 15:
+            messages.append(Have(i // 16).encode())
+    return b''.join(messages)
+
+
+def chunks(stream : bytes, size : int):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def legacy_loop(chunked):
+    """
+    The framing logic of the original `Peer._download`, minus the I/O
+    """
+    received = 0
+    buf = b''
+    for resp in chunked:
+        buf += resp
+        while True:
+            if len(buf) < 4:
+                break
+            length = struct.unpack('>I', buf[0:4])[0]
+            if len(buf) < 4 + length:
+                break
+            msg_id = struct.unpack('>b', buf[4:5])[0]
+            data = buf[:4 + length]
+            buf = buf[4 + length:]
+            if msg_id == 7:
+                l = struct.unpack('>I', data[:4])[0]
+                parts = struct.unpack('>IbII' + str(l - 9) + 's', data[:length + 4])
+                received += len(parts[4])
+    return received
+
+
+def parser_loop(chunked):
+    received = 0
+    parser = MessageParser()
+    for resp in chunked:
+        parser.feed(resp)
+        for message in parser:
+            if type(message) is Piece:
+                received += len(message.block)
+    return received
+
+
+def timeit(func, *args, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    stream = make_stream(4096)
+    for read_size in (REQUEST_SIZE, 2**16, 2**18):
+        chunked = chunks(stream, read_size)
+        legacy, legacy_bytes = timeit(legacy_loop, chunked)
+        parser, parser_bytes = timeit(parser_loop, chunked)
+        assert legacy_bytes == parser_bytes
+        mb = len(stream) / 2**20
+        print('read size {:>7}: legacy {:8.1f} MB/s  parser {:8.1f} MB/s  ({:.1f}x)'.format(
+            read_size, mb / legacy, mb / parser, legacy / parser))
+
+
+if __name__ == '__main__':
+    main()
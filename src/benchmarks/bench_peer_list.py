@@ -0,0 +1,69 @@
+"""
+Decoding large tracker peer lists: the old per record loop from
+`Tracker.parse_peers` against `peer_list.decode_peers`.
+
+Run from src/: python -m benchmarks.bench_peer_list
+"""
+import ipaddress
+import random
+import socket
+import struct
+import timeit
+
+from peer_list import decode_peers
+
+SIZES = (10000, 50000, 200000)
+
+
+def old_parse_peers(peers_data):
+    """
+    The old handle_bytes loop, minus the print for our own address
+    """
+    self_addr = '192.168.99.1'
+    peers = []
+    for i in range(0, len(peers_data), 6):
+        addr_bytes, port_bytes = (
+            peers_data[i:i + 4], peers_data[i + 4:i + 6]
+        )
+        ip_addr = str(ipaddress.IPv4Address(addr_bytes))
+        if ip_addr == self_addr:
+            continue
+        port_bytes = struct.unpack('>H', port_bytes)[0]
+        peers.append((ip_addr, port_bytes))
+    return peers
+
+
+def compact_peers(count : int) -> bytes:
+    return b''.join(
+        socket.inet_aton('10.{}.{}.{}'.format(
+            random.randrange(256), random.randrange(256), random.randrange(256))) +
+        struct.pack('>H', random.randrange(1, 65536))
+        for _ in range(count)
+    )
+
+
+def compact_peers6(count : int) -> bytes:
+    return b''.join(
+        bytes(random.getrandbits(8) for _ in range(16)) +
+        struct.pack('>H', random.randrange(1, 65536))
+        for _ in range(count)
+    )
+
+
+def main():
+    random.seed(1)
+    for size in SIZES:
+        data = compact_peers(size)
+        data6 = compact_peers6(size // 4)
+        repeat = max(1, 200000 // size)
+
+        old = timeit.timeit(lambda: old_parse_peers(data), number=repeat) / repeat
+        new = timeit.timeit(lambda: decode_peers(data), number=repeat) / repeat
+        new6 = timeit.timeit(lambda: decode_peers(data, data6), number=repeat) / repeat
+        print('{:7} peers  old {:8.2f} ms  new {:7.2f} ms ({:5.1f}x)  '
+              'with {} peers6 {:7.2f} ms'.format(
+                  size, old * 1e3, new * 1e3, old / new, size // 4, new6 * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Cost of picking pieces on a large torrent: the old linear scan from
+`DownloadSession.get_piece_request` against `piece_picker.PiecePicker`,
+with peers that have most pieces, peers that mostly have pieces we're
+done with, and peers that each have a slice of the torrent.
+
+Run from src/: python -m benchmarks.bench_piece_picker
+"""
+import random
+import time
+
+import bitstring
+
+from piece_picker import NoPieceAvailable, PiecePicker, RAREST_FIRST, SEQUENTIAL
+
+NUMBER_OF_PIECES = 100000
+NUMBER_OF_PEERS = 50
+PICKS = 2000
+
+
+def random_bitfield(fill : float) -> bitstring.BitArray:
+    return bitstring.BitArray(
+        bin=''.join('1' if random.random() < fill else '0'
+                    for _ in range(NUMBER_OF_PIECES)))
+
+
+def slice_bitfield(start : int, stop : int) -> bitstring.BitArray:
+    return bitstring.BitArray(bin='0' * start + '1' * (stop - start) +
+                              '0' * (NUMBER_OF_PIECES - stop))
+
+
+def dense_peers() -> list:
+    return [random_bitfield(random.uniform(0.2, 1.0)) for _ in range(NUMBER_OF_PEERS)]
+
+
+def skewed_peers() -> list:
+    """
+    Most peers only have a few of the pieces, and mostly the done ones
+    """
+    half = NUMBER_OF_PIECES // 2
+    peers = [slice_bitfield(0, half) for _ in range(NUMBER_OF_PEERS // 2)]
+    peers += [random_bitfield(0.05) for _ in range(NUMBER_OF_PEERS - len(peers))]
+    return peers
+
+
+def disjoint_peers() -> list:
+    """
+    Every peer has its own slice of the torrent and nothing else
+    """
+    size = NUMBER_OF_PIECES // NUMBER_OF_PEERS
+    return [slice_bitfield(i * size, (i + 1) * size) for i in range(NUMBER_OF_PEERS)]
+
+
+SCENARIOS = (
+    ('dense', dense_peers),
+    ('skewed', skewed_peers),
+    ('disjoint', disjoint_peers),
+)
+
+
+def linear_scan(peers, done, picks):
+    """
+    The old get_piece_request loop, where most pieces are already done or
+    in progress
+    """
+    in_progress = set()
+    for i in range(picks):
+        have = peers[i % len(peers)]
+        for index in range(NUMBER_OF_PIECES):
+            if index in done or index in in_progress:
+                continue
+            if have[index]:
+                in_progress.add(index)
+                break
+
+
+def picker_picks(peers, done, policy):
+    picker = PiecePicker(NUMBER_OF_PIECES, policy)
+    for have in peers:
+        picker.add_peer(have)
+    for index in done:
+        picker.mark_done(index)
+
+    start = time.perf_counter()
+    for i in range(PICKS):
+        try:
+            picker.pick(peers[i % len(peers)])
+        except NoPieceAvailable:
+            pass
+    return time.perf_counter() - start
+
+
+def main():
+    random.seed(1)
+    # Halfway through the download
+    done = set(range(0, NUMBER_OF_PIECES // 2))
+    for name, make_peers in SCENARIOS:
+        peers = make_peers()
+        print(name)
+        # Far slower, fewer picks are enough
+        picks = PICKS // 20
+        start = time.perf_counter()
+        linear_scan(peers, done, picks)
+        linear = time.perf_counter() - start
+        print('  linear scan   {:10.2f} us/pick'.format(linear / picks * 1e6))
+
+        for policy in (RAREST_FIRST, SEQUENTIAL):
+            elapsed = picker_picks(peers, done, policy)
+            print('  {:13} {:10.2f} us/pick'.format(policy, elapsed / PICKS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
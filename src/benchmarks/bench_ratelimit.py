@@ -0,0 +1,48 @@
+"""
+What the token buckets cost per read or write that is within its limit,
+for a peer with no limits, with only a global limit, and limited at all
+three levels, against the bare loop.
+
+Run from src/: python -m benchmarks.bench_ratelimit
+"""
+import timeit
+
+from ratelimit import TokenBucket
+from util import REQUEST_SIZE
+
+CALLS = 1000000
+
+
+def chain(*rates) -> TokenBucket:
+    bucket = None
+    for rate in rates:
+        bucket = TokenBucket(rate, parent=bucket)
+    return bucket
+
+
+def loop(bucket : TokenBucket):
+    consume = bucket.consume
+    for _ in range(CALLS):
+        if consume(REQUEST_SIZE):
+            pass
+
+
+def bare():
+    for _ in range(CALLS):
+        pass
+
+
+def main():
+    # High enough that nothing waits, only the bookkeeping is measured
+    fast = 2**60
+    base = timeit.timeit(bare, number=1)
+    for name, bucket in (
+            ('unlimited', chain(None, None, None)),
+            ('global limit', chain(fast, None, None)),
+            ('global, torrent, peer', chain(fast, fast, fast))):
+        elapsed = timeit.timeit(lambda: loop(bucket), number=1) - base
+        print('{:24} {:6.0f} ns per call'.format(name, elapsed / CALLS * 1e9))
+
+
+if __name__ == '__main__':
+    main()
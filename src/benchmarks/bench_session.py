@@ -0,0 +1,111 @@
+"""
+Many small torrents in one Session: a seeding Session serves them all on
+one port and a second Session downloads them all at once over loopback.
+
+Run from src/: python -m benchmarks.bench_session [torrents] [KiB each]
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import bencode
+from torrio import Session
+
+PIECE_LENGTH = 2**14
+
+
+def make_torrents(directory : str, count : int, size : int) -> list:
+    """
+    Writes `count` single file torrents of `size` random bytes, their
+    content goes in directory/seed
+    """
+    seed = os.path.join(directory, 'seed')
+    os.makedirs(seed)
+    paths = []
+    for i in range(count):
+        name = 'file{:05}'.format(i)
+        data = os.urandom(size)
+        with open(os.path.join(seed, name), 'wb') as f:
+            f.write(data)
+        info = {
+            b'name': name.encode(),
+            b'length': size,
+            b'piece length': PIECE_LENGTH,
+            b'pieces': b''.join(
+                hashlib.sha1(data[i:i + PIECE_LENGTH]).digest()
+                for i in range(0, size, PIECE_LENGTH)
+            ),
+        }
+        path = os.path.join(directory, name + '.torrent')
+        with open(path, 'wb') as f:
+            f.write(bencode.encode({b'info': info}))
+        paths.append(path)
+    return paths
+
+
+async def swarm(directory : str, paths : list) -> dict:
+    seeder = await Session(host='127.0.0.1', port=0, max_connections=2000).start()
+    leecher = await Session(host='127.0.0.1', port=0, max_connections=2000).start()
+    try:
+        start = time.monotonic()
+        for path in paths:
+            seeder.add(path, os.path.join(directory, 'seed'), seed=True)
+        while len(seeder.torrents) < len(paths) or not all(
+                session.is_on_disk() for session in seeder.torrents.values()):
+            await asyncio.sleep(0.01)
+        seeding = time.monotonic() - start
+
+        finished = []
+
+        async def leech(path):
+            await leecher.download(
+                path, os.path.join(directory, 'leech'),
+                peers=[('127.0.0.1', seeder.port)])
+            finished.append(time.monotonic() - start)
+
+        start = time.monotonic()
+        cpu = time.process_time()
+        await asyncio.gather(*[leech(path) for path in paths])
+        return {
+            'seeding': seeding,
+            'elapsed': time.monotonic() - start,
+            'cpu': time.process_time() - cpu,
+            'finished': sorted(finished),
+        }
+    finally:
+        await leecher.close()
+        await seeder.close()
+
+
+def main():
+    logging.getLogger('').setLevel(logging.WARNING)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else 256) * 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_torrents(directory, count, size)
+        result = asyncio.get_event_loop().run_until_complete(swarm(directory, paths))
+
+    finished = result['finished']
+    total = count * size
+    print('{} torrents of {} KiB in one Session each side'.format(count, size // 1024))
+    print('  seeders ready   {:8.2f} s (recheck of {:.1f} MB)'.format(
+        result['seeding'], total / 2**20))
+    print('  downloaded      {:8.2f} s  {:7.1f} MB/s  cpu {:.2f} s'.format(
+        result['elapsed'], total / 2**20 / result['elapsed'], result['cpu']))
+    print('  per torrent     p50 {:.2f} s  p99 {:.2f} s  last {:.2f} s'.format(
+        finished[len(finished) // 2], finished[int(len(finished) * 0.99)],
+        finished[-1]))
+    print('  peak rss        {:8.1f} MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Startup time and memory of DownloadSession on a huge torrent, against
+the old eager Piece/Block construction.
+
+Run from src/: python -m benchmarks.bench_session_startup [size in GiB]
+"""
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bencoder
+import bitstring
+
+from torrent import Torrent
+from torrio import DownloadSession
+from util import REQUEST_SIZE
+
+PIECE_LENGTH = 2**18
+
+
+class LegacyPiece(object):
+    def __init__(self, index, blocks):
+        self.index = index
+        self.blocks = blocks
+        self.downloaded_blocks = bitstring.BitArray(bin='0' * len(blocks))
+
+
+class LegacyBlock(object):
+    def __init__(self, piece, begin, length):
+        self.piece = piece
+        self.begin = begin
+        self.length = length
+        self.data = None
+
+
+def legacy_get_pieces(torrent):
+    """
+    What DownloadSession.get_pieces used to build for the whole torrent
+    """
+    pieces = []
+    blocks_per_piece = math.ceil(torrent.piece_length / REQUEST_SIZE)
+    for piece_idx in range(torrent.number_of_pieces):
+        blocks = [
+            LegacyBlock(piece_idx, block_idx * REQUEST_SIZE, REQUEST_SIZE)
+            for block_idx in range(blocks_per_piece)
+        ]
+        pieces.append(LegacyPiece(piece_idx, blocks))
+    return pieces
+
+
+def make_torrent(directory, size):
+    number_of_pieces = math.ceil(size / PIECE_LENGTH)
+    path = os.path.join(directory, 'huge.torrent')
+    with open(path, 'wb') as f:
+        f.write(bencoder.encode({
+            b'announce': b'http://localhost/announce',
+            b'info': {
+                b'name': b'huge',
+                b'length': size,
+                b'piece length': PIECE_LENGTH,
+                b'pieces': bytes(20 * number_of_pieces),
+            }
+        }))
+    return Torrent(path)
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    size = int(float(sys.argv[1]) * 2**30) if len(sys.argv) > 1 else 10 * 2**30
+    with tempfile.TemporaryDirectory() as directory:
+        torrent = make_torrent(directory, size)
+        print('{:.0f} GiB, {} pieces, {} blocks'.format(
+            size / 2**30, torrent.number_of_pieces,
+            torrent.number_of_pieces * PIECE_LENGTH // REQUEST_SIZE))
+
+        _, elapsed, peak = measure(lambda: legacy_get_pieces(torrent))
+        print('eager objects   {:8.3f} s  {:10.1f} MiB'.format(elapsed, peak / 2**20))
+
+        _, elapsed, peak = measure(lambda: DownloadSession(torrent))
+        print('DownloadSession {:8.3f} s  {:10.1f} MiB'.format(elapsed, peak / 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Time to first byte of a seek into a torrent whose download has just
+started, with the streaming window against without it. Uses the loopback swarm of
+bench_swarm: seeder processes, possibly behind added latency, and a
+tracker in this process.
+
+Run from src/: python -m benchmarks.bench_stream --size 64 --seeders 4 \\
+    --latency 50 --seeks 8
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from benchmarks.bench_swarm import (
+    SwarmTracker, close_loop, cycle, floats, make_torrent, run_seeder
+)
+from torrent import Torrent
+from torrio import Session
+
+
+async def seek(url : str, offset : int, length : int = 2**16) -> float:
+    """
+    Seconds until the first byte of content at `offset` arrives
+    """
+    host, port = url.split('/')[2].split(':')
+    started = time.monotonic()
+    reader, writer = await asyncio.open_connection(host, int(port))
+    try:
+        writer.write('GET /{} HTTP/1.1\r\nRange: bytes={}-{}\r\n\r\n'.format(
+            url.split('/', 3)[3], offset, offset + length - 1).encode())
+        await reader.readuntil(b'\r\n\r\n')
+        await reader.readexactly(1)
+        return time.monotonic() - started
+    finally:
+        writer.close()
+
+
+async def leech(directory : str, torrent : Torrent, tracker : SwarmTracker,
+                seeders : int, window : int, offset : int) -> float:
+    """
+    Time to first byte of a seek to `offset` as soon as a fresh download
+    of the torrent starts
+    """
+    while tracker.seeders(torrent.info_hash) < seeders:
+        await asyncio.sleep(0.05)
+    session = await Session(
+        host='127.0.0.1', port=0, stream_port=0, stream_window=window,
+        metadata_cache=os.path.join(directory, 'cache')).start()
+    leech_dir = os.path.join(directory, 'leech')
+    try:
+        downloading = session.add(torrent.path, leech_dir)
+        while torrent.info_hash not in session.torrents:
+            await asyncio.sleep(0.001)
+        first_byte = await seek(session.stream_url(torrent.info_hash), offset)
+        downloading.cancel()
+        return first_byte
+    finally:
+        await session.close()
+        shutil.rmtree(leech_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=64, help='torrent size in MiB')
+    parser.add_argument('--piece-length', type=int, default=256, help='piece length in KiB')
+    parser.add_argument('--seeders', type=int, default=4)
+    parser.add_argument('--latency', type=floats, default=[50.0],
+                        help='round trip ms added per seeder, comma separated')
+    parser.add_argument('--loss', type=floats, default=[0.0],
+                        help='chunk loss probability per seeder, comma separated')
+    parser.add_argument('--seeks', type=int, default=8)
+    args = parser.parse_args()
+    logging.getLogger('').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        tracker = loop.run_until_complete(SwarmTracker().start())
+        torrent = Torrent(make_torrent(
+            directory, args.size * 2**20, args.piece_length * 2**10,
+            tracker.announce_url))
+
+        context = multiprocessing.get_context('spawn')
+        ports = context.Queue()
+        stop = context.Event()
+        processes = [
+            context.Process(target=run_seeder, args=(
+                torrent.path, directory, cycle(args.latency, i) / 1000,
+                cycle(args.loss, i), ports, stop))
+            for i in range(args.seeders)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for _ in processes:
+                port, advertised = loop.run_until_complete(
+                    loop.run_in_executor(None, ports.get, True, 60))
+                tracker.aliases[port] = advertised
+            print('{} MiB in {} KiB pieces from {} seeders, latency {} ms, loss {}'.format(
+                args.size, args.piece_length, args.seeders, args.latency, args.loss))
+            rand = random.Random(args.seeks)
+            offsets = [rand.randrange(torrent.size) for _ in range(args.seeks)]
+            for window in (0, 8):
+                times = [
+                    loop.run_until_complete(leech(
+                        directory, torrent, tracker, args.seeders, window, offset))
+                    for offset in offsets
+                ]
+                print('  window {:2}  first byte median {:6.3f} s  max {:6.3f} s'.format(
+                    window, statistics.median(times), max(times)))
+        finally:
+            stop.set()
+            for process in processes:
+                process.join(30)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            tracker.close()
+            close_loop(loop)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+"""
+End to end download benchmark over loopback: a synthetic torrent, N
+seeder processes and an in-process HTTP tracker on 127.0.0.1, and a
+leeching Session in this process that finds the seeders through the
+tracker. Reports MB/s, CPU time (leecher and seeders), the leecher's peak
+RSS and the time to the first piece on disk.
+
+Each seeder can sit behind a proxy that adds latency and loss, given per
+seeder as comma separated lists that are cycled through. TCP hides loss
+behind retransmissions, so a lost segment shows up as the stream stalling
+for a retransmission timeout, and that is what the proxy does.
+
+Run from src/: python -m benchmarks.bench_swarm --size 256 --seeders 4 \\
+    --latency 0,20,100 --loss 0,0.01
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+from urllib import parse as urlparse
+
+import bencode
+from peer_list import encode_compact_peers
+from torrent import Torrent
+from torrio import Session
+
+# What a lost segment costs, Linux's minimum retransmission timeout
+RETRANSMIT_TIMEOUT = 0.2
+ANNOUNCE_INTERVAL = 5
+
+
+def make_torrent(
+        directory : str, size : int, piece_length : int,
+        announce : str, name : str = 'synthetic') -> str:
+    """
+    Writes `size` random bytes to directory/seed/name and a .torrent for
+    them, a piece at a time so big torrents don't need the memory
+    """
+    seed = os.path.join(directory, 'seed')
+    os.makedirs(seed, exist_ok=True)
+    rand = random.Random(size)
+    hashes = []
+    with open(os.path.join(seed, name), 'wb') as f:
+        for offset in range(0, size, piece_length):
+            piece = rand.getrandbits(
+                8 * min(piece_length, size - offset)).to_bytes(
+                    min(piece_length, size - offset), 'big')
+            f.write(piece)
+            hashes.append(hashlib.sha1(piece).digest())
+    path = os.path.join(directory, name + '.torrent')
+    with open(path, 'wb') as f:
+        f.write(bencode.encode({
+            b'announce': announce.encode(),
+            b'info': {
+                b'name': name.encode(),
+                b'length': size,
+                b'piece length': piece_length,
+                b'pieces': b''.join(hashes),
+            },
+        }))
+    return path
+
+
+class SwarmTracker(object):
+    """
+    A minimal HTTP tracker: remembers who announced for which info hash
+    and answers with compact peer lists. Peers behind a proxy are handed
+    out with the proxy's port, see `aliases`.
+    """
+
+    def __init__(self, host : str = '127.0.0.1'):
+        self.host = host
+        self.port = None
+        self.server = None
+        # info hash -> {(host, port): bytes left}
+        self.swarms : dict = {}
+        # Port a seeder listens on -> port of the proxy in front of it
+        self.aliases : dict = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.on_connection, self.host, 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    @property
+    def announce_url(self) -> str:
+        return 'http://{}:{}/announce'.format(self.host, self.port)
+
+    def seeders(self, info_hash : bytes) -> int:
+        return sum(1 for left in self.swarms.get(info_hash, {}).values() if not left)
+
+    def announce(self, host : str, query : str) -> dict:
+        params = {}
+        for pair in query.split('&'):
+            key, _, value = pair.partition('=')
+            params[key] = urlparse.unquote_to_bytes(value)
+        swarm = self.swarms.setdefault(params['info_hash'], {})
+        address = (host, int(params['port']))
+        if params.get('event') == b'stopped':
+            swarm.pop(address, None)
+        else:
+            swarm[address] = int(params.get('left', b'0'))
+        peers = [
+            (peer_host, self.aliases.get(port, port))
+            for peer_host, port in swarm if (peer_host, port) != address
+        ]
+        return {
+            b'interval': ANNOUNCE_INTERVAL,
+            b'peers': encode_compact_peers(peers),
+        }
+
+    async def on_connection(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            target = request.split(b' ', 2)[1].decode('latin-1')
+            path, _, query = target.partition('?')
+            if path == '/announce':
+                body = bencode.encode(self.announce(
+                    writer.get_extra_info('peername')[0], query))
+            else:
+                body = bencode.encode({b'failure reason': b'not found'})
+            writer.write(
+                b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, KeyError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+class ImpairedProxy(object):
+    """
+    Forwards connections to `target_port`, delaying everything by half of
+    `latency` in each direction. Each chunk is lost with probability
+    `loss`, which stalls the stream for RETRANSMIT_TIMEOUT like TCP would.
+    """
+
+    def __init__(self, target_port : int, latency : float = 0, loss : float = 0):
+        self.target_port = target_port
+        self.delay = latency / 2
+        self.loss = loss
+        self.port = None
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.on_connection, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def on_connection(self, client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(
+                '127.0.0.1', self.target_port)
+        except OSError:
+            client_writer.close()
+            return
+        await asyncio.gather(
+            self.pump(client_reader, server_writer),
+            self.pump(server_reader, client_writer),
+            return_exceptions=True)
+        client_writer.close()
+        server_writer.close()
+
+    async def pump(self, reader, writer):
+        """
+        Chunks are delivered in order, at the earliest `delay` after they
+        were read, and a lost one holds up everything behind it
+        """
+        loop = asyncio.get_event_loop()
+        # Bounded, so a stall pushes back on the sender as TCP would
+        queue = asyncio.Queue(256)
+
+        async def deliver():
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    return
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+                writer.write(data)
+                await writer.drain()
+
+        delivering = asyncio.ensure_future(deliver())
+        last_due = 0
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                due = loop.time() + self.delay
+                if self.loss and random.random() < self.loss:
+                    due += RETRANSMIT_TIMEOUT
+                last_due = max(last_due, due)
+                await queue.put((last_due, data))
+            await queue.put((0, None))
+            await delivering
+        finally:
+            delivering.cancel()
+            if writer.can_write_eof():
+                writer.write_eof()
+
+    def close(self):
+        self.server.close()
+
+
+def run_seeder(torrent_path : str, directory : str, latency : float,
+               loss : float, ports, stop):
+    """
+    Seeder process: seeds the torrent, behind an ImpairedProxy if there is
+    any latency or loss, until `stop` is set. Puts (seeder port, port to
+    hand out) on `ports` once listening.
+    """
+    logging.getLogger('').setLevel(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def seed():
+        session = await Session(
+            host='127.0.0.1', port=0,
+            metadata_cache=os.path.join(directory, 'cache')).start()
+        proxy = None
+        if latency or loss:
+            proxy = await ImpairedProxy(session.port, latency, loss).start()
+        ports.put((session.port, proxy.port if proxy else session.port))
+        seeding = session.add(torrent_path, os.path.join(directory, 'seed'), seed=True)
+        try:
+            await loop.run_in_executor(None, stop.wait)
+        finally:
+            seeding.cancel()
+            await session.close()
+            if proxy is not None:
+                proxy.close()
+
+    loop.run_until_complete(seed())
+    close_loop(loop)
+
+
+def close_loop(loop):
+    """
+    Closes the loop once the tasks of connections left open are cancelled
+    """
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.close()
+
+
+def cycle(values : list, i : int) -> float:
+    return values[i % len(values)]
+
+
+async def leech(directory : str, torrent_path : str, tracker : SwarmTracker,
+                info_hash : bytes, seeders : int) -> dict:
+    while tracker.seeders(info_hash) < seeders:
+        await asyncio.sleep(0.05)
+
+    session = await Session(
+        host='127.0.0.1', port=0,
+        metadata_cache=os.path.join(directory, 'cache')).start()
+    first_piece = None
+
+    async def watch_first_piece():
+        nonlocal first_piece
+        while not any(s.pieces_on_disk for s in session.torrents.values()):
+            await asyncio.sleep(0.001)
+        first_piece = time.monotonic() - start
+
+    try:
+        start = time.monotonic()
+        cpu = time.process_time()
+        watching = asyncio.ensure_future(watch_first_piece())
+        downloaded = await session.download(
+            torrent_path, os.path.join(directory, 'leech'))
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpu
+        watching.cancel()
+        return {
+            'elapsed': elapsed,
+            'cpu': cpu,
+            'first_piece': first_piece,
+            'pieces': downloaded.number_of_pieces,
+        }
+    finally:
+        await session.close()
+
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        tracker = loop.run_until_complete(SwarmTracker().start())
+        started = time.monotonic()
+        torrent_path = make_torrent(
+            directory, args.size * 2**20, args.piece_length * 2**10,
+            tracker.announce_url)
+        info_hash = Torrent(torrent_path).info_hash
+        generated = time.monotonic() - started
+
+        context = multiprocessing.get_context('spawn')
+        ports = context.Queue()
+        stop = context.Event()
+        processes = [
+            context.Process(target=run_seeder, args=(
+                torrent_path, directory, cycle(args.latency, i) / 1000,
+                cycle(args.loss, i), ports, stop))
+            for i in range(args.seeders)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for _ in processes:
+                port, advertised = loop.run_until_complete(
+                    loop.run_in_executor(None, ports.get, True, 60))
+                tracker.aliases[port] = advertised
+            result = loop.run_until_complete(
+                leech(directory, torrent_path, tracker, info_hash, args.seeders))
+        finally:
+            stop.set()
+            for process in processes:
+                process.join(30)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            tracker.close()
+            close_loop(loop)
+        result['generated'] = generated
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result['seeder_cpu'] = children.ru_utime + children.ru_stime
+        return result
+
+
+def floats(value : str) -> list:
+    return [float(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=64, help='torrent size in MiB')
+    parser.add_argument('--piece-length', type=int, default=256, help='piece length in KiB')
+    parser.add_argument('--seeders', type=int, default=4)
+    parser.add_argument('--latency', type=floats, default=[0.0],
+                        help='round trip ms added per seeder, comma separated')
+    parser.add_argument('--loss', type=floats, default=[0.0],
+                        help='chunk loss probability per seeder, comma separated')
+    args = parser.parse_args()
+    logging.getLogger('').setLevel(logging.WARNING)
+
+    result = run(args)
+    size = args.size * 2**20
+    print('{} MiB in {} KiB pieces from {} seeders, latency {} ms, loss {}'.format(
+        args.size, args.piece_length, args.seeders, args.latency, args.loss))
+    print('  generated       {:8.2f} s'.format(result['generated']))
+    print('  downloaded      {:8.2f} s  {:7.1f} MB/s'.format(
+        result['elapsed'], size / 2**20 / result['elapsed']))
+    print('  first piece     {:8.3f} s'.format(result['first_piece']))
+    print('  cpu             {:8.2f} s leecher, {:.2f} s seeders'.format(
+        result['cpu'], result['seeder_cpu']))
+    print('  peak rss        {:8.1f} MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
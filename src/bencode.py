@@ -0,0 +1,205 @@
+_NOTHING = object()
+_DIGITS = frozenset(b'0123456789')
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def encode(obj) -> bytes:
+    parts = []
+    _encode(obj, parts.append)
+    return b''.join(parts)
+
+
+def _encode(obj, write):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        write(b'%d:' % len(obj))
+        write(obj)
+    elif isinstance(obj, str):
+        _encode(obj.encode('utf-8'), write)
+    elif isinstance(obj, int):
+        write(b'i%de' % obj)
+    elif isinstance(obj, (list, tuple)):
+        write(b'l')
+        for item in obj:
+            _encode(item, write)
+        write(b'e')
+    elif isinstance(obj, dict):
+        write(b'd')
+        items = [
+            (key.encode('utf-8') if isinstance(key, str) else key, value)
+            for key, value in obj.items()
+        ]
+        items.sort(key=lambda item: item[0])
+        for key, value in items:
+            _encode(key, write)
+            _encode(value, write)
+        write(b'e')
+    else:
+        raise BencodeError('Cannot bencode {!r}'.format(type(obj)))
+
+
+class Decoder(object):
+    """
+    Incremental bencode decoder. Data can be fed in chunks as it arrives,
+    e.g. a large tracker response straight off the socket, and `finish`
+    returns the decoded value.
+
+    Values of the top level dict whose key is in `span_keys` have the
+    (start, end) offsets of their raw encoding recorded in `spans`, which
+    is how a torrent's info hash is computed from the original bytes.
+    """
+
+    def __init__(self, span_keys=()):
+        self.span_keys = frozenset(span_keys)
+        self.spans : dict = {}
+        self.result = _NOTHING
+        # Stop after the first value instead of rejecting what follows
+        self.stop_at_end = False
+        self._buffer = bytearray()
+        # Absolute offset of _buffer[0]
+        self._offset = 0
+        self._pos = 0
+        # [container, pending dict key, start offset]
+        self._stack : list = []
+
+    def feed(self, data : bytes):
+        self._buffer += data
+        self._pos = self._parse(self._buffer, self._pos, None)
+        # Drop what has been consumed once it's worth the copy
+        if self._pos > 65536 and self._pos * 2 > len(self._buffer):
+            del self._buffer[:self._pos]
+            self._offset += self._pos
+            self._pos = 0
+
+    def finish(self):
+        if self.result is _NOTHING or self._pos != len(self._buffer):
+            raise BencodeError('Truncated bencoded data')
+        return self.result
+
+    def _parse(self, buf, pos : int, lazy_threshold) -> int:
+        """
+        Parses as many complete values from 'buf' as there are, returns
+        the position of the first unparsed byte. Strings of at least
+        'lazy_threshold' bytes are returned as views into 'buf'.
+        """
+        stack = self._stack
+        end = len(buf)
+        find = buf.find
+        while pos < end:
+            if self.result is not _NOTHING:
+                if self.stop_at_end:
+                    break
+                raise BencodeError('Trailing data at offset {}'.format(self._offset + pos))
+            start = pos
+            c = buf[pos]
+            if c == 0x6c:  # l
+                stack.append([[], None, self._offset + pos])
+                pos += 1
+                continue
+            if c == 0x64:  # d
+                stack.append([{}, None, self._offset + pos])
+                pos += 1
+                continue
+            if c == 0x65:  # e
+                if not stack:
+                    raise BencodeError('Unexpected end at offset {}'.format(self._offset + pos))
+                container, key, start = stack.pop()
+                if key is not None:
+                    raise BencodeError('Dict key without value at offset {}'.format(start))
+                value = container
+                pos += 1
+                start -= self._offset
+            elif c == 0x69:  # i
+                e = find(b'e', pos + 1)
+                if e < 0:
+                    if end - pos > 32:
+                        raise BencodeError('Invalid int at offset {}'.format(self._offset + pos))
+                    break
+                try:
+                    value = int(buf[pos + 1:e])
+                except ValueError:
+                    raise BencodeError('Invalid int at offset {}'.format(self._offset + pos))
+                pos = e + 1
+            elif c in _DIGITS:
+                colon = find(b':', pos)
+                if colon < 0:
+                    if end - pos > 20:
+                        raise BencodeError('Invalid string at offset {}'.format(self._offset + pos))
+                    break
+                try:
+                    length = int(buf[pos:colon])
+                except ValueError:
+                    raise BencodeError('Invalid string at offset {}'.format(self._offset + pos))
+                stop = colon + 1 + length
+                if stop > end:
+                    break
+                if lazy_threshold is not None and length >= lazy_threshold:
+                    value = memoryview(buf)[colon + 1:stop]
+                else:
+                    value = bytes(buf[colon + 1:stop])
+                pos = stop
+            else:
+                raise BencodeError('Invalid byte {!r} at offset {}'.format(
+                    chr(c), self._offset + pos))
+
+            if not stack:
+                self.result = value
+                continue
+            top = stack[-1]
+            container = top[0]
+            if container.__class__ is list:
+                container.append(value)
+            elif top[1] is None:
+                if value.__class__ is memoryview:
+                    value = bytes(value)
+                if value.__class__ is not bytes:
+                    raise BencodeError('Dict key must be a string at offset {}'.format(
+                        self._offset + start))
+                top[1] = value
+            else:
+                key = top[1]
+                container[key] = value
+                top[1] = None
+                if key in self.span_keys and len(stack) == 1:
+                    self.spans[key] = (self._offset + start, self._offset + pos)
+        return pos
+
+
+def decode(data : bytes, span_keys=(), lazy_threshold : int = None):
+    """
+    Decodes a complete bencoded value. With 'lazy_threshold', strings of
+    at least that many bytes are memoryviews into 'data' instead of
+    copies, e.g. a torrent's piece hashes.
+    """
+    value, _ = decode_with_spans(data, span_keys, lazy_threshold)
+    return value
+
+
+def decode_with_spans(data : bytes, span_keys=(), lazy_threshold : int = None) -> tuple:
+    """
+    Returns (value, spans), see Decoder
+    """
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    decoder = Decoder(span_keys)
+    pos = decoder._parse(data, 0, lazy_threshold)
+    if decoder.result is _NOTHING or pos != len(data) or decoder._stack:
+        raise BencodeError('Truncated bencoded data')
+    return decoder.result, decoder.spans
+
+
+def decode_prefix(data : bytes) -> tuple:
+    """
+    Decodes the value at the start of 'data', returns (value, end offset).
+    For messages with raw bytes after a bencoded header, like ut_metadata.
+    """
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    decoder = Decoder()
+    decoder.stop_at_end = True
+    pos = decoder._parse(data, 0, None)
+    if decoder.result is _NOTHING:
+        raise BencodeError('Truncated bencoded data')
+    return decoder.result, pos
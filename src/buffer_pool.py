@@ -0,0 +1,149 @@
+import asyncio
+from collections import deque
+
+
+class NoBufferAvailable(Exception):
+    pass
+
+
+class MemoryBudget(object):
+    """
+    Bytes of buffers that several BufferPools, one per torrent, may
+    allocate between them. A pool gives a released buffer back to the
+    budget instead of keeping it when another pool is waiting for memory.
+    """
+
+    def __init__(self, limit : int):
+        self.limit = limit
+        self.allocated = 0
+        self._waiters : deque = deque()
+
+    @property
+    def waiting(self) -> bool:
+        return bool(self._waiters)
+
+    def try_allocate(self, size : int) -> bool:
+        if self.allocated + size > self.limit:
+            return False
+        self.allocated += size
+        return True
+
+    def free(self, size : int):
+        self.allocated -= size
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_available(self, size : int):
+        if self.allocated + size <= self.limit:
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+
+class BufferPool(object):
+    """
+    Fixed budget of piece sized buffers that blocks are written into.
+
+    A buffer is taken when a piece is started and returned once the piece
+    is on disk (or has failed), and is then reused for the next piece
+    instead of being freed. When the whole budget is in use `try_acquire`
+    returns None and callers wait with `wait_available` instead of
+    allocating more, which is what keeps a slow disk from growing memory
+    without bound.
+
+    Buffers are allocated on first use up to the budget unless
+    `preallocate` is set: bytearrays are zero filled on creation, so
+    preallocating commits the whole budget up front.
+
+    With `shared` the pool's allocations also count against a
+    MemoryBudget shared with other pools.
+    """
+
+    def __init__(
+            self, buffer_size : int, budget : int, preallocate : bool = False,
+            shared : MemoryBudget = None):
+        self.buffer_size = buffer_size
+        self.shared = shared
+        self.capacity = max(1, budget // buffer_size)
+        self.allocated = 0
+        self.in_use = 0
+        # Times a caller found the pool empty
+        self.stalls = 0
+        self.closed = False
+        self._free : list = []
+        self._waiters : deque = deque()
+        if preallocate and shared is None:
+            self._free = [bytearray(buffer_size) for _ in range(self.capacity)]
+            self.allocated = self.capacity
+
+    def __len__(self):
+        """
+        Number of buffers that can still be acquired
+        """
+        return self.capacity - self.in_use
+
+    def try_acquire(self):
+        if self._free:
+            buf = self._free.pop()
+        elif self.allocated < self.capacity and (
+                self.shared is None or
+                self.shared.try_allocate(self.buffer_size)):
+            buf = bytearray(self.buffer_size)
+            self.allocated += 1
+        else:
+            self.stalls += 1
+            return None
+        self.in_use += 1
+        return buf
+
+    async def wait_available(self):
+        """
+        Waits until a buffer has been released
+        """
+        if self.in_use < self.capacity:
+            if (self.shared is not None and not self._free and
+                    self.allocated == self.in_use):
+                # Our own budget has room but the shared one may not
+                await self.shared.wait_available(self.buffer_size)
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def release(self, buf : bytearray):
+        self.in_use -= 1
+        if self.shared is not None and (self.closed or self.shared.waiting):
+            # Another pool needs the memory more than we need a spare
+            self.allocated -= 1
+            self.shared.free(self.buffer_size)
+        else:
+            self._free.append(buf)
+        # Wake everyone, a woken peer may not end up taking the buffer
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def close(self):
+        """
+        The torrent is done with the pool, spare buffers and the ones still
+        in use once they are released go back to the shared budget
+        """
+        self.closed = True
+        if self.shared is not None and self._free:
+            self.allocated -= len(self._free)
+            self.shared.free(len(self._free) * self.buffer_size)
+        self._free = []
+
+    def stats(self) -> dict:
+        return {
+            'capacity': self.capacity,
+            'allocated': self.allocated,
+            'in_use': self.in_use,
+            'occupancy': self.in_use / self.capacity,
+            'stalls': self.stalls,
+            'waiters': len(self._waiters),
+        }
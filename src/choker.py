@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import random
+import time
+
+from util import LOG
+
+
+class Choker(object):
+    """
+    Decides which interested peers the Uploader sends data to.
+
+    Every `interval` seconds the interested peers are ranked by how fast
+    they upload to us, or how fast they take our data once we are seeding,
+    and the best `max_upload_slots - 1` are unchoked (tit-for-tat). The
+    last slot is an optimistic unchoke given to a random other interested
+    peer and rotated every `optimistic_interval` seconds, which is how new
+    peers get a chance to show what they can give us.
+    """
+
+    def __init__(
+            self, uploader, interval : float = 10,
+            optimistic_interval : float = 30, clock=time.monotonic,
+            rng : random.Random = None):
+        self.uploader = uploader
+        self.interval = interval
+        self.optimistic_interval = optimistic_interval
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.optimistic = None
+        self._optimistic_since : float = None
+
+    @property
+    def regular_slots(self) -> int:
+        return max(0, self.uploader.max_upload_slots - 1)
+
+    @staticmethod
+    def rate(peer, seeding : bool) -> float:
+        if seeding:
+            return peer.upload_rate.rate
+        return peer.pipeline.download_rate.rate
+
+    def rechoke(self, seeding : bool = False):
+        interested = list(self.uploader.interested)
+        interested.sort(key=lambda peer: self.rate(peer, seeding), reverse=True)
+        regular = interested[:self.regular_slots]
+        unchoke = set(regular)
+
+        now = self.clock()
+        if (self.optimistic not in self.uploader.interested or
+                self.optimistic in unchoke or
+                now - self._optimistic_since >= self.optimistic_interval):
+            candidates = interested[self.regular_slots:]
+            self.optimistic = self.rng.choice(candidates) if candidates else None
+            self._optimistic_since = now
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        for peer in list(self.uploader.unchoked):
+            if peer not in unchoke:
+                self.uploader.choke(peer)
+        for peer in unchoke:
+            self.uploader.unchoke(peer)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Rechoked: {} unchoked, optimistic {}'.format(
+                len(unchoke), self.optimistic))
+
+    async def run(self, is_seeding=lambda: False):
+        """
+        Rechokes every `interval` seconds, `is_seeding` tells which rate
+        peers are ranked by
+        """
+        while True:
+            self.rechoke(is_seeding())
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,310 @@
+import asyncio
+import heapq
+import time
+
+from peer import Peer
+from messages import ProtocolError
+from util import LOG
+
+
+class ConnectionLimits(object):
+    """
+    Connection caps shared by every torrent: at most `max_connections`
+    connections in total, of which at most `max_half_open` are still
+    connecting. Too many simultaneous connects make home routers drop
+    connections and just time out anyway. Torrents waiting for room are
+    woken when another torrent's connection frees some.
+    """
+
+    def __init__(self, max_connections : int = 200, max_half_open : int = 16):
+        self.max_connections = max_connections
+        self.max_half_open = max_half_open
+        self.connections = 0
+        self.half_open = 0
+        self._blocked : set = set()
+
+    def wait_for_room(self, manager):
+        self._blocked.add(manager)
+
+    def forget(self, manager):
+        self._blocked.discard(manager)
+
+    def release(self):
+        """
+        A connection or connect attempt has finished
+        """
+        blocked, self._blocked = self._blocked, set()
+        for manager in blocked:
+            manager.wake()
+
+    @property
+    def full(self) -> bool:
+        return self.connections + self.half_open >= self.max_connections
+
+    @property
+    def can_connect(self) -> bool:
+        return not self.full and self.half_open < self.max_half_open
+
+
+class PeerCandidate(object):
+    """
+    An address we may connect to and how it went the previous times
+    """
+    __slots__ = (
+        'host', 'port', 'failures', 'downloaded', 'connected_time',
+        'next_attempt', 'connected'
+    )
+
+    def __init__(self, host : str, port : int):
+        self.host = host
+        self.port = port
+        self.failures = 0
+        self.downloaded = 0
+        self.connected_time = 0.0
+        self.next_attempt = 0.0
+        self.connected = False
+
+    @property
+    def throughput(self) -> float:
+        if not self.connected_time:
+            return 0.0
+        return self.downloaded / self.connected_time
+
+    @property
+    def score(self) -> tuple:
+        """
+        Peers that gave us data before come first, then untried ones,
+        then the ones that failed the most
+        """
+        return (self.throughput / (1 + self.failures), -self.failures)
+
+    def __repr__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+
+class ConnectionManager(object):
+    """
+    Keeps up to `max_connections` connections open for a torrent, picking
+    the best scored candidates from the pool and replacing connections as
+    they close.
+
+    A candidate that fails to connect is retried after an exponential
+    backoff, `base_backoff * 2**(failures - 1)` capped at `max_backoff`,
+    and forgotten after `max_failures` failures in a row or a protocol
+    error. A candidate whose connection closed normally can be retried
+    after `base_backoff`.
+    """
+
+    def __init__(
+            self, session, max_connections : int = 50,
+            limits : ConnectionLimits = None, connect_timeout : float = 10,
+            base_backoff : float = 5, max_backoff : float = 600,
+            max_failures : int = 8, clock=time.monotonic, peer_factory=Peer):
+        self.session = session
+        self.max_connections = max_connections
+        self.limits = limits or ConnectionLimits()
+        self.connect_timeout = connect_timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+        self.clock = clock
+        self.peer_factory = peer_factory
+
+        self.candidates : dict = {}
+        self.half_open = 0
+        self.active = 0
+        self.tasks : set = set()
+        self._wakeup = None
+
+    def add_peers(self, addresses) -> int:
+        """
+        Adds (host, port) pairs to the candidate pool, returns how many
+        were new
+        """
+        added = 0
+        for host, port in addresses:
+            if (host, port) not in self.candidates:
+                self.candidates[(host, port)] = PeerCandidate(host, port)
+                added += 1
+        if added:
+            self.wake()
+        return added
+
+    @property
+    def accepting(self) -> bool:
+        """
+        Whether there is room for one more connection
+        """
+        return (
+            self.active + self.half_open < self.max_connections and
+            not self.limits.full
+        )
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def fill(self):
+        """
+        Starts connecting to the best candidates while there's room
+        """
+        while self.accepting and self.limits.can_connect:
+            now = self.clock()
+            room = min(
+                self.max_connections - self.active - self.half_open,
+                self.limits.max_half_open - self.limits.half_open,
+                self.limits.max_connections - self.limits.connections - self.limits.half_open,
+            )
+            best = heapq.nlargest(
+                room,
+                (c for c in self.candidates.values()
+                 if not c.connected and c.next_attempt <= now),
+                key=lambda c: c.score
+            )
+            if not best:
+                return
+            for candidate in best:
+                self._start(candidate)
+
+    def _start(self, candidate : PeerCandidate):
+        candidate.connected = True
+        self.half_open += 1
+        self.limits.half_open += 1
+        task = asyncio.ensure_future(self._connect(candidate))
+        self.tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, task):
+        self.tasks.discard(task)
+        self.wake()
+
+    async def _connect(self, candidate : PeerCandidate):
+        peer = self.peer_factory(self.session, candidate.host, candidate.port)
+        try:
+            try:
+                reader, writer = await peer.connect(self.connect_timeout)
+            finally:
+                self.half_open -= 1
+                self.limits.half_open -= 1
+                # A half open slot is free either way
+                self.wake()
+                self.limits.release()
+        except ProtocolError as e:
+            LOG.info('[{}] Protocol error: {}'.format(peer, e))
+            self._forget(candidate)
+            return
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            self._on_failure(candidate, e)
+            return
+
+        candidate.failures = 0
+        start = self.clock()
+        try:
+            await self._run(peer, reader, writer, candidate=candidate)
+        finally:
+            candidate.connected_time += self.clock() - start
+            candidate.downloaded += peer.pipeline.download_rate.total
+            candidate.next_attempt = self.clock() + self.base_backoff
+            candidate.connected = False
+
+    async def accept(self, peer : Peer, reader, writer):
+        """
+        Runs an incoming connection, counting it against the limits. It's
+        closed with the outgoing ones when `run` stops.
+        """
+        task = asyncio.ensure_future(self._run(peer, reader, writer, incoming=True))
+        self.tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        await task
+
+    async def _run(
+            self, peer : Peer, reader, writer, incoming : bool = False,
+            candidate : PeerCandidate = None):
+        self.active += 1
+        self.limits.connections += 1
+        try:
+            if incoming:
+                await peer.accept(reader, writer)
+            else:
+                try:
+                    await peer.run(reader, writer)
+                finally:
+                    writer.close()
+        except ProtocolError as e:
+            LOG.info('[{}] Protocol error: {}'.format(peer, e))
+            # Like at connect time, a misbehaving peer isn't redialled
+            if candidate is not None:
+                self._forget(candidate)
+        except ConnectionError as e:
+            LOG.info('[{}] Connection closed: {}'.format(peer, e))
+        finally:
+            self.active -= 1
+            self.limits.connections -= 1
+            self.wake()
+            self.limits.release()
+
+    def _on_failure(self, candidate : PeerCandidate, error : Exception):
+        candidate.connected = False
+        candidate.failures += 1
+        LOG.info('Failed to connect to {} ({} times): {!r}'.format(
+            candidate, candidate.failures, error))
+        if candidate.failures >= self.max_failures:
+            self._forget(candidate)
+            return
+        backoff = self.base_backoff * 2 ** (candidate.failures - 1)
+        candidate.next_attempt = self.clock() + min(backoff, self.max_backoff)
+        self.wake()
+
+    def _forget(self, candidate : PeerCandidate):
+        self.candidates.pop((candidate.host, candidate.port), None)
+        self.wake()
+
+    def _next_attempt_in(self):
+        if self.active + self.half_open >= self.max_connections:
+            # Only a closing connection makes room, and that wakes us
+            return None
+        if not self.limits.can_connect:
+            # Waiting on other torrents' connections, which wake us
+            self.limits.wait_for_room(self)
+            return None
+        waiting = [
+            c.next_attempt for c in self.candidates.values() if not c.connected
+        ]
+        if not waiting:
+            return None
+        return max(0.0, min(waiting) - self.clock())
+
+    async def run(self, linger : bool = False):
+        """
+        Keeps the connections topped up. Returns once there is nobody
+        left to connect to and every connection has closed, or with
+        `linger` keeps waiting for new candidates and incoming connections
+        until cancelled.
+        """
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                self._wakeup.clear()
+                self.fill()
+                if (not linger and not self.candidates and not self.tasks and
+                        not self.active):
+                    return
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), self._next_attempt_in())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wakeup = None
+            self.limits.forget(self)
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'candidates': len(self.candidates),
+            'half_open': self.half_open,
+            'active': self.active,
+        }
@@ -0,0 +1,653 @@
+import asyncio
+import hashlib
+import heapq
+import os
+import random
+import socket
+import struct
+import time
+
+import bencode
+from metrics import REGISTRY
+from peer_list import decode_peers, encode_compact_peers
+from util import LOG
+
+# Well known nodes to join the DHT through
+BOOTSTRAP_NODES = (
+    ('router.bittorrent.com', 6881),
+    ('dht.transmissionbt.com', 6881),
+    ('router.utorrent.com', 6881),
+)
+# Kademlia's bucket size and lookup parallelism
+K = 8
+ALPHA = 3
+# Nodes that leave this many queries in a row unanswered are dropped
+MAX_FAILURES = 2
+# A node we haven't heard from in this long may be replaced by a new one
+NODE_LIFETIME = 15 * 60
+# The token secret changes this often, a token is good for two of them
+TOKEN_ROTATION = 5 * 60
+# Peers announced to us are forgotten after this long
+PEER_LIFETIME = 30 * 60
+# Most peers in a get_peers response, so it fits in one datagram
+MAX_VALUES = 50
+# What we store for others, so nobody can fill our memory
+MAX_PEERS_PER_TORRENT = 200
+MAX_TORRENTS = 2000
+# How often `run` looks a torrent up again, sooner when nobody was found
+LOOKUP_INTERVAL = 15 * 60
+RETRY_INTERVAL = 60
+
+ERROR_PROTOCOL = 203
+ERROR_METHOD_UNKNOWN = 204
+
+DHT_NODES = REGISTRY.gauge('battorrent_dht_nodes', 'Nodes in the DHT routing table')
+
+_COMPACT_NODE = struct.Struct('>20s4sH')
+
+
+class DHTError(Exception):
+    pass
+
+
+def distance(a : bytes, b : bytes) -> int:
+    """
+    Kademlia's XOR metric between two node ids or info hashes
+    """
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+def encode_compact_nodes(nodes) -> bytes:
+    """
+    26 bytes per Node: id, IPv4 address and port. IPv6 nodes are left out.
+    """
+    records = []
+    for node in nodes:
+        try:
+            records.append(_COMPACT_NODE.pack(
+                node.id, socket.inet_aton(node.host), node.port))
+        except OSError:
+            continue
+    return b''.join(records)
+
+
+def decode_compact_nodes(data) -> list:
+    """
+    (node id, host, port) of every record of a compact node list, a
+    truncated last record is ignored
+    """
+    if not isinstance(data, bytes):
+        return []
+    view = memoryview(data)
+    view = view[:len(view) - len(view) % _COMPACT_NODE.size]
+    return [
+        (node_id, socket.inet_ntoa(ip), port)
+        for node_id, ip, port in _COMPACT_NODE.iter_unpack(view) if port
+    ]
+
+
+def _node_id(value) -> bytes:
+    """
+    `value` if it's a 20 byte id or info hash, else ValueError
+    """
+    if not isinstance(value, bytes) or len(value) != 20:
+        raise ValueError('Invalid id {!r}'.format(value))
+    return value
+
+
+class Node(object):
+    __slots__ = ('id', 'host', 'port', 'last_seen', 'failures')
+
+    def __init__(self, node_id : bytes, host : str, port : int, last_seen : float):
+        self.id = node_id
+        self.host = host
+        self.port = port
+        self.last_seen = last_seen
+        self.failures = 0
+
+    @property
+    def address(self) -> tuple:
+        return self.host, self.port
+
+    def __repr__(self):
+        return '<Node {} {}:{}>'.format(self.id.hex()[:8], self.host, self.port)
+
+
+class RoutingTable(object):
+    """
+    Kademlia routing table: a bucket of up to `k` nodes for each length of
+    the prefix their id shares with ours, so we know many nodes close to
+    us and a few far away. Nodes that have been around longest are kept,
+    a new node only gets into a full bucket by replacing one that failed
+    to answer or went quiet.
+    """
+
+    def __init__(self, own_id : bytes, k : int = K, clock=time.monotonic):
+        self.own_id = own_id
+        self.k = k
+        self.clock = clock
+        self.buckets = [[] for _ in range(160)]
+        # node id -> Node
+        self._nodes : dict = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(list(self._nodes.values()))
+
+    def get(self, node_id : bytes) -> Node:
+        return self._nodes.get(node_id)
+
+    def _bucket(self, node_id : bytes) -> list:
+        return self.buckets[160 - distance(node_id, self.own_id).bit_length()]
+
+    def add(self, node_id : bytes, host : str, port : int) -> Node:
+        """
+        Records that we heard from a node, returns its Node or None if
+        there's no room for it
+        """
+        if node_id == self.own_id or len(node_id) != 20 or not port:
+            return None
+        now = self.clock()
+        node = self._nodes.get(node_id)
+        if node is not None:
+            if node.address == (host, port):
+                node.last_seen = now
+                node.failures = 0
+            # Else someone else claims its id, the node we know stays
+            return node
+
+        bucket = self._bucket(node_id)
+        if len(bucket) >= self.k:
+            stale = [
+                n for n in bucket
+                if n.failures or now - n.last_seen > NODE_LIFETIME
+            ]
+            if not stale:
+                return None
+            self.remove(max(stale, key=lambda n: (n.failures, -n.last_seen)).id)
+        node = Node(node_id, host, port, now)
+        bucket.append(node)
+        self._nodes[node_id] = node
+        return node
+
+    def failed(self, node_id : bytes):
+        """
+        The node didn't answer a query
+        """
+        node = self._nodes.get(node_id)
+        if node is None:
+            return
+        node.failures += 1
+        if node.failures >= MAX_FAILURES:
+            self.remove(node_id)
+
+    def remove(self, node_id : bytes):
+        node = self._nodes.pop(node_id, None)
+        if node is not None:
+            self._bucket(node_id).remove(node)
+
+    def closest(self, target : bytes, count : int = None) -> list:
+        """
+        The `count` (default k) nodes closest to `target`, closest first
+        """
+        return heapq.nsmallest(
+            count or self.k, self._nodes.values(),
+            key=lambda node: distance(node.id, target))
+
+
+class _DHTProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self.node = node
+
+    def datagram_received(self, data, addr):
+        self.node.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, the query times out
+        LOG.debug('DHT socket error: {!r}'.format(exc))
+
+
+class DHTNode(object):
+    """
+    A node of the mainline DHT (BEP 5), over KRPC on one UDP socket.
+
+    It answers ping, find_node, get_peers and announce_peer for other
+    nodes, storing the peers announced to it with a token that proves
+    they asked from that address first. Its own lookups are iterative:
+    the closest nodes known are asked, `alpha` at a time, and the closer
+    nodes they return are asked in turn until the `k` closest that
+    answered have all been asked.
+
+    With `state_file` our node id and routing table are saved on close
+    and loaded on start, so a restart bootstraps from nodes that were
+    alive recently rather than only through the `bootstrap` routers.
+    """
+
+    def __init__(
+            self, host : str = '0.0.0.0', port : int = 6881,
+            node_id : bytes = None, state_file : str = None,
+            bootstrap=BOOTSTRAP_NODES, alpha : int = ALPHA, k : int = K,
+            timeout : float = 2, clock=time.monotonic):
+        self.host = host
+        self.port = port
+        self.state_file = state_file
+        self.bootstrap_nodes = list(bootstrap)
+        self.alpha = alpha
+        self.k = k
+        self.timeout = timeout
+        self.clock = clock
+        self.node_id = node_id
+        saved = self.load_state() if state_file is not None else []
+        if self.node_id is None:
+            self.node_id = os.urandom(20)
+        self.table = RoutingTable(self.node_id, k, clock)
+        # Nodes of the last run, tried first when bootstrapping
+        self._saved_nodes = saved
+
+        self.transport = None
+        # transaction id -> (future of the response, address asked)
+        self._transactions : dict = {}
+        self._next_transaction = random.getrandbits(16)
+        self._secrets = [os.urandom(8), os.urandom(8)]
+        self._rotated_at = clock()
+        # info hash -> {(host, port): expiry}
+        self.peers : dict = {}
+        self._bootstrapping = None
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DHTProtocol(self), local_addr=(self.host, self.port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        DHT_NODES.track(self, len)
+        self._bootstrapping = asyncio.ensure_future(self.bootstrap())
+        LOG.info('DHT node {} on port {}'.format(self.node_id.hex(), self.port))
+        return self
+
+    def __len__(self):
+        return len(self.table)
+
+    async def bootstrap(self):
+        """
+        Fills the routing table: pings the nodes of the last run and the
+        bootstrap routers, then looks up our own id through whoever
+        answered
+        """
+        loop = asyncio.get_event_loop()
+        addresses = [(host, port) for _, host, port in self._saved_nodes]
+        for host, port in self.bootstrap_nodes:
+            try:
+                infos = await loop.getaddrinfo(
+                    host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            except OSError as e:
+                LOG.info('Cannot resolve DHT router {}: {!r}'.format(host, e))
+                continue
+            addresses += [info[4][:2] for info in infos[:1]]
+        await asyncio.gather(
+            *[self.query(address, 'ping') for address in addresses],
+            return_exceptions=True)
+        await self.find_node(self.node_id)
+        LOG.info('DHT bootstrapped with {} nodes'.format(len(self.table)))
+
+    async def wait_bootstrapped(self):
+        """
+        Waits for the bootstrap that start() began, and starts another if
+        the routing table is still empty, e.g. we were offline
+        """
+        if self._bootstrapping is not None:
+            await asyncio.shield(self._bootstrapping)
+        if not len(self.table):
+            self._bootstrapping = asyncio.ensure_future(self.bootstrap())
+            await asyncio.shield(self._bootstrapping)
+
+    async def find_node(self, target : bytes) -> list:
+        """
+        The `k` nodes closest to `target` that answered, closest first
+        """
+        answered = await self._lookup(target, 'find_node', {b'target': target})
+        return [node for node, _ in answered]
+
+    async def get_peers(self, info_hash : bytes) -> list:
+        """
+        Peers of a torrent, from the nodes closest to its info hash
+        """
+        _, peers = await self._get_peers(info_hash)
+        return peers
+
+    async def announce_peer(self, info_hash : bytes, port : int) -> list:
+        """
+        Looks the torrent up and tells the `k` closest nodes that we
+        download it on `port`. Returns the peers the lookup found.
+        """
+        answered, peers = await self._get_peers(info_hash)
+        await asyncio.gather(*[
+            self.query(node.address, 'announce_peer', {
+                b'info_hash': info_hash, b'port': port, b'token': response[b'token']
+            }, node.id)
+            for node, response in answered if isinstance(response.get(b'token'), bytes)
+        ], return_exceptions=True)
+        return peers
+
+    async def run(
+            self, info_hash : bytes, on_peers, port : int = None,
+            interval : float = LOOKUP_INTERVAL, retry : float = RETRY_INTERVAL):
+        """
+        Looks the torrent up every `interval` seconds until cancelled, or
+        after `retry` when nobody was found, and hands the peers to
+        `on_peers`. With `port` we announce ourselves too.
+        """
+        while True:
+            await self.wait_bootstrapped()
+            if port is None:
+                peers = await self.get_peers(info_hash)
+            else:
+                peers = await self.announce_peer(info_hash, port)
+            LOG.info('DHT returned {} peers for {}'.format(len(peers), info_hash.hex()))
+            if peers:
+                on_peers(peers)
+            await asyncio.sleep(interval if peers else retry)
+
+    async def _get_peers(self, info_hash : bytes) -> tuple:
+        answered = await self._lookup(
+            info_hash, 'get_peers', {b'info_hash': info_hash}, all_values=True)
+        values = self._stored_peers(info_hash)
+        for _, response in answered:
+            values += response.get(b'values', [])
+        # BEP 32 nodes may mix in 18 byte IPv6 peers
+        compact = b''.join(v for v in values if isinstance(v, bytes) and len(v) == 6)
+        return answered[:self.k], decode_peers(compact)
+
+    async def _lookup(
+            self, target : bytes, method : str, args : dict,
+            all_values : bool = False) -> list:
+        """
+        Iterative lookup of `target`, returns (Node, response) of the `k`
+        closest nodes that answered, closest first. With `all_values`
+        every node that answered is returned, for the peers they gave.
+        """
+        # distance -> (node id, address) of nodes not asked yet
+        candidates : dict = {}
+        asked : set = set()
+        # (distance, Node, response)
+        answered = []
+        pending : dict = {}
+
+        def consider(node_id, address):
+            d = distance(node_id, target)
+            if node_id != self.node_id and d not in asked and d not in candidates:
+                candidates[d] = (node_id, address)
+
+        for node in self.table.closest(target, self.k):
+            consider(node.id, node.address)
+        try:
+            while True:
+                # Once k nodes answered, only closer ones are worth asking
+                answered.sort(key=lambda entry: entry[0])
+                bound = answered[self.k - 1][0] if len(answered) >= self.k else None
+                while len(pending) < self.alpha and candidates:
+                    d = min(candidates)
+                    if bound is not None and d >= bound:
+                        candidates.clear()
+                        break
+                    node_id, address = candidates.pop(d)
+                    asked.add(d)
+                    task = asyncio.ensure_future(self.query(address, method, args, node_id))
+                    pending[task] = (d, address)
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    d, address = pending.pop(task)
+                    try:
+                        response = task.result()
+                    except DHTError:
+                        continue
+                    node = self.table.get(response[b'id'])
+                    if node is None or node.address != address:
+                        # No room in the table, it answered all the same
+                        node = Node(response[b'id'], *address, self.clock())
+                    answered.append((d, node, response))
+                    for node_id, host, port in decode_compact_nodes(response.get(b'nodes')):
+                        consider(node_id, (host, port))
+        finally:
+            for task in pending:
+                task.cancel()
+        answered.sort(key=lambda entry: entry[0])
+        if not all_values:
+            answered = answered[:self.k]
+        return [(node, response) for _, node, response in answered]
+
+    async def query(
+            self, address : tuple, method : str, args : dict = None,
+            node_id : bytes = None) -> dict:
+        """
+        Sends a KRPC query and returns the `r` dict of the response.
+        Raises DHTError when the node answers with an error or not at all,
+        the node `node_id` then counts as failed.
+        """
+        loop = asyncio.get_event_loop()
+        transaction_id = self._new_transaction()
+        waiter = loop.create_future()
+        self._transactions[transaction_id] = (waiter, address)
+        args = dict(args or {})
+        args[b'id'] = self.node_id
+        try:
+            self._send(address, {
+                b't': transaction_id, b'y': b'q', b'q': method.encode(), b'a': args})
+            return await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            if node_id is not None:
+                self.table.failed(node_id)
+            raise DHTError('{} to {}:{} timed out'.format(method, *address))
+        except OSError as e:
+            raise DHTError('{} to {}:{} failed: {!r}'.format(method, *address, e))
+        finally:
+            self._transactions.pop(transaction_id, None)
+
+    def _new_transaction(self) -> bytes:
+        self._next_transaction = (self._next_transaction + 1) & 0xffff
+        return struct.pack('>H', self._next_transaction)
+
+    def _send(self, address : tuple, message : dict):
+        if self.transport is None or self.transport.is_closing():
+            raise DHTError('DHT node is closed')
+        self.transport.sendto(bencode.encode(message), address)
+
+    def on_datagram(self, data : bytes, address : tuple):
+        try:
+            message = bencode.decode(data)
+        except bencode.BencodeError:
+            return
+        if not isinstance(message, dict) or not isinstance(message.get(b't'), bytes):
+            return
+        kind = message.get(b'y')
+        if kind == b'q':
+            self._on_query(message, address)
+        elif kind in (b'r', b'e'):
+            self._on_response(message, address)
+
+    def _on_response(self, message : dict, address : tuple):
+        waiter, asked = self._transactions.get(message[b't'], (None, None))
+        if waiter is None or waiter.done() or asked != address:
+            return
+        if message[b'y'] == b'e':
+            waiter.set_exception(DHTError('{}:{} answered with error {!r}'.format(
+                *address, message.get(b'e'))))
+            return
+        response = message.get(b'r')
+        try:
+            node_id = _node_id(response.get(b'id'))
+        except (AttributeError, ValueError):
+            waiter.set_exception(DHTError('Malformed response from {}:{}'.format(*address)))
+            return
+        self.table.add(node_id, *address)
+        waiter.set_result(response)
+
+    def _on_query(self, message : dict, address : tuple):
+        transaction_id = message[b't']
+        args = message.get(b'a')
+        handler = self._handlers.get(message.get(b'q'))
+        if handler is None:
+            self._send_error(address, transaction_id, ERROR_METHOD_UNKNOWN, 'Method Unknown')
+            return
+        try:
+            node_id = _node_id(args.get(b'id'))
+            response = handler(self, args, address)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            self._send_error(address, transaction_id, ERROR_PROTOCOL, str(e))
+            return
+        # Read only nodes (BEP 43) can't be queried
+        if not message.get(b'ro'):
+            self.table.add(node_id, *address)
+        response[b'id'] = self.node_id
+        try:
+            self._send(address, {b't': transaction_id, b'y': b'r', b'r': response})
+        except DHTError:
+            pass
+
+    def _send_error(self, address : tuple, transaction_id : bytes, code : int, text : str):
+        try:
+            self._send(address, {b't': transaction_id, b'y': b'e', b'e': [code, text]})
+        except DHTError:
+            pass
+
+    def on_ping(self, args : dict, address : tuple) -> dict:
+        return {}
+
+    def on_find_node(self, args : dict, address : tuple) -> dict:
+        target = _node_id(args[b'target'])
+        return {b'nodes': encode_compact_nodes(self.table.closest(target))}
+
+    def on_get_peers(self, args : dict, address : tuple) -> dict:
+        info_hash = _node_id(args[b'info_hash'])
+        response = {
+            b'token': self._token(address[0]),
+            b'nodes': encode_compact_nodes(self.table.closest(info_hash)),
+        }
+        values = self._stored_peers(info_hash)
+        if values:
+            response[b'values'] = values[:MAX_VALUES]
+        return response
+
+    def on_announce_peer(self, args : dict, address : tuple) -> dict:
+        info_hash = _node_id(args[b'info_hash'])
+        if not self._is_valid_token(address[0], args[b'token']):
+            raise ValueError('Bad token')
+        port = address[1] if args.get(b'implied_port') else args[b'port']
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError('Bad port')
+        self._store_peer(info_hash, (address[0], port))
+        return {}
+
+    _handlers = {
+        b'ping': on_ping,
+        b'find_node': on_find_node,
+        b'get_peers': on_get_peers,
+        b'announce_peer': on_announce_peer,
+    }
+
+    def _token(self, host : str) -> bytes:
+        self._rotate_secrets()
+        return hashlib.sha1(self._secrets[0] + host.encode()).digest()[:8]
+
+    def _is_valid_token(self, host : str, token) -> bool:
+        self._rotate_secrets()
+        return any(
+            token == hashlib.sha1(secret + host.encode()).digest()[:8]
+            for secret in self._secrets
+        )
+
+    def _rotate_secrets(self):
+        now = self.clock()
+        if now - self._rotated_at >= TOKEN_ROTATION:
+            self._secrets = [os.urandom(8), self._secrets[0]]
+            self._rotated_at = now
+
+    def _store_peer(self, info_hash : bytes, peer : tuple):
+        now = self.clock()
+        peers = self.peers.get(info_hash)
+        if peers is None:
+            if len(self.peers) >= MAX_TORRENTS:
+                self._expire_peers(now)
+                if len(self.peers) >= MAX_TORRENTS:
+                    return
+            peers = self.peers[info_hash] = {}
+        peers.pop(peer, None)
+        if len(peers) >= MAX_PEERS_PER_TORRENT:
+            # The oldest announce goes, dicts keep insertion order
+            del peers[next(iter(peers))]
+        peers[peer] = now + PEER_LIFETIME
+
+    def _stored_peers(self, info_hash : bytes) -> list:
+        """
+        Compact peers announced to us for the torrent, latest first
+        """
+        peers = self.peers.get(info_hash)
+        if not peers:
+            return []
+        now = self.clock()
+        for peer in [peer for peer, expiry in peers.items() if expiry <= now]:
+            del peers[peer]
+        if not peers:
+            del self.peers[info_hash]
+            return []
+        return [encode_compact_peers([peer]) for peer in reversed(peers)]
+
+    def _expire_peers(self, now : float):
+        for info_hash in list(self.peers):
+            peers = self.peers[info_hash]
+            for peer in [peer for peer, expiry in peers.items() if expiry <= now]:
+                del peers[peer]
+            if not peers:
+                del self.peers[info_hash]
+
+    def load_state(self) -> list:
+        """
+        Our node id and the (node id, host, port) of the saved routing
+        table, which the bootstrap pings first
+        """
+        try:
+            with open(self.state_file, 'rb') as f:
+                state = bencode.decode(f.read())
+            node_id = _node_id(state[b'id'])
+            nodes = decode_compact_nodes(state.get(b'nodes', b''))
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            LOG.info('No usable DHT state in {}: {!r}'.format(self.state_file, e))
+            return []
+        if self.node_id is None:
+            self.node_id = node_id
+        return nodes
+
+    def save_state(self):
+        """
+        Writes our node id and routing table atomically
+        """
+        directory = os.path.dirname(self.state_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bencode.encode({
+                b'id': self.node_id,
+                b'nodes': encode_compact_nodes(
+                    node for node in self.table if not node.failures),
+            }))
+        os.replace(tmp_path, self.state_file)
+
+    def close(self):
+        if self._bootstrapping is not None:
+            self._bootstrapping.cancel()
+        for waiter, _ in self._transactions.values():
+            waiter.cancel()
+        if self.state_file is not None:
+            try:
+                self.save_state()
+            except OSError as e:
+                LOG.warning('Cannot save DHT state to {}: {}'.format(self.state_file, e))
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        DHT_NODES.untrack(self)
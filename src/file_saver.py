@@ -1,33 +1,71 @@
 import asyncio
-import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from metrics import REGISTRY
+from storage import PREALLOCATE_SPARSE, Storage
 from util import LOG
 
+DISK_WRITE_SECONDS = REGISTRY.histogram(
+    'battorrent_disk_write_seconds', 'Time to write a piece to disk')
+DISK_QUEUE = REGISTRY.gauge(
+    'battorrent_disk_queue_length', 'Pieces waiting to be written')
+
 
 class FileSaver(object):
-    def __init__(self, outdir, torrent):
-        self.file_name = self.get_file_path(outdir, torrent)
-        self.fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT)
+    """
+    Writes verified pieces to disk. Queue items are (torrent offset, list
+    of buffers, callback or None) and are handed to the Storage on a disk
+    I/O thread pool, so the event loop never waits on the disk. The
+    callback is called with whether the write succeeded once it's done.
+    """
+    def __init__(
+            self, outdir, torrent, executor : ThreadPoolExecutor = None,
+            preallocate : str = PREALLOCATE_SPARSE, skip_files=()):
+        self.torrent = torrent
+        self.storage = Storage(
+            outdir, torrent, preallocate=preallocate, skip_files=skip_files)
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix='disk-io')
         self.received_blocks_queue = asyncio.Queue()
-        asyncio.ensure_future(self.start())
+        self.piece_length = torrent.piece_length
+        # Pieces that are safely on disk, what the resume data records
+        self.written_pieces = bytearray(torrent.number_of_pieces)
+        self.opened = asyncio.ensure_future(self.run_in_executor(self.storage.open))
+        self.task = asyncio.ensure_future(self.start())
+        DISK_QUEUE.track(self, _queue_length)
 
     def get_received_blocks_queue(self):
         return self.received_blocks_queue
 
-    def get_file_path(self, outdir, torrent):
-        name = torrent[b'info'][b'name'].decode()
-        file_path = os.path.join(outdir, name)
-        if os.path.exists(file_path):
-            # TODO: add (num) to file name
-            LOG.info('Previous download exists')
-        return file_path
+    def run_in_executor(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
 
     async def start(self):
+        await self.opened
         while True:
             block = await self.received_blocks_queue.get()
             if not block:
                 LOG.info('Received poison pill.Exiting')
+                await self.run_in_executor(self.storage.close)
+                return
+
+            block_abs_location, block_data, on_written = block
+            written = False
+            started = time.monotonic()
+            try:
+                await self.run_in_executor(
+                    self.storage.write, block_abs_location, block_data)
+                DISK_WRITE_SECONDS.observe(time.monotonic() - started)
+                self.written_pieces[block_abs_location // self.piece_length] = 1
+                written = True
+            except OSError as e:
+                LOG.error('Failed to write at offset {}: {}'.format(
+                    block_abs_location, e))
+            finally:
+                if on_written is not None:
+                    on_written(written)
+
 
-            block_abs_location, block_data = block
-            os.lseek(self.fd, block_abs_location, os.SEEK_SET)
-            os.write(self.fd, block_data)
+def _queue_length(file_saver : FileSaver) -> int:
+    return file_saver.received_blocks_queue.qsize()
@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+HASH_SECONDS = REGISTRY.histogram(
+    'battorrent_hash_seconds', 'Time to hash a piece on the pool')
+HASHES_PENDING = REGISTRY.gauge(
+    'battorrent_hashes_pending',
+    'Pieces in flight on the hash pool, not those waiting for a slot')
+
+
+def sha1_digest(buffers : list) -> bytes:
+    """
+    SHA-1 of the concatenation of 'buffers', fed one buffer at a time so
+    they never have to be joined. hashlib releases the GIL while hashing
+    anything bigger than a couple of KiB, so threads hash in parallel.
+    """
+    h = hashlib.sha1()
+    for buf in buffers:
+        h.update(buf)
+    return h.digest()
+
+
+class PieceHasher(object):
+    """
+    Verifies piece hashes off the event loop.
+
+    At most `max_pending` pieces are handed to the pool at a time, further
+    callers wait their turn so a burst of completed pieces can't queue up
+    unbounded work (and memory) in the executor. With `use_processes` the
+    buffers have to be pickled, which costs a copy, so threads are the
+    default.
+    """
+
+    def __init__(
+            self, workers : int = None, max_pending : int = None,
+            use_processes : bool = False, executor : Executor = None):
+        workers = workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        if executor is None:
+            if use_processes:
+                executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix='hasher')
+        self.executor = executor
+        self.max_pending = max_pending or 2 * workers
+        self.pending = 0
+        self._slots = None
+        HASHES_PENDING.track(self, _pending)
+
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_pending
+
+    async def hash(self, buffers : list) -> bytes:
+        if self._slots is None:
+            # Created lazily so it belongs to the running loop
+            self._slots = asyncio.Semaphore(self.max_pending)
+        if self.use_processes:
+            buffers = [bytes(buf) for buf in buffers]
+
+        async with self._slots:
+            self.pending += 1
+            started = time.monotonic()
+            try:
+                return await asyncio.get_event_loop().run_in_executor(
+                    self.executor, sha1_digest, buffers)
+            finally:
+                self.pending -= 1
+                HASH_SECONDS.observe(time.monotonic() - started)
+
+    async def verify(self, buffers : list, expected : bytes) -> bool:
+        return await self.hash(buffers) == expected
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def _pending(hasher : PieceHasher) -> int:
+    return hasher.pending
@@ -0,0 +1,95 @@
+import base64
+import binascii
+import urllib.parse as urlparse
+
+# Trackers only use `left` to tell seeders from leechers, anything non
+# zero does until the metadata says how big the torrent is
+UNKNOWN_SIZE = 2**14
+
+
+class MagnetError(ValueError):
+    pass
+
+
+def is_magnet(uri : str) -> bool:
+    return uri.startswith('magnet:')
+
+
+def _decode_info_hash(value : str) -> bytes:
+    """
+    The info hash of an `urn:btih:` topic, hex or base32 encoded
+    """
+    try:
+        if len(value) == 40:
+            return binascii.unhexlify(value)
+        if len(value) == 32:
+            return base64.b32decode(value.upper())
+    except (binascii.Error, ValueError):
+        pass
+    raise MagnetError('Invalid info hash {!r}'.format(value))
+
+
+def _parse_peer(value : str):
+    """
+    (host, port) of an `x.pe` peer address, None if it's malformed
+    """
+    try:
+        address = urlparse.urlsplit('//' + value)
+        host, port = address.hostname, address.port
+    except ValueError:
+        return None
+    if not host or not port:
+        return None
+    return host, port
+
+
+class Magnet(object):
+    """
+    A magnet link (BEP 9). It carries what the Tracker needs to find peers
+    for a torrent whose metadata we don't have yet: the info hash and
+    usually a few trackers, each its own tier.
+    """
+
+    def __init__(self, uri : str):
+        self.uri = uri
+        parsed = urlparse.urlsplit(uri)
+        if parsed.scheme != 'magnet':
+            raise MagnetError('Not a magnet link: {}'.format(uri))
+
+        self.info_hash : bytes = None
+        self.display_name : str = None
+        self.trackers : list = []
+        self.peers : list = []
+        self.size = UNKNOWN_SIZE
+        for key, value in urlparse.parse_qsl(parsed.query):
+            if key == 'xt' and value.startswith('urn:btih:'):
+                if self.info_hash is None:
+                    self.info_hash = _decode_info_hash(value[len('urn:btih:'):])
+            elif key == 'dn':
+                self.display_name = value
+            elif key == 'tr' or key.startswith('tr.'):
+                if value not in self.trackers:
+                    self.trackers.append(value)
+            elif key == 'x.pe':
+                peer = _parse_peer(value)
+                if peer is not None:
+                    self.peers.append(peer)
+            elif key == 'xl' and value.isdigit() and int(value):
+                self.size = int(value)
+        if self.info_hash is None:
+            raise MagnetError('Magnet link has no BitTorrent info hash')
+
+    @property
+    def name(self) -> str:
+        return self.display_name or binascii.hexlify(self.info_hash).decode()
+
+    @property
+    def announce_url(self) -> str:
+        return self.trackers[0] if self.trackers else None
+
+    @property
+    def announce_list(self) -> list:
+        return [[url] for url in self.trackers]
+
+    def __repr__(self):
+        return '<Magnet {}>'.format(self.name)
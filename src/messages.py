@@ -0,0 +1,405 @@
+import struct
+
+import bencode
+
+# Upper bound on a single wire message. Large enough for a bitfield of a
+# multi-million piece torrent, small enough that a garbage length prefix
+# can't make us buffer gigabytes.
+MAX_MESSAGE_LENGTH = 2**21
+
+_LENGTH = struct.Struct('>I')
+_HAVE = struct.Struct('>I')
+_BLOCK = struct.Struct('>III')
+_PIECE_HEADER = struct.Struct('>II')
+_PORT = struct.Struct('>H')
+_HANDSHAKE = struct.Struct('>B19s8s20s20s')
+
+PROTOCOL_NAME = b'BitTorrent protocol'
+HANDSHAKE_LENGTH = _HANDSHAKE.size
+# Reserved handshake bytes with the extension protocol bit set (BEP 10)
+RESERVED_EXTENSIONS = bytes([0, 0, 0, 0, 0, 0x10, 0, 0])
+# Extended message id of the extension handshake
+EXTENDED_HANDSHAKE_ID = 0
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_handshake(info_hash : bytes, peer_id : bytes, reserved : bytes = bytes(8)) -> bytes:
+    return _HANDSHAKE.pack(19, PROTOCOL_NAME, reserved, info_hash, peer_id)
+
+
+def decode_handshake(data : bytes):
+    """
+    Returns (reserved, info_hash, peer_id) of a peer's handshake
+    """
+    if len(data) != HANDSHAKE_LENGTH:
+        raise ProtocolError('Handshake has {} bytes'.format(len(data)))
+    pstrlen, pstr, reserved, info_hash, peer_id = _HANDSHAKE.unpack(data)
+    if pstrlen != 19 or pstr != PROTOCOL_NAME:
+        raise ProtocolError('Not a BitTorrent handshake')
+    return reserved, info_hash, peer_id
+
+
+def supports_extensions(reserved : bytes) -> bool:
+    return bool(reserved[5] & 0x10)
+
+
+class Message(object):
+    """
+    Base class for peer wire messages. `id` is the message id byte,
+    KeepAlive is the only message without one.
+    """
+    __slots__ = ()
+    id : int = None
+
+    def payload(self) -> bytes:
+        return b''
+
+    def encode(self) -> bytes:
+        payload = self.payload()
+        return _LENGTH.pack(len(payload) + 1) + bytes([self.id]) + payload
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, slot) == getattr(other, slot)
+            for slot in self.__slots__
+        )
+
+    def __repr__(self):
+        return '<{} {}>'.format(
+            type(self).__name__,
+            ' '.join(
+                '{}={}'.format(slot, getattr(self, slot))
+                for slot in self.__slots__
+                if not isinstance(getattr(self, slot), memoryview)
+            )
+        )
+
+
+class KeepAlive(Message):
+    __slots__ = ()
+
+    def encode(self) -> bytes:
+        return _LENGTH.pack(0)
+
+
+class Choke(Message):
+    __slots__ = ()
+    id = 0
+
+
+class Unchoke(Message):
+    __slots__ = ()
+    id = 1
+
+
+class Interested(Message):
+    __slots__ = ()
+    id = 2
+
+
+class NotInterested(Message):
+    __slots__ = ()
+    id = 3
+
+
+class Have(Message):
+    __slots__ = ('index',)
+    id = 4
+
+    def __init__(self, index : int):
+        self.index = index
+
+    def payload(self) -> bytes:
+        return _HAVE.pack(self.index)
+
+
+class Bitfield(Message):
+    __slots__ = ('bitfield',)
+    id = 5
+
+    def __init__(self, bitfield):
+        self.bitfield = bitfield
+
+    def payload(self) -> bytes:
+        return bytes(self.bitfield)
+
+
+class Request(Message):
+    __slots__ = ('index', 'begin', 'length')
+    id = 6
+
+    def __init__(self, index : int, begin : int, length : int):
+        self.index = index
+        self.begin = begin
+        self.length = length
+
+    def payload(self) -> bytes:
+        return _BLOCK.pack(self.index, self.begin, self.length)
+
+
+class Piece(Message):
+    """
+    `block` is a memoryview into the parser's receive buffer, it is only
+    copied if the receiver decides to keep it as bytes.
+    """
+    __slots__ = ('index', 'begin', 'block')
+    id = 7
+
+    def __init__(self, index : int, begin : int, block):
+        self.index = index
+        self.begin = begin
+        self.block = block
+
+    def payload(self) -> bytes:
+        return _PIECE_HEADER.pack(self.index, self.begin) + bytes(self.block)
+
+
+class Cancel(Message):
+    __slots__ = ('index', 'begin', 'length')
+    id = 8
+
+    def __init__(self, index : int, begin : int, length : int):
+        self.index = index
+        self.begin = begin
+        self.length = length
+
+    def payload(self) -> bytes:
+        return _BLOCK.pack(self.index, self.begin, self.length)
+
+
+class Port(Message):
+    __slots__ = ('port',)
+    id = 9
+
+    def __init__(self, port : int):
+        self.port = port
+
+    def payload(self) -> bytes:
+        return _PORT.pack(self.port)
+
+
+class Extended(Message):
+    """
+    Extension protocol message (BEP 10). `ext_id` is 0 for the extension
+    handshake, otherwise the id the receiver gave the extension in its
+    handshake.
+    """
+    __slots__ = ('ext_id', 'data')
+    id = 20
+
+    def __init__(self, ext_id : int, data):
+        self.ext_id = ext_id
+        self.data = data
+
+    def payload(self) -> bytes:
+        return bytes([self.ext_id]) + bytes(self.data)
+
+
+def encode_extended_handshake(extensions : dict, **fields) -> Extended:
+    """
+    The extension handshake, `extensions` maps extension names to the
+    ids we want to receive them with
+    """
+    handshake = {b'm': extensions}
+    for key, value in fields.items():
+        handshake[key.encode()] = value
+    return Extended(EXTENDED_HANDSHAKE_ID, bencode.encode(handshake))
+
+
+def decode_extended_handshake(data) -> dict:
+    """
+    The peer's extension handshake, 'm' is always a dict of extension
+    names to the non zero ids the peer wants them sent with
+    """
+    try:
+        handshake = bencode.decode(data)
+    except bencode.BencodeError as e:
+        raise ProtocolError('Malformed extension handshake: {}'.format(e))
+    if not isinstance(handshake, dict):
+        raise ProtocolError('Extension handshake is not a dict')
+    extensions = handshake.get(b'm')
+    if not isinstance(extensions, dict):
+        extensions = {}
+    handshake[b'm'] = {
+        name: ext_id for name, ext_id in extensions.items()
+        if isinstance(ext_id, int) and 0 < ext_id < 256
+    }
+    return handshake
+
+
+class UnknownMessage(Message):
+    __slots__ = ('message_id', 'data')
+
+    def __init__(self, message_id : int, data):
+        self.message_id = message_id
+        self.data = data
+
+    @property
+    def id(self):
+        return self.message_id
+
+    def payload(self) -> bytes:
+        return bytes(self.data)
+
+
+def _decode_have(payload):
+    return Have(_HAVE.unpack_from(payload)[0])
+
+
+def _decode_bitfield(payload):
+    return Bitfield(payload)
+
+
+def _decode_request(payload):
+    return Request(*_BLOCK.unpack_from(payload))
+
+
+def _decode_piece(payload):
+    index, begin = _PIECE_HEADER.unpack_from(payload)
+    return Piece(index, begin, payload[_PIECE_HEADER.size:])
+
+
+def _decode_cancel(payload):
+    return Cancel(*_BLOCK.unpack_from(payload))
+
+
+def _decode_port(payload):
+    return Port(_PORT.unpack_from(payload)[0])
+
+
+def _decode_extended(payload):
+    if not len(payload):
+        raise struct.error('Extended message without an id')
+    return Extended(payload[0], payload[1:])
+
+
+_SINGLETONS = {
+    Choke.id: Choke(),
+    Unchoke.id: Unchoke(),
+    Interested.id: Interested(),
+    NotInterested.id: NotInterested(),
+}
+
+_DECODERS = {
+    Have.id: _decode_have,
+    Bitfield.id: _decode_bitfield,
+    Request.id: _decode_request,
+    Piece.id: _decode_piece,
+    Cancel.id: _decode_cancel,
+    Port.id: _decode_port,
+    Extended.id: _decode_extended,
+}
+
+KEEP_ALIVE = KeepAlive()
+
+
+class MessageParser(object):
+    """
+    Incremental framing of the peer wire protocol.
+
+    Chunks read off the socket are fed in with `feed()` and complete
+    messages are pulled out by iterating over the parser. Message payloads
+    are memoryviews into the receive buffer, so framing never copies them.
+
+    A chunk that only holds whole messages is used as the buffer as is.
+    When a message straddles chunks its pieces are collected in a list
+    until enough bytes have arrived and then joined once, so every byte is
+    copied at most once instead of on every message like the old
+    `buf = buf[4 + length:]` loop did. Buffers are never resized in place,
+    which keeps views handed out earlier valid.
+    """
+
+    def __init__(self, max_length : int = MAX_MESSAGE_LENGTH):
+        self.max_length = max_length
+        self._view = memoryview(b'')
+        self._pos = 0
+        # Unframed bytes waiting for the rest of their message
+        self._pending : list = []
+        self._pending_length = 0
+        self._needed = 0
+
+    def __len__(self):
+        """
+        Number of buffered bytes that haven't been framed yet
+        """
+        return len(self._view) - self._pos + self._pending_length
+
+    def feed(self, data : bytes):
+        if self._pos < len(self._view):
+            # Fed before everything buffered was framed
+            self._stash(0)
+
+        if not self._pending:
+            self._view = memoryview(data)
+            self._pos = 0
+            return
+
+        self._pending.append(data)
+        self._pending_length += len(data)
+        if self._pending_length < self._needed:
+            return
+
+        self._view = memoryview(b''.join(self._pending))
+        self._pos = 0
+        self._pending = []
+        self._pending_length = 0
+
+    def __iter__(self):
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
+
+    def _stash(self, needed : int):
+        """
+        Moves the unconsumed tail of the buffer aside until `needed` bytes
+        are available
+        """
+        tail = self._view[self._pos:]
+        if len(tail):
+            self._pending = [tail]
+            self._pending_length = len(tail)
+        self._needed = needed
+        self._view = memoryview(b'')
+        self._pos = 0
+
+    def next_message(self):
+        """
+        Returns the next complete message or None if more data is needed
+        """
+        view, pos = self._view, self._pos
+        available = len(view) - pos
+        if available < 4:
+            self._stash(4)
+            return None
+
+        length = _LENGTH.unpack_from(view, pos)[0]
+        if length > self.max_length:
+            raise ProtocolError('Message length {} exceeds limit'.format(length))
+        if available < 4 + length:
+            self._stash(4 + length)
+            return None
+
+        self._pos = pos + 4 + length
+        if length == 0:
+            return KEEP_ALIVE
+
+        message_id = view[pos + 4]
+        singleton = _SINGLETONS.get(message_id)
+        if singleton is not None:
+            return singleton
+
+        payload = view[pos + 5:pos + 4 + length]
+        decoder = _DECODERS.get(message_id)
+        if decoder is None:
+            return UnknownMessage(message_id, payload)
+        try:
+            return decoder(payload)
+        except struct.error:
+            raise ProtocolError(
+                'Malformed message id {} with length {}'.format(
+                    message_id, length))
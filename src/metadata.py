@@ -0,0 +1,366 @@
+import asyncio
+import binascii
+import hashlib
+import math
+import os
+
+import bencode
+from messages import (
+    EXTENDED_HANDSHAKE_ID, Extended, HANDSHAKE_LENGTH, MessageParser,
+    ProtocolError, RESERVED_EXTENSIONS, decode_extended_handshake,
+    decode_handshake, encode_extended_handshake, encode_handshake,
+    supports_extensions
+)
+from torrent import Torrent
+from util import LOG, PEER_ID
+
+UT_METADATA = b'ut_metadata'
+# The id we ask peers to send us ut_metadata messages with
+UT_METADATA_ID = 2
+METADATA_BLOCK_SIZE = 2**14
+# Larger metadata sizes are refused, the torrent would be absurd and the
+# peer may just want us to buffer gigabytes
+MAX_METADATA_SIZE = 2**24
+
+# ut_metadata msg_type
+METADATA_REQUEST = 0
+METADATA_DATA = 1
+METADATA_REJECT = 2
+
+
+def encode_metadata_message(
+        msg_type : int, piece : int, block=None, total_size : int = None) -> bytes:
+    message = {b'msg_type': msg_type, b'piece': piece}
+    if total_size is not None:
+        message[b'total_size'] = total_size
+    encoded = bencode.encode(message)
+    if block is not None:
+        encoded += bytes(block)
+    return encoded
+
+
+def decode_metadata_message(data) -> tuple:
+    """
+    Returns (msg_type, piece, block) of a ut_metadata message, block is
+    empty for anything but data messages
+    """
+    try:
+        header, end = bencode.decode_prefix(data)
+    except bencode.BencodeError as e:
+        raise ProtocolError('Malformed ut_metadata message: {}'.format(e))
+    if (not isinstance(header, dict) or
+            not isinstance(header.get(b'msg_type'), int) or
+            not isinstance(header.get(b'piece'), int)):
+        raise ProtocolError('Malformed ut_metadata message')
+    return header[b'msg_type'], header[b'piece'], data[end:]
+
+
+def metadata_reply(metadata, piece : int) -> bytes:
+    """
+    Our answer to a peer's request for block 'piece' of 'metadata'
+    """
+    if not 0 <= piece < math.ceil(len(metadata) / METADATA_BLOCK_SIZE):
+        return encode_metadata_message(METADATA_REJECT, piece)
+    begin = piece * METADATA_BLOCK_SIZE
+    return encode_metadata_message(
+        METADATA_DATA, piece, metadata[begin:begin + METADATA_BLOCK_SIZE],
+        total_size=len(metadata))
+
+
+class MetadataFetcher(object):
+    """
+    Downloads a torrent's info dict, its metadata, from peers that support
+    ut_metadata (BEP 9), from up to `max_peers` at once.
+
+    Every peer keeps `pipeline` block requests outstanding and asks for the
+    missing blocks the fewest peers are already asked for, so slow peers
+    get overtaken by fast ones near the end. The assembled metadata is
+    only accepted if it hashes to the info hash. If it doesn't, every peer
+    that sent a block of it is banned and the download starts over.
+    """
+
+    def __init__(
+            self, info_hash : bytes, max_peers : int = 8,
+            connect_timeout : float = 10, request_timeout : float = 20,
+            pipeline : int = 4):
+        self.info_hash = info_hash
+        self.max_peers = max_peers
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.pipeline = pipeline
+
+        self.metadata : bytes = None
+        self.size : int = None
+        self.blocks : list = []
+        # Outstanding requests and sender of every block
+        self.requested : list = []
+        self.sources : list = []
+
+        # Untried addresses, in the order they were given
+        self.candidates : dict = {}
+        self.tried : set = set()
+        self.banned : set = set()
+        # Peers that disagreed with the metadata size we went with
+        self.disagreed : set = set()
+        self.tasks : set = set()
+        self._wakeup = None
+
+    def add_peers(self, addresses) -> int:
+        """
+        Adds (host, port) pairs to try, returns how many were new
+        """
+        added = 0
+        for host, port in addresses:
+            address = (host, port)
+            if address not in self.tried and address not in self.candidates:
+                self.candidates[address] = None
+                added += 1
+        if added:
+            self.wake()
+        return added
+
+    @property
+    def peers(self) -> list:
+        """
+        Addresses we've tried that weren't caught sending bad metadata
+        """
+        return [address for address in self.tried if address not in self.banned]
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def fetch(self) -> bytes:
+        """
+        Returns the metadata once it's complete and verified. Waits for
+        more peers from `add_peers` when it runs out of them.
+        """
+        self._wakeup = asyncio.Event()
+        try:
+            while self.metadata is None:
+                self._wakeup.clear()
+                while self.candidates and len(self.tasks) < self.max_peers:
+                    address = next(iter(self.candidates))
+                    del self.candidates[address]
+                    self.tried.add(address)
+                    task = asyncio.ensure_future(self._fetch_from(*address))
+                    self.tasks.add(task)
+                    task.add_done_callback(self._on_task_done)
+                await self._wakeup.wait()
+            return self.metadata
+        finally:
+            self._wakeup = None
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _on_task_done(self, task):
+        self.tasks.discard(task)
+        self.wake()
+
+    async def _fetch_from(self, host : str, port : int):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            LOG.info('Metadata: failed to connect to {}:{}: {!r}'.format(host, port, e))
+            return
+
+        outstanding : set = set()
+        try:
+            await self._exchange((host, port), reader, writer, outstanding)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ProtocolError) as e:
+            LOG.info('Metadata: dropping {}:{}: {!r}'.format(host, port, e))
+        finally:
+            writer.close()
+            for piece in outstanding:
+                self._release(piece)
+
+    async def _exchange(self, address : tuple, reader, writer, outstanding : set):
+        loop = asyncio.get_event_loop()
+        writer.write(encode_handshake(
+            self.info_hash, PEER_ID.encode(), RESERVED_EXTENSIONS))
+        await writer.drain()
+        reserved, info_hash, _ = decode_handshake(await asyncio.wait_for(
+            reader.readexactly(HANDSHAKE_LENGTH), self.connect_timeout))
+        if info_hash != self.info_hash:
+            raise ProtocolError('Peer is serving another torrent')
+        if not supports_extensions(reserved):
+            raise ProtocolError('Peer does not support the extension protocol')
+        writer.write(encode_extended_handshake({UT_METADATA: UT_METADATA_ID}).encode())
+
+        remote_id = size = None
+        parser = MessageParser()
+        # Peers get `request_timeout` to send each block, other messages
+        # don't count
+        deadline = loop.time() + self.request_timeout
+        while self.metadata is None and address not in self.banned:
+            if remote_id is not None:
+                self._use_size(address, size)
+                self._request_blocks(remote_id, writer, outstanding)
+                if not outstanding:
+                    return
+            await writer.drain()
+
+            data = await asyncio.wait_for(
+                reader.read(65536), max(0, deadline - loop.time()))
+            if not data:
+                return
+            parser.feed(data)
+            for message in parser:
+                if not isinstance(message, Extended):
+                    continue
+                if message.ext_id == EXTENDED_HANDSHAKE_ID:
+                    remote_id, size = self._on_handshake(message.data)
+                elif message.ext_id == UT_METADATA_ID:
+                    msg_type, piece, block = decode_metadata_message(message.data)
+                    if msg_type == METADATA_DATA:
+                        if piece in outstanding:
+                            outstanding.discard(piece)
+                            self._release(piece)
+                        self._on_block(address, piece, block)
+                        deadline = loop.time() + self.request_timeout
+                    elif msg_type == METADATA_REJECT:
+                        raise ProtocolError('Peer rejected metadata request')
+                    elif msg_type == METADATA_REQUEST and remote_id is not None:
+                        writer.write(Extended(remote_id, encode_metadata_message(
+                            METADATA_REJECT, piece)).encode())
+
+    def _on_handshake(self, data) -> tuple:
+        """
+        Returns the peer's ut_metadata id and the metadata size it claims
+        """
+        handshake = decode_extended_handshake(data)
+        remote_id = handshake[b'm'].get(UT_METADATA)
+        size = handshake.get(b'metadata_size')
+        if remote_id is None:
+            raise ProtocolError('Peer does not support ut_metadata')
+        if not isinstance(size, int) or not 0 < size <= MAX_METADATA_SIZE:
+            raise ProtocolError('Invalid metadata size {!r}'.format(size))
+        return remote_id, size
+
+    def _use_size(self, address : tuple, size : int):
+        """
+        The first peer to get here sizes the metadata, peers that claim
+        another size are dropped
+        """
+        if self.size is None:
+            self.size = size
+            count = math.ceil(size / METADATA_BLOCK_SIZE)
+            self.blocks = [None] * count
+            self.requested = [0] * count
+            self.sources = [None] * count
+        elif size != self.size:
+            self.disagreed.add(address)
+            raise ProtocolError('Metadata size {} instead of {}'.format(size, self.size))
+
+    def _request_blocks(self, remote_id : int, writer, outstanding : set):
+        while len(outstanding) < self.pipeline:
+            missing = [
+                piece for piece, block in enumerate(self.blocks)
+                if block is None and piece not in outstanding
+            ]
+            if not missing:
+                return
+            piece = min(missing, key=self.requested.__getitem__)
+            outstanding.add(piece)
+            self.requested[piece] += 1
+            writer.write(Extended(remote_id, encode_metadata_message(
+                METADATA_REQUEST, piece)).encode())
+
+    def _release(self, piece : int):
+        # Counts are reset when bad metadata is thrown away
+        if piece < len(self.requested) and self.requested[piece]:
+            self.requested[piece] -= 1
+
+    def _on_block(self, address : tuple, piece : int, block):
+        if self.size is None or not 0 <= piece < len(self.blocks):
+            raise ProtocolError('Unexpected metadata piece {}'.format(piece))
+        expected = min(METADATA_BLOCK_SIZE, self.size - piece * METADATA_BLOCK_SIZE)
+        if len(block) != expected:
+            raise ProtocolError('Metadata piece {} has {} bytes instead of {}'.format(
+                piece, len(block), expected))
+        if self.blocks[piece] is not None:
+            return
+        self.blocks[piece] = bytes(block)
+        self.sources[piece] = address
+        if all(block is not None for block in self.blocks):
+            self._verify()
+
+    def _verify(self):
+        metadata = b''.join(self.blocks)
+        if hashlib.sha1(metadata).digest() == self.info_hash:
+            LOG.info('Metadata complete, {} bytes'.format(len(metadata)))
+            self.metadata = metadata
+            self.wake()
+            return
+
+        sources = set(self.sources)
+        LOG.warning('Metadata from {} does not match the info hash'.format(sources))
+        self.banned |= sources
+        self.size = None
+        self.blocks, self.requested, self.sources = [], [], []
+        # The size we went with may have been the lie
+        for address in self.disagreed - self.banned:
+            self.tried.discard(address)
+        self.add_peers(self.disagreed - self.banned)
+        self.disagreed = set()
+
+
+class MetadataCache(object):
+    """
+    Torrents whose metadata came from peers, saved as .torrent files named
+    after the info hash so a magnet link needs peers only once
+    """
+
+    def __init__(self, directory : str):
+        self.directory = directory
+
+    def path(self, info_hash : bytes) -> str:
+        return os.path.join(
+            self.directory, binascii.hexlify(info_hash).decode() + '.torrent')
+
+    def load(self, info_hash : bytes) -> Torrent:
+        """
+        The cached torrent, None if there's none or it doesn't match
+        """
+        path = self.path(info_hash)
+        if not os.path.exists(path):
+            return None
+        try:
+            torrent = Torrent(path)
+        except (OSError, bencode.BencodeError) as e:
+            LOG.warning('Ignoring cached metadata {}: {}'.format(path, e))
+            return None
+        if torrent.info_hash != info_hash:
+            LOG.warning('Ignoring cached metadata {}: wrong info hash'.format(path))
+            return None
+        return torrent
+
+    def store(self, info_hash : bytes, metadata : bytes, trackers=()) -> Torrent:
+        """
+        Writes the .torrent atomically, the info dict exactly as the peers
+        sent it so its hash stays the same
+        """
+        if not isinstance(bencode.decode(metadata), dict):
+            raise bencode.BencodeError('Metadata is not a dict')
+        parts = [b'd']
+        if trackers:
+            parts += [
+                bencode.encode(b'announce'), bencode.encode(trackers[0]),
+                bencode.encode(b'announce-list'),
+                bencode.encode([[url] for url in trackers]),
+            ]
+        parts += [bencode.encode(b'info'), metadata, b'e']
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(info_hash)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(parts))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return Torrent(path)
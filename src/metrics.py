@@ -0,0 +1,309 @@
+import asyncio
+import bisect
+import json
+import os
+import weakref
+
+from util import LOG
+
+# Seconds, from a fast SSD write up to a piece stuck behind a busy disk
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+    2.5, 5, 10, 30, 60, 120, 300,
+)
+
+
+class _Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Observations(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds : tuple):
+        self.bounds = bounds
+        # counts[i] is the observations in (bounds[i - 1], bounds[i]], the
+        # last one those above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value : float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric(object):
+    """
+    A named family of values, one per combination of label values.
+    `labels(...)` returns the value for one combination, hot paths keep
+    hold of it so an update is a single attribute increment. Metrics
+    without labels can be updated directly.
+    """
+    kind = None
+
+    def __init__(self, name : str, help : str, labelnames : tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children : dict = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} takes labels {}'.format(self.name, self.labelnames))
+            child = self._children[values] = self._new_child()
+        return child
+
+    def samples(self):
+        """
+        (suffix, labels dict, value) of every value
+        """
+        for values, child in list(self._children.items()):
+            yield '', dict(zip(self.labelnames, values)), child.value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+
+class Gauge(Metric):
+    """
+    Besides being set, a gauge can `track` objects: at export time it
+    reads `fn(obj)` for every tracked object that is still alive and adds
+    the results up per label values. Queue depths and the like cost
+    nothing until someone looks at them.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name : str, help : str, labelnames : tuple = ()):
+        super().__init__(name, help, labelnames)
+        self._tracked = weakref.WeakKeyDictionary()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def dec(self, amount=1):
+        self._default.value -= amount
+
+    def set(self, value):
+        self._default.value = value
+
+    def track(self, obj, fn, *labels):
+        self._tracked[obj] = (fn, tuple(str(label) for label in labels))
+
+    def untrack(self, obj):
+        self._tracked.pop(obj, None)
+
+    def samples(self):
+        totals = {
+            values: child.value for values, child in self._children.items()}
+        for obj, (fn, values) in list(self._tracked.items()):
+            totals[values] = totals.get(values, 0) + fn(obj)
+        for values, value in totals.items():
+            yield '', dict(zip(self.labelnames, values)), value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+            self, name : str, help : str, labelnames : tuple = (),
+            buckets : tuple = DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _Observations(self.bounds)
+
+    def observe(self, value : float):
+        self._default.observe(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            cumulative = 0
+            for bound, count in zip(self.bounds + ('+Inf',), child.counts):
+                cumulative += count
+                yield '_bucket', dict(labels, le=str(bound)), cumulative
+            yield '_sum', labels, child.sum
+            yield '_count', labels, child.count
+
+
+def _escape(value : str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels : dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape(value)) for name, value in labels.items()
+    ) + '}'
+
+
+class Registry(object):
+    """
+    The metrics of a process. Asking for a metric that exists returns it,
+    so modules can declare theirs at import time.
+    """
+
+    def __init__(self):
+        self.metrics : dict = {}
+
+    def _get(self, cls, name : str, help : str, *args, **kwargs) -> Metric:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError('{} is already a {}'.format(name, metric.kind))
+        return metric
+
+    def counter(self, name : str, help : str, labelnames : tuple = ()) -> Counter:
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name : str, help : str, labelnames : tuple = ()) -> Gauge:
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(
+            self, name : str, help : str, labelnames : tuple = (),
+            buckets : tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labelnames, buckets)
+
+    def to_prometheus(self) -> str:
+        """
+        The Prometheus text exposition format
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append('{}{}{} {}'.format(
+                    name, suffix, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> dict:
+        result = {}
+        for name, metric in sorted(self.metrics.items()):
+            result[name] = {
+                'type': metric.kind,
+                'help': metric.help,
+                'samples': [
+                    {'name': name + suffix, 'labels': labels, 'value': value}
+                    for suffix, labels, value in metric.samples()
+                ],
+            }
+        return result
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=1, sort_keys=True)
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer(object):
+    """
+    Serves the registry over HTTP: Prometheus text at /metrics and JSON at
+    /metrics.json. Meant for localhost, it speaks just enough HTTP/1.0 for
+    a scraper or curl.
+    """
+
+    def __init__(
+            self, registry : Registry = REGISTRY, host : str = '127.0.0.1',
+            port : int = 9696, timeout : float = 10):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.on_connection, self.host, self.port)
+        sockets = self.server.sockets or []
+        if sockets:
+            self.port = sockets[0].getsockname()[1]
+        LOG.info('Serving metrics on http://{}:{}/metrics'.format(self.host, self.port))
+        return self
+
+    def respond(self, path : str):
+        """
+        (status, content type, body) for a GET of `path`
+        """
+        path = path.split('?', 1)[0]
+        if path == '/metrics':
+            return '200 OK', 'text/plain; version=0.0.4', self.registry.to_prometheus()
+        if path == '/metrics.json':
+            return '200 OK', 'application/json', self.registry.to_json()
+        return '404 Not Found', 'text/plain', 'Not found\n'
+
+    async def on_connection(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+            method, path = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ')[:2]
+            if method != 'GET':
+                status, content_type, body = '405 Method Not Allowed', 'text/plain', ''
+            else:
+                status, content_type, body = self.respond(path)
+            body = body.encode()
+            writer.write('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+                         'Connection: close\r\n\r\n'.format(
+                             status, content_type, len(body)).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ConnectionError, ValueError) as e:
+            LOG.info('Dropping metrics request: {!r}'.format(e))
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+async def dump_metrics(path : str, interval : float = 60, registry : Registry = REGISTRY):
+    """
+    Writes the registry as JSON to `path` every `interval` seconds, and
+    a last time when cancelled
+    """
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            _write_dump(path, registry)
+    finally:
+        _write_dump(path, registry)
+
+
+def _write_dump(path : str, registry : Registry):
+    partial = path + '.part'
+    try:
+        with open(partial, 'w') as f:
+            f.write(registry.to_json())
+        os.replace(partial, path)
+    except OSError as e:
+        LOG.warning('Failed to write metrics to {}: {}'.format(path, e))
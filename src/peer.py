@@ -1,67 +1,202 @@
 import asyncio
-import struct
-from collections import defaultdict
+import logging
+from collections import deque
 
 import bitstring
 
+from messages import (
+    Bitfield, Cancel, Choke, EXTENDED_HANDSHAKE_ID, Extended,
+    HANDSHAKE_LENGTH, Have, Interested, KeepAlive, Message, MessageParser,
+    NotInterested, Piece as PieceMessage, ProtocolError, RESERVED_EXTENSIONS,
+    Request, Unchoke, decode_extended_handshake, decode_handshake,
+    encode_extended_handshake, encode_handshake, supports_extensions
+)
+from buffer_pool import NoBufferAvailable
+from metadata import (
+    METADATA_REQUEST, UT_METADATA, UT_METADATA_ID, decode_metadata_message,
+    metadata_reply
+)
+from metrics import REGISTRY
+from pex import UT_PEX, UT_PEX_ID
+from pipeline import RateMeter, RequestPipeline
+from ratelimit import TokenBucket
 from util import LOG, PEER_ID, REQUEST_SIZE
 
+MESSAGES_RECEIVED = REGISTRY.counter(
+    'battorrent_messages_received_total', 'Peer wire messages received', ('type',))
+BYTES_RECEIVED = REGISTRY.counter(
+    'battorrent_received_bytes_total', 'Bytes read from peer connections')
+PEER_DOWNLOADED = REGISTRY.gauge(
+    'battorrent_peer_downloaded_bytes',
+    'Block bytes received from each connected peer', ('peer',))
+PEER_UPLOADED = REGISTRY.gauge(
+    'battorrent_peer_uploaded_bytes',
+    'Block bytes sent to each connected peer', ('peer',))
+
+
+def _downloaded(peer) -> int:
+    return peer.pipeline.download_rate.total
+
+
+def _uploaded(peer) -> int:
+    return peer.upload_rate.total
+
 
 class Peer(object):
     def __init__(self, torrent_session, host, port):
         self.host = host
         self.port = port
         self.torrent_session = torrent_session
+        # Where the peer accepts connections: our connections go there,
+        # incoming ones only tell us in their extension handshake
+        self.listen_port = port
+        self.outgoing = True
 
         # Pieces this torrent is able to serve us
         self.have_pieces = bitstring.BitArray(
             bin='0' * self.torrent_session.number_of_pieces
         )
-        self.piece_in_progress = None
-        self.blocks = None
-
-        self.inflight_requests = 0
+        self.pipeline = RequestPipeline()
+        self.buffer_waiter = None
+        self.wake_pending = False
+        # Connections start choked, nothing can be requested until the
+        # peer unchokes us
+        self.peer_choking = True
+        # Extension protocol (BEP 10): whether the peer's handshake had the
+        # bit set, and the ids it gave its extensions
+        self.supports_extensions = False
+        self.extensions : dict = {}
+        # Peer exchange: the addresses we told the peer about, and when
+        # it last told us about others
+        self.pex_advertised : set = set()
+        self.pex_received_at = None
+
+        self.writer = None
+        # Upload side: whether we choke the peer and what it asked for
+        self.am_choking = True
+        self.peer_interested = False
+        self.upload_queue : deque = deque()
+        self.upload_task = None
+        self.upload_rate = RateMeter()
+        # Bandwidth limits, within the torrent's which are within the
+        # global ones
+        self.download_limit = TokenBucket(
+            torrent_session.peer_download_rate,
+            parent=torrent_session.download_limit)
+        self.upload_limit = TokenBucket(
+            torrent_session.peer_upload_rate,
+            parent=torrent_session.upload_limit)
 
     def handshake(self):
-        return struct.pack(
-            '>B19s8x20s20s',
-            19,
-            b'BitTorrent protocol',
+        return encode_handshake(
             self.torrent_session.torrent.info_hash,
-            PEER_ID.encode()
+            PEER_ID.encode(),
+            RESERVED_EXTENSIONS
         )
 
+    def send(self, message : Message):
+        """
+        Queues a message without waiting for it to drain, for messages
+        sent from outside the peer's own loop
+        """
+        if self.writer is not None and not self.writer.transport.is_closing():
+            self.writer.write(message.encode())
+
     async def send_interested(self, writer):
-        # TODO: refactor into messages util
-        msg = struct.pack('>Ib', 1, 2)
-        writer.write(msg)
+        writer.write(Interested().encode())
         await writer.drain()
 
 
-    def get_blocks_generator(self):
-        def blocks():
-            while True:
-                piece = self.torrent_session.get_piece_request(self.have_pieces)
-                LOG.info('[{}] Generating blocks for Piece: {}'.format(self, piece))
-                for block in piece.blocks:
-                    yield block
-        if not self.blocks:
-            self.blocks = blocks()
-        return self.blocks
-
+    async def request_pieces(self, writer):
+        """
+        Tops up the request pipeline and sends the new requests with a
+        single write and drain
+        """
+        if self.queue_requests(writer):
+            await writer.drain()
+
+    def queue_requests(self, writer) -> bool:
+        """
+        Writes requests to top up the pipeline without draining, returns
+        whether there were any
+        """
+        if self.peer_choking or writer.transport.is_closing():
+            return False
+        room = self.pipeline.room()
+        if not room:
+            return False
 
-    async def request_a_piece(self, writer):
-        if self.inflight_requests > 1:
+        try:
+            blocks = self.torrent_session.next_requests(self, room)
+        except NoBufferAvailable:
+            self.request_when_buffer_available(writer)
+            return False
+        if not blocks:
+            return False
+
+        requests = []
+        for block in blocks:
+            requests.append(
+                Request(block.piece, block.begin, block.length).encode())
+            self.pipeline.on_request_sent(block.piece, block.begin, block.length)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('[{}] Requesting {} blocks'.format(self, len(requests)))
+        writer.write(b''.join(requests))
+        return True
+
+    def request_when_buffer_available(self, writer):
+        """
+        The memory budget is used up. Requests resume once a piece buffer
+        is released rather than on the next message, there may be none.
+        """
+        if self.buffer_waiter is not None and not self.buffer_waiter.done():
             return
-        blocks_generator = self.get_blocks_generator()
-        block  = next(blocks_generator)
 
-
-        LOG.info('[{}] Request Block: {}'.format(self, block))
-        msg = struct.pack('>IbIII', 13, 6, block.piece, block.begin, block.length)
-        writer.write(msg)
-        self.inflight_requests += 1
-        await writer.drain()
+        async def wait_and_request():
+            await self.torrent_session.buffer_pool.wait_available()
+            # Another peer or torrent may get the buffer first, a new
+            # waiter is needed then
+            self.buffer_waiter = None
+            self.queue_requests(writer)
+        self.buffer_waiter = asyncio.ensure_future(wait_and_request())
+
+    def wake_requests(self):
+        """
+        Tops up the pipeline outside of the message loop, e.g. when blocks
+        another peer was asked for have become available. Runs on the next
+        loop iteration so callers can finish their own bookkeeping first.
+        """
+        if self.wake_pending or self.writer is None or self.peer_choking:
+            return
+        self.wake_pending = True
+
+        def wake(writer=self.writer):
+            self.wake_pending = False
+            if writer is self.writer:
+                self.queue_requests(writer)
+        asyncio.get_event_loop().call_soon(wake)
+
+    def cancel_request(self, index : int, begin : int, length : int):
+        """
+        The block came in from another peer
+        """
+        self.pipeline.cancel(index, begin)
+        self.send(Cancel(index, begin, length))
+
+    def extended_handshake(self) -> Extended:
+        metadata = self.torrent_session.torrent.info_bytes
+        extensions = {UT_METADATA: UT_METADATA_ID}
+        fields = {'metadata_size': len(metadata)}
+        pex = self.torrent_session.pex
+        if pex is not None:
+            extensions[UT_PEX] = UT_PEX_ID
+            if pex.listen_port:
+                fields['p'] = pex.listen_port
+        return encode_extended_handshake(extensions, **fields)
+
+    @property
+    def stats(self) -> dict:
+        return self.pipeline.stats()
 
     async def download(self):
         retries = 0
@@ -71,147 +206,207 @@ class Peer(object):
                 await self._download()
             except asyncio.TimeoutError:
                 LOG.warning('Timed out connecting with: {}'.format(self.host))
+            except ProtocolError as e:
+                LOG.warning('[{}] Protocol error: {}'.format(self, e))
+                return
 
     async def _download(self):
         try:
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(self.host, self.port),
-                timeout=10
-            )
+            reader, writer = await self.connect()
         except ConnectionError:
             LOG.error('Failed to connect to Peer {}'.format(self))
             return
+        except asyncio.IncompleteReadError:
+            LOG.info('{} Closed the connection during handshake'.format(self))
+            return
 
-        LOG.info('{} Sending handshake'.format(self))
-        writer.write(self.handshake())
-        await writer.drain()
-
-        # TODO: Validate handshake
-        handshake = await reader.read(68)  # Suspends here if there's nothing to be read
+        try:
+            await self.run(reader, writer)
+        finally:
+            writer.close()
+
+    async def connect(self, timeout : float = 10):
+        """
+        Opens the connection and exchanges handshakes, the connection is
+        closed again if anything goes wrong
+        """
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port),
+            timeout=timeout
+        )
+        try:
+            LOG.info('{} Sending handshake'.format(self))
+            writer.write(self.handshake())
+            await writer.drain()
+
+            handshake = await asyncio.wait_for(
+                reader.readexactly(HANDSHAKE_LENGTH), timeout=timeout)
+            reserved, info_hash, _ = decode_handshake(handshake)
+            if info_hash != self.torrent_session.torrent.info_hash:
+                raise ProtocolError('Peer is serving another torrent')
+            self.supports_extensions = supports_extensions(reserved)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def accept(self, reader, writer):
+        """
+        Takes over an incoming connection whose handshake has been read
+        and checked by the PeerServer
+        """
+        self.listen_port = None
+        self.outgoing = False
+        try:
+            writer.write(self.handshake())
+            await self.run(reader, writer)
+        finally:
+            writer.close()
+
+    async def run(self, reader, writer):
+        """
+        Exchanges messages with the peer until the connection closes
+        """
+        # Measurements from an earlier connection don't carry over
+        self.pipeline = RequestPipeline()
+        self.peer_choking = True
+        self.writer = writer
+        self.am_choking = True
+        self.peer_interested = False
+        self.extensions = {}
+        self.pex_advertised = set()
+        self.pex_received_at = None
+        self.download_limit.set_rate(self.torrent_session.peer_download_rate)
+        self.upload_limit.set_rate(self.torrent_session.peer_upload_rate)
+        self.torrent_session.on_peer_connected(self)
+        address = '{}:{}'.format(self.host, self.port)
+        PEER_DOWNLOADED.track(self, _downloaded, address)
+        PEER_UPLOADED.track(self, _uploaded, address)
+        try:
+            if self.supports_extensions:
+                writer.write(self.extended_handshake().encode())
+            bitfield = self.torrent_session.get_bitfield()
+            if bitfield is not None:
+                writer.write(Bitfield(bitfield).encode())
+            await self.send_interested(writer)
+
+            parser = MessageParser()
+            while True:
+                resp = await reader.read(REQUEST_SIZE)  # Suspends here if there's nothing to be read
+                if not resp:
+                    return
+                BYTES_RECEIVED.inc(len(resp))
+                # Not reading while over the limit lets the socket buffers
+                # fill up and TCP slow the peer down
+                if self.download_limit.consume(len(resp)):
+                    await self.download_limit.wait()
+
+                parser.feed(resp)
+                for message in parser:
+                    message_type = type(message)
+                    handler = self._handlers.get(message_type)
+                    if handler is None:
+                        LOG.info('[{}] Unhandled message {}'.format(self, message))
+                        continue
+                    self._received[message_type].inc()
+                    if LOG.isEnabledFor(logging.DEBUG):
+                        LOG.debug('[{}] Received {}'.format(self, message))
+                    await handler(self, message, writer)
+
+                await self.request_pieces(writer)
+        finally:
+            PEER_DOWNLOADED.untrack(self)
+            PEER_UPLOADED.untrack(self)
+            self.writer = None
+            if self.upload_task is not None:
+                self.upload_task.cancel()
+            self.torrent_session.on_peer_disconnected(self)
+            self.have_pieces = bitstring.BitArray(
+                bin='0' * self.torrent_session.number_of_pieces
+            )
 
+    async def on_keep_alive(self, message : KeepAlive, writer):
+        pass
+
+    async def on_choke(self, message : Choke, writer):
+        self.peer_choking = True
+        # A choking peer discards our outstanding requests, someone else
+        # can have them
+        self.torrent_session.on_requests_cancelled(self, self.pipeline.clear())
+
+    async def on_unchoke(self, message : Unchoke, writer):
+        self.peer_choking = False
+
+    async def on_interested(self, message : Interested, writer):
+        self.torrent_session.on_peer_interested(self)
+
+    async def on_not_interested(self, message : NotInterested, writer):
+        self.torrent_session.on_peer_not_interested(self)
+
+    async def on_have(self, message : Have, writer):
+        if message.index >= len(self.have_pieces):
+            raise ProtocolError('Have for unknown piece {}'.format(message.index))
+        if not self.have_pieces[message.index]:
+            self.have_pieces[message.index] = True
+            self.torrent_session.on_peer_have(message.index)
+
+    async def on_bitfield(self, message : Bitfield, writer):
+        if len(message.bitfield) * 8 < self.torrent_session.number_of_pieces:
+            raise ProtocolError('Bitfield is too short')
+        self.torrent_session.forget_peer_pieces(self.have_pieces)
+        self.have_pieces = bitstring.BitArray(bytes(message.bitfield))
+        self.torrent_session.on_peer_bitfield(self.have_pieces)
         await self.send_interested(writer)
 
-        # TODO: use async iterator
-        buf = b''
-        while True:
-            resp = await reader.read(REQUEST_SIZE)  # Suspends here if there's nothing to be read
-            # LOG.info('{} Read from peer: {}'.format(self, resp[:8]))
-
-            buf += resp
-
-            #LOG.info('Buffer len({}) is {}'.format(len(buf), buf[:8]))
-
-            if not buf and not resp:
-                return
-
-            while True:
-                if len(buf) < 4:
-                    # LOG.info('Buffer is too short')
-                    break
-
-                length = struct.unpack('>I', buf[0:4])[0]
-
-                if not len(buf) >= length:
-                    break
-
-                def consume(buf):
-                    buf = buf[4 + length:]
-                    return buf
-
-                def get_data(buf):
-                    return buf[:4 + length]
-
-
-                if length == 0:
-                    LOG.info('[Message] Keep Alive')
-                    buf = consume(buf)
-                    data = get_data(buf)
-                    LOG.info('[DATA]', data)
-                    continue
-
-                if len(buf) < 5:
-                    LOG.info('Buffer is less than 5... breaking')
-                    break
-
-                msg_id = struct.unpack('>b', buf[4:5])[0] # 5th byte is the ID
-
-                if msg_id == 0:
-                    LOG.info('[Message] CHOKE')
-                    data = get_data(buf)
-                    buf = consume(buf)
-                    LOG.info('[DATA]', data)
-
-                elif msg_id == 1:
-                    data = get_data(buf)
-                    buf = consume(buf)
-                    LOG.info('[Message] UNCHOKE')
-                    self.peer_choke = False
-
-                elif msg_id == 2:
-                    data = get_data(buf)
-                    buf = consume(buf)
-                    LOG.info('[Message] Interested')
-                    pass
-
-                elif msg_id == 3:
-                    data = get_data(buf)
-                    buf = consume(buf)
-                    LOG.info('[Message] Not Interested')
-                    pass
-
-                elif msg_id == 4:
-                    buf = buf[5:]
-                    data = get_data(buf)
-                    buf = consume(buf)
-                    LOG.info('[Message] Have')
-                    pass
-
-                elif msg_id == 5:
-                    bitfield = buf[5: 5 + length - 1]
-                    self.have_pieces = bitstring.BitArray(bitfield)
-                    LOG.info('[Message] Bitfield: {}'.format(bitfield))
-
-                    # buf = buf[5 + length - 1:]
-                    buf = buf[4 + length:]
-                    await self.send_interested(writer)
-
-                elif msg_id == 7:
-                    self.inflight_requests -= 1
-                    data = get_data(buf)
-                    buf = consume(buf)
-
-                    l = struct.unpack('>I', data[:4])[0]
-                    try:
-                        parts = struct.unpack(
-                            '>IbII' + str(l - 9) + 's',
-                            data[:length + 4])
-                        piece_idx, begin, data = parts[2], parts[3], parts[4]
-                        self.torrent_session.on_block_received(piece_idx, begin, data)
-                        # LOG.info('Got piece idx {} begin {}'.format(piece, begin))
-                    except struct.error:
-                        LOG.info('error decoding piece')
-                        return None
-
-                    # piece_index = buf[5]
-                    # piece_begin = buf[6]
-                    # block = buf[13: 13 + length]
-                    # # buf = buf[13 + length:]
-                    # buf = buf[4 + length:]
-                    # LOG.info('Buffer is reduced to {}'.format(buf))
-                    # LOG.info('Got piece idx {} begin {}'.format(piece_index, piece_begin))
-                    # LOG.info('Block has len {}'.format(len(block)))
-                    # LOG.info('Got this piece: {}'.format(block))
-
-                    # TODO: delegate to torrent session
-                    # with open(self.torrent_session.torrent.info[b'info'][b'name'].decode(), 'wb') as f:
-                    #     f.write(block)
-                    # continue
-                else:
-                    LOG.info('unknown ID {}'.format(msg_id))
-                    if msg_id == 159:
-                        exit(1)
-
-                await self.request_a_piece(writer)
+    async def on_piece(self, message : PieceMessage, writer):
+        self.pipeline.on_block_received(
+            message.index, message.begin, len(message.block))
+        self.torrent_session.on_block_received(
+            message.index, message.begin, message.block, self)
+
+    async def on_request(self, message : Request, writer):
+        self.torrent_session.on_peer_request(self, message)
+
+    async def on_cancel(self, message : Cancel, writer):
+        self.torrent_session.on_peer_cancel(self, message)
+
+    async def on_extended(self, message : Extended, writer):
+        if message.ext_id == EXTENDED_HANDSHAKE_ID:
+            handshake = decode_extended_handshake(message.data)
+            self.extensions = handshake[b'm']
+            port = handshake.get(b'p')
+            if not self.outgoing and isinstance(port, int) and 0 < port < 65536:
+                self.listen_port = port
+            LOG.info('[{}] Extensions: {}'.format(self, self.extensions))
+        elif message.ext_id == UT_PEX_ID:
+            self.torrent_session.on_peer_exchange(self, message.data)
+        elif message.ext_id == UT_METADATA_ID:
+            msg_type, piece, _ = decode_metadata_message(message.data)
+            remote_id = self.extensions.get(UT_METADATA)
+            if msg_type == METADATA_REQUEST and remote_id is not None:
+                writer.write(Extended(remote_id, metadata_reply(
+                    self.torrent_session.torrent.info_bytes, piece)).encode())
+        else:
+            LOG.info('[{}] Unknown extension message {}'.format(self, message.ext_id))
+
+    _handlers = {
+        KeepAlive: on_keep_alive,
+        Choke: on_choke,
+        Unchoke: on_unchoke,
+        Interested: on_interested,
+        NotInterested: on_not_interested,
+        Have: on_have,
+        Bitfield: on_bitfield,
+        PieceMessage: on_piece,
+        Request: on_request,
+        Cancel: on_cancel,
+        Extended: on_extended,
+    }
+    # Counts of each message type, looked up once
+    _received = {
+        message_type: MESSAGES_RECEIVED.labels(message_type.__name__)
+        for message_type in _handlers
+    }
 
     def __repr__(self):
         return '[Peer {}:{}]'.format(self.host, self.port)
@@ -0,0 +1,84 @@
+import socket
+import struct
+
+_COMPACT_IPV4 = struct.Struct('>4sH')
+_COMPACT_IPV6 = struct.Struct('>16sH')
+
+
+def decode_compact_peers(data : bytes) -> list:
+    """
+    (host, port) of every 6 byte record of a compact IPv4 peer list. A
+    truncated last record is ignored.
+    """
+    view = memoryview(data)
+    view = view[:len(view) - len(view) % _COMPACT_IPV4.size]
+    inet_ntoa = socket.inet_ntoa
+    return [(inet_ntoa(ip), port) for ip, port in _COMPACT_IPV4.iter_unpack(view)]
+
+
+def decode_compact_peers6(data : bytes) -> list:
+    """
+    (host, port) of every 18 byte record of a compact IPv6 peer list
+    (BEP 7)
+    """
+    view = memoryview(data)
+    view = view[:len(view) - len(view) % _COMPACT_IPV6.size]
+    inet_ntop = socket.inet_ntop
+    return [
+        (inet_ntop(socket.AF_INET6, ip), port)
+        for ip, port in _COMPACT_IPV6.iter_unpack(view)
+    ]
+
+
+def decode_peer_dicts(peers : list) -> list:
+    """
+    (host, port) of the non compact model, a list of dicts with 'ip' and
+    'port'. Malformed entries are skipped.
+    """
+    decoded = []
+    for peer in peers:
+        if not isinstance(peer, dict):
+            continue
+        ip, port = peer.get(b'ip'), peer.get(b'port')
+        if not isinstance(ip, bytes) or not isinstance(port, int):
+            continue
+        try:
+            decoded.append((ip.decode('ascii'), port))
+        except UnicodeDecodeError:
+            continue
+    return decoded
+
+
+def encode_compact_peers(peers) -> bytes:
+    """
+    Compact IPv4 peer list, IPv6 addresses are left out
+    """
+    records = []
+    for host, port in peers:
+        try:
+            records.append(_COMPACT_IPV4.pack(socket.inet_aton(host), port))
+        except OSError:
+            continue
+    return b''.join(records)
+
+
+def decode_peers(peers=b'', peers6=b'', exclude=frozenset()) -> list:
+    """
+    Unique (host, port) pairs from a response's `peers`, compact or not,
+    and `peers6`, in the order they were given. Addresses in `exclude`
+    and port 0 are dropped.
+    """
+    if isinstance(peers, (bytes, bytearray, memoryview)):
+        decoded = decode_compact_peers(peers)
+    elif isinstance(peers, list):
+        decoded = decode_peer_dicts(peers)
+    else:
+        decoded = []
+    if peers6:
+        decoded += decode_compact_peers6(peers6)
+
+    # dict keeps the first occurrence of each address, in order
+    unique = dict.fromkeys(decoded)
+    for address in exclude:
+        unique.pop(address, None)
+    return [address for address in unique if address[1]]
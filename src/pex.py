@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+import bencode
+from messages import Extended, ProtocolError
+from metrics import REGISTRY
+from peer_list import decode_peers, encode_compact_peers
+from ratelimit import TokenBucket
+from util import LOG, OWN_ADDRESSES
+
+UT_PEX = b'ut_pex'
+# The id we ask peers to send us ut_pex messages with
+UT_PEX_ID = 1
+# BEP 11: at most one message a minute per peer, with at most 50 added
+# and 50 dropped peers
+PEX_INTERVAL = 60
+MAX_PEX_PEERS = 50
+# Messages from a peer closer together than this are ignored
+MIN_RECEIVE_INTERVAL = 30
+# How many new candidates PEX may add to a torrent's pool, per minute
+PEX_PEERS_PER_MINUTE = 100
+
+# added.f flag: we connected to the peer, so it accepts connections
+FLAG_REACHABLE = 0x10
+
+PEX_PEERS_RECEIVED = REGISTRY.counter(
+    'battorrent_pex_peers_received_total',
+    'New candidate peers learned through peer exchange')
+
+
+def encode_pex_message(added, dropped=(), flags : bytes = None) -> bytes:
+    """
+    A ut_pex message, `flags` has the added.f byte of each added peer.
+    IPv6 peers are left out, like in our compact peer lists.
+    """
+    records = [
+        (encode_compact_peers([address]), flag)
+        for address, flag in zip(added, flags or bytes(len(added)))
+    ]
+    records = [(record, flag) for record, flag in records if record]
+    return bencode.encode({
+        b'added': b''.join(record for record, _ in records),
+        b'added.f': bytes(flag for _, flag in records),
+        b'dropped': encode_compact_peers(dropped),
+    })
+
+
+def decode_pex_message(data) -> tuple:
+    """
+    Returns the (added, dropped) (host, port) pairs of a ut_pex message
+    """
+    try:
+        message = bencode.decode(data)
+    except bencode.BencodeError as e:
+        raise ProtocolError('Malformed ut_pex message: {}'.format(e))
+    if not isinstance(message, dict):
+        raise ProtocolError('ut_pex message is not a dict')
+    added = decode_peers(message.get(b'added', b''), message.get(b'added6', b''))
+    dropped = decode_peers(message.get(b'dropped', b''), message.get(b'dropped6', b''))
+    return added, dropped
+
+
+class PeerExchange(object):
+    """
+    Peer exchange (BEP 11) for a torrent, over the extension protocol.
+
+    Every `interval` seconds each connected peer that supports ut_pex is
+    told which peers we connected to or lost since the last message it
+    got, by their listen addresses. Peers it tells us about go into the
+    ConnectionManager's pool unless they're already there, at most
+    `peers_per_minute` of them, so a peer can't flood the pool.
+    """
+
+    def __init__(
+            self, session, connections, listen_port : int = None,
+            interval : float = PEX_INTERVAL,
+            peers_per_minute : int = PEX_PEERS_PER_MINUTE,
+            own_addresses=OWN_ADDRESSES, clock=time.monotonic):
+        self.session = session
+        self.connections = connections
+        self.listen_port = listen_port
+        # Peers may hand us back to ourselves
+        self.own_peers = frozenset((host, listen_port) for host in own_addresses)
+        self.interval = interval
+        self.clock = clock
+        self.limit = TokenBucket(peers_per_minute / 60, peers_per_minute, clock=clock)
+
+    def connected_peers(self) -> dict:
+        """
+        (host, listen port) -> added.f flags of the peers we're connected
+        to whose listen port we know
+        """
+        return {
+            (peer.host, peer.listen_port): FLAG_REACHABLE if peer.outgoing else 0
+            for peer in self.session.peers if peer.listen_port
+        }
+
+    def send_updates(self):
+        connected = self.connected_peers()
+        for peer in list(self.session.peers):
+            remote_id = peer.extensions.get(UT_PEX)
+            if remote_id is None:
+                continue
+            current = set(connected)
+            current.discard((peer.host, peer.listen_port))
+            added = list(current - peer.pex_advertised)[:MAX_PEX_PEERS]
+            dropped = list(peer.pex_advertised - current)[:MAX_PEX_PEERS]
+            if not added and not dropped:
+                continue
+            peer.pex_advertised.difference_update(dropped)
+            peer.pex_advertised.update(added)
+            flags = bytes(connected[address] for address in added)
+            peer.send(Extended(remote_id, encode_pex_message(added, dropped, flags)))
+
+    def on_message(self, peer, data):
+        added, _ = decode_pex_message(data)
+        now = self.clock()
+        if (peer.pex_received_at is not None and
+                now - peer.pex_received_at < MIN_RECEIVE_INTERVAL):
+            LOG.info('[{}] Ignoring ut_pex message, too soon'.format(peer))
+            return
+        peer.pex_received_at = now
+        known = self.connections.candidates.keys() | self.connected_peers().keys()
+        new = [
+            address for address in added[:MAX_PEX_PEERS]
+            if address not in known and address not in self.own_peers
+        ]
+        if not new or self.limit.delay():
+            return
+        self.limit.consume(len(new))
+        PEX_PEERS_RECEIVED.inc(self.connections.add_peers(new))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.send_updates()
@@ -0,0 +1,358 @@
+import heapq
+import random
+from array import array
+
+RAREST_FIRST = 'rarest-first'
+SEQUENTIAL = 'sequential'
+RANDOM_FIRST = 'random-first'
+
+POLICIES = (RAREST_FIRST, SEQUENTIAL, RANDOM_FIRST)
+
+# Piece priorities, higher ones are picked first. Skipped pieces are
+# never picked.
+SKIP = 0
+LOW = 1
+NORMAL = 4
+HIGH = 7
+
+PRIORITIES = {'skip': SKIP, 'low': LOW, 'normal': NORMAL, 'high': HIGH}
+
+
+class NoPieceAvailable(Exception):
+    pass
+
+
+class PiecePicker(object):
+    """
+    Decides which piece to request next.
+
+    Keeps a count of how many connected peers have each piece, fed by
+    BITFIELD and HAVE messages. Pieces that can still be picked are kept
+    in one bitmask per availability count (a bucket), a Python int with
+    piece 0 in the highest bit like in a BITFIELD. A rarest-first pick
+    ANDs the peer's pieces with each bucket from the lowest up and takes
+    the lowest index of the first non-empty result, so pieces the peer
+    lacks cost nothing to skip. Those are word operations done in C, a
+    pick or update costs O(n / 64) however the pieces are spread out, and
+    a whole BITFIELD shifts every bucket at once.
+
+    Every piece has a priority, and each priority has buckets of its own
+    which are emptied before those of any lower priority. Pieces of
+    priority SKIP are not wanted at all: they're never picked and don't
+    count towards `len()`.
+
+    Pieces can be given a deadline, for streaming. Those are picked before
+    any other, earliest deadline first, from a heap of (deadline, index)
+    whose stale entries are dropped lazily.
+
+    Policies:
+        rarest-first    lowest availability first
+        sequential      lowest index first, in a single bucket per
+                        priority
+        random-first    random pieces of the highest priority until
+                        `random_first_pieces` are done, so we quickly
+                        have something to trade, then rarest-first
+    """
+
+    def __init__(
+            self, number_of_pieces : int, policy : str = RAREST_FIRST,
+            random_first_pieces : int = 4):
+        if policy not in POLICIES:
+            raise ValueError('Unknown piece picking policy: {}'.format(policy))
+        self.number_of_pieces = number_of_pieces
+        self.policy = policy
+        self.random_first_pieces = random_first_pieces
+
+        self.availability = array('I', bytes(4 * number_of_pieces))
+        self.priorities = bytearray([NORMAL]) * number_of_pieces
+        self.completed = 0
+        # Pieces that are wanted and not done
+        self._wanted = number_of_pieces
+
+        # 1 while a piece is wanted and neither in progress nor done, and
+        # so has its bit set in exactly one bucket
+        self._pickable = bytearray(b'\x01' * number_of_pieces)
+        self._in_progress = bytearray(number_of_pieces)
+        self._done = bytearray(number_of_pieces)
+
+        # Bitmasks are as wide as a BITFIELD, spare bits are never set
+        self._bitfield_length = (number_of_pieces + 7) // 8
+        self._width = 8 * self._bitfield_length
+        # priority -> bucket per availability
+        everything = ((1 << number_of_pieces) - 1) << (self._width - number_of_pieces)
+        self._buckets : dict = {NORMAL: [everything]}
+
+        # Time critical pieces, index -> deadline
+        self.deadlines : dict = {}
+        self._critical : list = []
+
+    def __len__(self):
+        """
+        Number of wanted pieces that aren't done yet
+        """
+        return self._wanted
+
+    def is_done(self, index : int) -> bool:
+        return bool(self._done[index])
+
+    def add_peer(self, have_pieces):
+        """
+        Counts the pieces of a peer that just sent its BITFIELD
+        """
+        for index in self._indices(have_pieces):
+            self.availability[index] += 1
+        if self.policy == SEQUENTIAL:
+            return
+        # Its pieces go up a bucket
+        have = self._mask(have_pieces)
+        for buckets in self._buckets.values():
+            moved = 0
+            for level, bucket in enumerate(buckets):
+                buckets[level] = (bucket & ~have) | moved
+                moved = bucket & have
+            if moved:
+                buckets.append(moved)
+
+    def remove_peer(self, have_pieces):
+        """
+        Forgets the pieces of a disconnected peer
+        """
+        for index in self._indices(have_pieces):
+            if self.availability[index]:
+                self.availability[index] -= 1
+        if self.policy == SEQUENTIAL:
+            return
+        # Its pieces go down a bucket, those nobody else had stay in 0
+        have = self._mask(have_pieces)
+        for buckets in self._buckets.values():
+            for level in range(1, len(buckets)):
+                moved = buckets[level] & have
+                if moved:
+                    buckets[level] ^= moved
+                    buckets[level - 1] |= moved
+
+    def increment(self, index : int):
+        """
+        A peer announced it has piece 'index'
+        """
+        if index >= self.number_of_pieces:
+            return
+        self.availability[index] += 1
+        self._rebucket(index, self.availability[index] - 1)
+
+    def decrement(self, index : int):
+        if index >= self.number_of_pieces or not self.availability[index]:
+            return
+        self.availability[index] -= 1
+        self._rebucket(index, self.availability[index] + 1)
+
+    def pick(self, have_pieces) -> int:
+        """
+        Returns the index of a piece the peer has and we want, and marks
+        it as in progress. Raises NoPieceAvailable if there is none.
+        """
+        index = None
+        if self.deadlines:
+            index = self._pick_critical(have_pieces)
+        if index is None:
+            have = self._mask(have_pieces)
+            if (self.policy == RANDOM_FIRST and
+                    self.completed < self.random_first_pieces):
+                index = self._pick_random(have)
+            else:
+                index = self._pick_lowest(have)
+
+        if index is None:
+            raise NoPieceAvailable('Not eligible for valid pieces')
+        self._remove(index)
+        self._pickable[index] = 0
+        self._in_progress[index] = 1
+        return index
+
+    def release(self, index : int):
+        """
+        Makes an in progress piece pickable again, e.g. when its download
+        failed or its peer went away
+        """
+        if not self._in_progress[index]:
+            return
+        self._in_progress[index] = 0
+        if self.priorities[index] != SKIP:
+            self._make_pickable(index)
+
+    def mark_done(self, index : int):
+        if self._done[index]:
+            return
+        if self._pickable[index]:
+            self._remove(index)
+        self._done[index] = 1
+        self._pickable[index] = 0
+        self._in_progress[index] = 0
+        self.completed += 1
+        if self.priorities[index] != SKIP:
+            self._wanted -= 1
+        self.deadlines.pop(index, None)
+
+    def mark_undone(self, index : int):
+        """
+        A done piece is needed again, e.g. because writing it failed
+        """
+        if not self._done[index]:
+            return
+        self._done[index] = 0
+        self.completed -= 1
+        if self.priorities[index] != SKIP:
+            self._wanted += 1
+            self._make_pickable(index)
+
+    def set_priority(self, index : int, priority : int):
+        """
+        Changes the priority of a piece. A piece in progress that becomes
+        skipped stays in progress until it's released or done.
+        """
+        old = self.priorities[index]
+        if priority == old:
+            return
+        if self._pickable[index]:
+            self._remove(index)
+        self.priorities[index] = priority
+        if self._done[index]:
+            return
+        if priority == SKIP:
+            self._wanted -= 1
+            self._pickable[index] = 0
+        elif old == SKIP:
+            self._wanted += 1
+            if not self._in_progress[index]:
+                self._make_pickable(index)
+        elif self._pickable[index]:
+            self._add(index)
+
+    def set_priorities(self, priorities):
+        """
+        Sets the priority of every piece
+        """
+        for index, priority in enumerate(priorities):
+            self.set_priority(index, priority)
+
+    def set_deadline(self, index : int, deadline : float = None):
+        """
+        Makes a piece time critical, or a normal piece again with None
+        """
+        if deadline is None:
+            self.deadlines.pop(index, None)
+            return
+        if self._done[index] or self.deadlines.get(index) == deadline:
+            return
+        self.deadlines[index] = deadline
+        heapq.heappush(self._critical, (deadline, index))
+        if len(self._critical) > 2 * len(self.deadlines) + 64:
+            self._critical = [
+                (deadline, index) for index, deadline in self.deadlines.items()
+                if self._pickable[index]
+            ]
+            heapq.heapify(self._critical)
+
+    def _indices(self, have_pieces):
+        """
+        Indices of the set bits of a BitArray, ignoring spare bits past
+        the last piece
+        """
+        number_of_pieces = self.number_of_pieces
+        for byte_idx, byte in enumerate(have_pieces.tobytes()):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    index = byte_idx * 8 + bit
+                    if index >= number_of_pieces:
+                        return
+                    yield index
+
+    def _mask(self, have_pieces) -> int:
+        """
+        A peer's BitArray as a bitmask like the buckets
+        """
+        data = have_pieces.tobytes()
+        if len(data) != self._bitfield_length:
+            data = data[:self._bitfield_length].ljust(self._bitfield_length, b'\0')
+        return int.from_bytes(data, 'big')
+
+    def _bit(self, index : int) -> int:
+        return 1 << (self._width - 1 - index)
+
+    def _level(self, index : int) -> int:
+        return 0 if self.policy == SEQUENTIAL else self.availability[index]
+
+    def _add(self, index : int):
+        """
+        Sets a pickable piece's bit in the bucket of its priority and
+        availability
+        """
+        buckets = self._buckets.setdefault(self.priorities[index], [])
+        level = self._level(index)
+        while len(buckets) <= level:
+            buckets.append(0)
+        buckets[level] |= self._bit(index)
+
+    def _remove(self, index : int):
+        self._buckets[self.priorities[index]][self._level(index)] ^= self._bit(index)
+
+    def _make_pickable(self, index : int):
+        self._pickable[index] = 1
+        self._add(index)
+        if index in self.deadlines:
+            heapq.heappush(self._critical, (self.deadlines[index], index))
+
+    def _rebucket(self, index : int, old_level : int):
+        if self.policy == SEQUENTIAL or not self._pickable[index]:
+            return
+        self._buckets[self.priorities[index]][old_level] ^= self._bit(index)
+        self._add(index)
+
+    def _pick_lowest(self, have : int):
+        """
+        The lowest piece the peer has of the first non-empty bucket of
+        the highest priority
+        """
+        for priority in sorted(self._buckets, reverse=True):
+            for bucket in self._buckets[priority]:
+                found = bucket & have
+                if found:
+                    return self._width - found.bit_length()
+        return None
+
+    def _pick_critical(self, have_pieces):
+        """
+        The critical piece with the earliest deadline that the peer has
+        """
+        skipped = []
+        found = None
+        critical = self._critical
+        while critical:
+            deadline, index = heapq.heappop(critical)
+            if not self._pickable[index] or self.deadlines.get(index) != deadline:
+                continue
+            if have_pieces[index]:
+                found = index
+                break
+            skipped.append((deadline, index))
+        for entry in skipped:
+            heapq.heappush(critical, entry)
+        return found
+
+    def _pick_random(self, have : int):
+        """
+        A random piece the peer has, of the highest priority it has any
+        of: the first one from a random index on, wrapping around
+        """
+        for priority in sorted(self._buckets, reverse=True):
+            candidates = 0
+            for bucket in self._buckets[priority]:
+                candidates |= bucket & have
+            if not candidates:
+                continue
+            start = random.randrange(self.number_of_pieces)
+            after = candidates & ((1 << (self._width - start)) - 1)
+            return self._width - (after or candidates).bit_length()
+        return None
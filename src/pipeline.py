@@ -0,0 +1,188 @@
+import math
+import time
+
+from util import REQUEST_SIZE
+
+
+class RateMeter(object):
+    """
+    Exponentially decaying transfer rate in bytes per second. Adding and
+    reading are O(1), which matters as it's updated for every block.
+
+    The average starts at zero, so during the first few time constants it
+    is divided by the weight it has accumulated so far. Without that a new
+    connection would look slow until it had been up for a while.
+    """
+
+    def __init__(self, time_constant : float = 5.0, clock=time.monotonic):
+        self.time_constant = time_constant
+        self.clock = clock
+        self.total = 0
+        self._rate = 0.0
+        self._start = self._last = clock()
+
+    def _decay(self, now : float):
+        elapsed = now - self._last
+        if elapsed > 0:
+            self._rate *= math.exp(-elapsed / self.time_constant)
+            self._last = now
+
+    def add(self, amount : int):
+        self._decay(self.clock())
+        self._rate += amount / self.time_constant
+        self.total += amount
+
+    @property
+    def rate(self) -> float:
+        now = self.clock()
+        self._decay(now)
+        weight = 1 - math.exp(-(now - self._start) / self.time_constant)
+        if weight <= 0:
+            return 0.0
+        return self._rate / weight
+
+
+class RequestPipeline(object):
+    """
+    Tracks the block requests outstanding with one peer and how many
+    there should be.
+
+    The queue depth follows the bandwidth-delay product of the connection:
+    `gain * download rate * min RTT / REQUEST_SIZE`. While requests are
+    not queueing up at the remote end the measured RTT stays close to the
+    minimum and the depth keeps growing with the rate, like TCP slow start.
+    Once the link is saturated the extra requests only add queueing delay,
+    the rate stops growing and the depth settles at about `gain` times the
+    actual bandwidth-delay product.
+
+    Every request gets a deadline from when it should arrive at the
+    current rate: the RTT plus the time to receive everything queued
+    ahead of it, times `slack`, kept between `min_deadline` and
+    `max_deadline`. Until the peer has sent anything `max_deadline` is
+    used.
+    """
+
+    def __init__(
+            self, min_depth : int = 2, max_depth : int = 250,
+            initial_depth : int = 4, gain : float = 2.0,
+            slack : float = 3.0, min_deadline : float = 2.0,
+            max_deadline : float = 30.0, clock=time.monotonic):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.gain = gain
+        self.slack = slack
+        self.min_deadline = min_deadline
+        self.max_deadline = max_deadline
+        self.clock = clock
+
+        self.depth = initial_depth
+        # (piece index, begin) -> (length, time sent, deadline)
+        self.inflight : dict = {}
+        self.inflight_bytes = 0
+        self.rtt : float = None
+        self.min_rtt : float = None
+        self.download_rate = RateMeter(clock=clock)
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def room(self) -> int:
+        """
+        Number of requests that can be sent right now
+        """
+        return max(0, self.depth - len(self.inflight))
+
+    def on_request_sent(self, index : int, begin : int, length : int):
+        now = self.clock()
+        self.inflight_bytes += length
+        rate = self.download_rate.rate
+        if rate and self.rtt is not None:
+            expected = self.rtt + self.inflight_bytes / rate
+            timeout = max(self.min_deadline, min(self.max_deadline, self.slack * expected))
+        else:
+            timeout = self.max_deadline
+        self.inflight[(index, begin)] = (length, now, now + timeout)
+
+    def _forget(self, index : int, begin : int):
+        request = self.inflight.pop((index, begin), None)
+        if request is not None:
+            self.inflight_bytes -= request[0]
+        return request
+
+    def on_block_received(self, index : int, begin : int, length : int) -> bool:
+        """
+        Returns False if the block was never requested (or was cancelled)
+        """
+        request = self._forget(index, begin)
+        self.download_rate.add(length)
+        if request is None:
+            return False
+
+        sample = self.clock() - request[1]
+        self.rtt = sample if self.rtt is None else 0.875 * self.rtt + 0.125 * sample
+        # Only ever decreases: in steady state every sample carries some
+        # queueing delay, so letting it creep up would let the depth (and
+        # with it the queueing) grow without bound
+        if self.min_rtt is None or sample < self.min_rtt:
+            self.min_rtt = sample
+        self._update_depth()
+        return True
+
+    def cancel(self, index : int, begin : int):
+        self._forget(index, begin)
+
+    def late(self) -> list:
+        """
+        (index, begin, length) of the requests past their deadline
+        """
+        now = self.clock()
+        return [
+            (index, begin, length)
+            for (index, begin), (length, _, deadline) in self.inflight.items()
+            if now > deadline
+        ]
+
+    def expired(self, timeout : float) -> list:
+        """
+        Forgets the requests that have been outstanding for longer than
+        'timeout' and returns their (index, begin, length)
+        """
+        deadline = self.clock() - timeout
+        requests = [
+            (index, begin, length)
+            for (index, begin), (length, sent, _) in self.inflight.items()
+            if sent < deadline
+        ]
+        for index, begin, _ in requests:
+            self._forget(index, begin)
+        return requests
+
+    def clear(self) -> list:
+        """
+        Forgets all outstanding requests, e.g. after a disconnect, and
+        returns their (index, begin, length)
+        """
+        requests = [
+            (index, begin, length)
+            for (index, begin), (length, _, _) in self.inflight.items()
+        ]
+        self.inflight.clear()
+        self.inflight_bytes = 0
+        return requests
+
+    def _update_depth(self):
+        bdp = self.download_rate.rate * self.min_rtt / REQUEST_SIZE
+        depth = math.ceil(self.gain * bdp)
+        # Double or halve at most per block so a single odd sample can't
+        # flood the peer with requests or drain the pipe
+        depth = max(self.depth // 2, min(depth, self.depth * 2))
+        self.depth = max(self.min_depth, min(self.max_depth, depth))
+
+    def stats(self) -> dict:
+        return {
+            'inflight': len(self.inflight),
+            'queue_depth': self.depth,
+            'rtt': self.rtt,
+            'min_rtt': self.min_rtt,
+            'download_rate': self.download_rate.rate,
+        }
@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+
+class TokenBucket(object):
+    """
+    Limits a transfer to `rate` bytes per second with bursts of up to
+    `burst` bytes, one second's worth by default. A rate of None or 0 is
+    unlimited.
+
+    Buckets form a hierarchy, e.g. global -> torrent -> peer: bytes taken
+    from a bucket are taken from all of its parents too, so a transfer
+    goes as fast as the tightest of them allows.
+
+    Taking never blocks and lets the buckets go into debt, `consume`
+    returns how long the caller should then wait. That keeps the common
+    case down to a little arithmetic per read or write, and a single
+    message larger than the burst still gets through. `wait` sleeps until
+    no bucket is in debt and starts over when a rate is changed, so
+    `set_rate` takes effect at once.
+    """
+
+    def __init__(
+            self, rate : float = None, burst : float = None,
+            parent : 'TokenBucket' = None, clock=time.monotonic):
+        self.parent = parent
+        self.clock = clock
+        self.rate = None
+        self.burst = 0.0
+        self.tokens = 0.0
+        self._last = clock()
+        self._waiters : set = set()
+        # This bucket and its ancestors, innermost first
+        self._chain : list = [self]
+        while parent is not None:
+            self._chain.append(parent)
+            parent = parent.parent
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate : float = None, burst : float = None):
+        """
+        Changes the limit, transfers waiting on this bucket recompute how
+        long they wait
+        """
+        now = self.clock()
+        if self.rate:
+            self._refill(now)
+        elif rate:
+            # Coming off unlimited, start with a full burst
+            self.tokens = burst or rate
+        self.rate = rate or None
+        self.burst = (burst or rate) if rate else 0.0
+        self.tokens = min(self.tokens, self.burst)
+        self._last = now
+
+        waiters, self._waiters = self._waiters, set()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _refill(self, now : float):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def consume(self, amount : int) -> float:
+        """
+        Takes 'amount' tokens from this bucket and its parents, returns the
+        seconds until none of them is in debt
+        """
+        now = self.clock()
+        delay = 0.0
+        for bucket in self._chain:
+            rate = bucket.rate
+            if rate is None:
+                continue
+            bucket._refill(now)
+            bucket.tokens -= amount
+            if bucket.tokens < 0 and -bucket.tokens / rate > delay:
+                delay = -bucket.tokens / rate
+        return delay
+
+    def delay(self) -> float:
+        """
+        Seconds until none of the chain is in debt
+        """
+        now = self.clock()
+        delay = 0.0
+        for bucket in self._chain:
+            if bucket.rate is None:
+                continue
+            bucket._refill(now)
+            if bucket.tokens < 0:
+                delay = max(delay, -bucket.tokens / bucket.rate)
+        return delay
+
+    async def wait(self):
+        """
+        Waits until no bucket of the chain is in debt
+        """
+        delay = self.delay()
+        loop = asyncio.get_event_loop()
+        while delay > 0:
+            waiter = loop.create_future()
+            for bucket in self._chain:
+                bucket._waiters.add(waiter)
+            timer = loop.call_later(delay, _wake, waiter)
+            try:
+                await waiter
+            finally:
+                timer.cancel()
+                for bucket in self._chain:
+                    bucket._waiters.discard(waiter)
+            delay = self.delay()
+
+    def __repr__(self):
+        return '<TokenBucket rate={} tokens={:.0f}>'.format(self.rate, self.tokens)
+
+
+def _wake(waiter : asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -0,0 +1,180 @@
+import asyncio
+import mmap
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bencode
+from hasher import sha1_digest
+from util import LOG
+
+RESUME_VERSION = 1
+
+
+class ResumeData(object):
+    """
+    Remembers which pieces are already on disk between runs.
+
+    The file holds the bitmap of pieces that have been written, plus the
+    size and mtime of every file taken right after. On load the bitmap is
+    trusted as is if no file has changed since. If sizes match but a file
+    was touched later (we crashed mid-download, or someone else wrote to
+    it) only the pieces the bitmap claims need to be rechecked. Anything
+    else means the resume data is useless.
+    """
+
+    def __init__(self, path : str, torrent, storage):
+        self.path = path
+        self.torrent = torrent
+        self.storage = storage
+
+    def load(self):
+        """
+        Returns (bitmap, needs_check), or None if there's no usable
+        resume data
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = bencode.decode(f.read())
+        except (OSError, bencode.BencodeError) as e:
+            LOG.info('No usable resume data in {}: {}'.format(self.path, e))
+            return None
+
+        pieces = data.get(b'pieces', b'')
+        files = data.get(b'files', [])
+        if (data.get(b'version') != RESUME_VERSION or
+                data.get(b'info-hash') != self.torrent.info_hash or
+                len(pieces) != self.torrent.number_of_pieces or
+                len(files) != len(self.storage.files)):
+            LOG.info('Resume data in {} is for a different torrent'.format(self.path))
+            return None
+
+        needs_check = False
+        for f, saved in zip(self.storage.files, files):
+            try:
+                st = os.stat(f.path)
+            except OSError:
+                if saved[b'size'] == -1:
+                    # Still not there, a skipped file
+                    continue
+                return None
+            if st.st_size != saved[b'size']:
+                return None
+            if st.st_mtime_ns != saved[b'mtime']:
+                needs_check = True
+        return bytearray(pieces), needs_check
+
+    def save(self, pieces : bytearray):
+        """
+        Writes the resume file atomically: a crash leaves either the old
+        or the new file, never a torn one
+        """
+        files = []
+        for f in self.storage.files:
+            try:
+                st = os.stat(f.path)
+                files.append({b'size': st.st_size, b'mtime': st.st_mtime_ns})
+            except OSError:
+                files.append({b'size': -1, b'mtime': 0})
+
+        data = bencode.encode({
+            b'version': RESUME_VERSION,
+            b'info-hash': self.torrent.info_hash,
+            b'pieces': bytes(pieces),
+            b'files': files,
+        })
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def run(self, file_saver, interval : float = 30):
+        """
+        Saves the pieces written by 'file_saver' every 'interval' seconds
+        while they keep changing
+        """
+        saved = None
+        while True:
+            await asyncio.sleep(interval)
+            pieces = bytes(file_saver.written_pieces)
+            if pieces == saved:
+                continue
+            await file_saver.run_in_executor(self.save, pieces)
+            saved = pieces
+
+
+def recheck(storage, torrent, pieces=None, workers : int = None) -> tuple:
+    """
+    Hashes the data already on disk and returns (bitmap of the valid
+    pieces, stats), checking only the pieces set in 'pieces' if given.
+
+    Files are mmap'd read only and pieces are hashed on a thread per core.
+    hashlib releases the GIL, so both the hashing and the page faults that
+    pull data off the disk run in parallel. Blocking, run it in an
+    executor.
+    """
+    workers = workers or os.cpu_count() or 1
+    number_of_pieces = torrent.number_of_pieces
+    valid = bytearray(number_of_pieces)
+    to_check = [
+        index for index in range(number_of_pieces)
+        if pieces is None or pieces[index]
+    ]
+
+    start = time.perf_counter()
+    maps = _map_files(storage)
+    checked_bytes = 0
+    try:
+        def check(index):
+            offset = index * torrent.piece_length
+            length = torrent.get_piece_length(index)
+            views = []
+            for f, file_offset, n in storage.map(offset, length):
+                mapped = maps.get(f.path)
+                if mapped is None or file_offset + n > len(mapped):
+                    return index, False
+                views.append(memoryview(mapped)[file_offset:file_offset + n])
+            try:
+                return index, sha1_digest(views) == torrent.get_piece_hash(index)
+            finally:
+                for view in views:
+                    view.release()
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='recheck') as executor:
+            # Bounded window of in flight pieces instead of one future per
+            # piece of the torrent
+            window = workers * 4
+            for i in range(0, len(to_check), window):
+                for index, is_valid in executor.map(check, to_check[i:i + window]):
+                    checked_bytes += torrent.get_piece_length(index)
+                    if is_valid:
+                        valid[index] = 1
+    finally:
+        for mapped in maps.values():
+            mapped.close()
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        'pieces': len(to_check),
+        'valid': sum(valid),
+        'bytes': checked_bytes,
+        'seconds': elapsed,
+        'throughput': checked_bytes / elapsed if elapsed else 0.0,
+    }
+    LOG.info('Rechecked {} pieces ({} valid) at {:.1f} MB/s'.format(
+        stats['pieces'], stats['valid'], stats['throughput'] / 2**20))
+    return valid, stats
+
+
+def _map_files(storage) -> dict:
+    maps = {}
+    for f in storage.files:
+        try:
+            with open(f.path, 'rb') as fp:
+                if os.fstat(fp.fileno()).st_size:
+                    maps[f.path] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            continue
+    return maps
@@ -0,0 +1,359 @@
+import asyncio
+import os
+import struct
+from collections import OrderedDict, deque
+
+from messages import (
+    Choke, HANDSHAKE_LENGTH, ProtocolError, Unchoke, decode_handshake,
+    supports_extensions
+)
+from metrics import REGISTRY
+from peer import Peer
+from util import LISTEN_PORT, LOG, MAX_REQUEST_SIZE
+
+_PIECE_HEADER = struct.Struct('>IBII')
+
+UPLOADED_BYTES = REGISTRY.counter(
+    'battorrent_uploaded_bytes_total', 'Block bytes sent to peers')
+
+
+class ReadCache(object):
+    """
+    LRU cache of whole pieces read back from disk for uploading. Peers
+    request the blocks of a piece one after the other, so reading the
+    piece once serves all of them. Concurrent misses on the same piece
+    share a single read.
+    """
+
+    def __init__(self, file_saver, max_bytes : int = 2**26):
+        self.file_saver = file_saver
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pieces : OrderedDict = OrderedDict()
+        self._loading : dict = {}
+
+    async def read(self, piece_idx : int, begin : int, length : int) -> memoryview:
+        piece = self._pieces.get(piece_idx)
+        if piece is not None:
+            self.hits += 1
+            self._pieces.move_to_end(piece_idx)
+        else:
+            self.misses += 1
+            piece = await self._load(piece_idx)
+        return memoryview(piece)[begin:begin + length]
+
+    async def _load(self, piece_idx : int) -> bytes:
+        loading = self._loading.get(piece_idx)
+        if loading is None:
+            torrent = self.file_saver.torrent
+            loading = self.file_saver.run_in_executor(
+                self.file_saver.storage.read,
+                piece_idx * torrent.piece_length,
+                torrent.get_piece_length(piece_idx)
+            )
+            self._loading[piece_idx] = loading
+            try:
+                piece = await loading
+            finally:
+                del self._loading[piece_idx]
+            self._insert(piece_idx, piece)
+            return piece
+        return await asyncio.shield(loading)
+
+    def _insert(self, piece_idx : int, piece : bytes):
+        if len(piece) > self.max_bytes:
+            return
+        self._pieces[piece_idx] = piece
+        self.size += len(piece)
+        while self.size > self.max_bytes:
+            _, evicted = self._pieces.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class UploadSlots(object):
+    """
+    Unchoke slots shared by the Uploaders of several torrents, caps how
+    many peers we upload to at once across all of them. A freed slot goes
+    round robin to a torrent with an interested peer waiting for one, on
+    the next loop iteration so a torrent that is rechoking its own peers
+    gets to keep it.
+    """
+
+    def __init__(self, max_slots : int):
+        self.max_slots = max_slots
+        self.used = 0
+        self.uploaders : deque = deque()
+        self._handover_pending = False
+
+    def take(self) -> bool:
+        if self.used >= self.max_slots:
+            return False
+        self.used += 1
+        return True
+
+    def give(self):
+        self.used -= 1
+        if not self._handover_pending and len(self.uploaders) > 1:
+            self._handover_pending = True
+            asyncio.get_event_loop().call_soon(self._hand_over)
+
+    def _hand_over(self):
+        self._handover_pending = False
+        for _ in range(len(self.uploaders)):
+            if self.used >= self.max_slots:
+                return
+            uploader = self.uploaders[0]
+            self.uploaders.rotate(-1)
+            uploader.fill_slot()
+
+
+class Uploader(object):
+    """
+    Serves REQUESTs from peers out of the ReadCache, or with os.sendfile
+    straight from the files when `use_sendfile` is set and the event loop
+    supports it (Python 3.7+). Blocks of files that aren't on disk, like
+    skipped ones, always come from the cache.
+
+    At most `max_upload_slots` interested peers are unchoked at a time.
+    Free slots go to peers as soon as they become interested, the Choker
+    then periodically reassigns them. With `slots` every unchoke also
+    takes one of the UploadSlots shared with other torrents.
+    """
+
+    def __init__(
+            self, file_saver, max_upload_slots : int = 4,
+            cache_size : int = 2**26, use_sendfile : bool = False,
+            slots : UploadSlots = None):
+        self.file_saver = file_saver
+        self.max_upload_slots = max_upload_slots
+        self.slots = slots
+        if slots is not None:
+            slots.uploaders.append(self)
+        self.cache = ReadCache(file_saver, cache_size)
+        self.use_sendfile = (
+            use_sendfile and hasattr(os, 'sendfile') and
+            hasattr(asyncio.AbstractEventLoop, 'sendfile'))
+        self.interested : set = set()
+        self.unchoked : set = set()
+        self.uploaded = 0
+        self._files : dict = {}
+
+    def on_interested(self, peer):
+        peer.peer_interested = True
+        self.interested.add(peer)
+        if len(self.unchoked) < self.max_upload_slots:
+            self.unchoke(peer)
+
+    def on_not_interested(self, peer):
+        peer.peer_interested = False
+        self.interested.discard(peer)
+        if peer in self.unchoked:
+            self.choke(peer)
+
+    def fill_slot(self):
+        """
+        Unchokes a waiting interested peer if there's room
+        """
+        if len(self.unchoked) >= self.max_upload_slots:
+            return
+        for peer in self.interested:
+            if peer not in self.unchoked:
+                self.unchoke(peer)
+                return
+
+    def on_peer_disconnected(self, peer):
+        self.interested.discard(peer)
+        self._release_slot(peer)
+        peer.upload_queue.clear()
+
+    def _release_slot(self, peer):
+        if peer in self.unchoked:
+            self.unchoked.discard(peer)
+            if self.slots is not None:
+                self.slots.give()
+
+    def choke(self, peer):
+        self._release_slot(peer)
+        if peer.am_choking:
+            return
+        peer.am_choking = True
+        # Choking discards all of the peer's pending requests
+        peer.upload_queue.clear()
+        peer.send(Choke())
+
+    def unchoke(self, peer):
+        if peer not in self.unchoked:
+            if self.slots is not None and not self.slots.take():
+                return
+            self.unchoked.add(peer)
+        if not peer.am_choking:
+            return
+        peer.am_choking = False
+        peer.send(Unchoke())
+
+    def on_request(self, peer, request):
+        if peer.am_choking:
+            return
+        session = peer.torrent_session
+        torrent = session.torrent
+        if (request.index >= session.number_of_pieces or
+                request.length > MAX_REQUEST_SIZE or
+                request.begin + request.length > torrent.get_piece_length(request.index)):
+            raise ProtocolError('Invalid request {}'.format(request))
+        if not session.has_piece(request.index):
+            LOG.info('[{}] Requested piece {} we don\'t have'.format(peer, request.index))
+            return
+
+        peer.upload_queue.append(request)
+        if peer.upload_task is None or peer.upload_task.done():
+            peer.upload_task = asyncio.ensure_future(self.serve(peer))
+
+    def on_cancel(self, peer, cancel):
+        for request in peer.upload_queue:
+            if (request.index, request.begin, request.length) == \
+                    (cancel.index, cancel.begin, cancel.length):
+                peer.upload_queue.remove(request)
+                return
+
+    async def serve(self, peer):
+        writer = peer.writer
+        try:
+            while peer.upload_queue and not peer.am_choking:
+                request = peer.upload_queue.popleft()
+                if peer.upload_limit.consume(request.length):
+                    await peer.upload_limit.wait()
+                    # Choking meanwhile discarded the request
+                    if peer.am_choking:
+                        break
+                header = _PIECE_HEADER.pack(
+                    9 + request.length, 7, request.index, request.begin)
+                parts = self._map(request)
+                if self.use_sendfile and all(f.fd is not None for f, _, _ in parts):
+                    writer.write(header)
+                    await self.sendfile(writer, parts)
+                else:
+                    block = await self.cache.read(
+                        request.index, request.begin, request.length)
+                    writer.write(header)
+                    writer.write(block)
+                    await writer.drain()
+                peer.upload_rate.add(request.length)
+                self.uploaded += request.length
+                UPLOADED_BYTES.inc(request.length)
+        except (ConnectionError, asyncio.CancelledError):
+            peer.upload_queue.clear()
+
+    def _map(self, request) -> list:
+        """
+        The (file, offset, length) parts of the files a request covers
+        """
+        offset = (
+            request.index * self.file_saver.torrent.piece_length +
+            request.begin
+        )
+        return self.file_saver.storage.map(offset, request.length)
+
+    async def sendfile(self, writer, parts : list):
+        """
+        Zero copy upload, the block goes from the page cache to the socket
+        without passing through Python
+        """
+        await writer.drain()
+        loop = asyncio.get_event_loop()
+        for f, file_offset, length in parts:
+            fileobj = self._files.get(f.path)
+            if fileobj is None:
+                fileobj = self._files[f.path] = open(f.path, 'rb')
+            await loop.sendfile(writer.transport, fileobj, file_offset, length)
+
+    def close(self):
+        if self.slots is not None and self in self.slots.uploaders:
+            self.slots.uploaders.remove(self)
+        for fileobj in self._files.values():
+            fileobj.close()
+        self._files.clear()
+
+    def stats(self) -> dict:
+        return {
+            'uploaded': self.uploaded,
+            'interested': len(self.interested),
+            'unchoked': len(self.unchoked),
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+        }
+
+
+class PeerServer(object):
+    """
+    Accepts incoming peer connections on the port we announce to the
+    tracker and hands them to the torrent whose info hash the handshake
+    asks for. Connections for other torrents are dropped after the
+    handshake, and so are all of a torrent's while its `connections` are
+    full. One server can serve every torrent of a Session.
+    """
+
+    def __init__(
+            self, session=None, host : str = '0.0.0.0', port : int = LISTEN_PORT,
+            handshake_timeout : float = 10, connections=None):
+        self.host = host
+        self.port = port
+        self.handshake_timeout = handshake_timeout
+        self.server = None
+        # info hash -> (DownloadSession, ConnectionManager or None)
+        self.torrents : dict = {}
+        if session is not None:
+            self.add_torrent(session, connections)
+
+    def add_torrent(self, session, connections=None):
+        self.torrents[session.torrent.info_hash] = (session, connections)
+
+    def remove_torrent(self, info_hash : bytes):
+        self.torrents.pop(info_hash, None)
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.on_connection, self.host, self.port)
+        sockets = self.server.sockets or []
+        if sockets:
+            self.port = sockets[0].getsockname()[1]
+        LOG.info('Listening for peers on {}:{}'.format(self.host, self.port))
+        return self
+
+    async def on_connection(self, reader, writer):
+        try:
+            data = await asyncio.wait_for(
+                reader.readexactly(HANDSHAKE_LENGTH), self.handshake_timeout)
+            reserved, info_hash, _ = decode_handshake(data)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError, ProtocolError) as e:
+            LOG.info('Dropping incoming connection: {}'.format(e))
+            writer.close()
+            return
+
+        torrent = self.torrents.get(info_hash)
+        if torrent is None:
+            LOG.info('Dropping incoming connection for unknown torrent')
+            writer.close()
+            return
+        session, connections = torrent
+
+        host, port = writer.get_extra_info('peername')[:2]
+        peer = Peer(session, host, port)
+        peer.supports_extensions = supports_extensions(reserved)
+        if connections is not None:
+            if not connections.accepting:
+                LOG.info('Too many connections, dropping {}'.format(peer))
+                writer.close()
+                return
+            await connections.accept(peer, reader, writer)
+            return
+        try:
+            await peer.accept(reader, writer)
+        except (ConnectionError, ProtocolError) as e:
+            LOG.info('[{}] Incoming connection closed: {}'.format(peer, e))
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
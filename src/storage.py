@@ -0,0 +1,228 @@
+import bisect
+import os
+import threading
+
+from util import LOG
+
+PREALLOCATE_SPARSE = 'sparse'
+PREALLOCATE_FULL = 'full'
+
+# Most systems cap the number of buffers in a single pwritev call at 1024
+IOV_MAX = 1024
+
+
+class StorageFile(object):
+    __slots__ = ('path', 'length', 'offset', 'fd', 'skipped')
+
+    def __init__(self, path : str, length : int, offset : int):
+        self.path = path
+        self.length = length
+        # Offset of the first byte of this file in the torrent
+        self.offset = offset
+        self.fd = None
+        # Not wanted, it's neither created nor allocated up front
+        self.skipped = False
+
+    def __repr__(self):
+        return '<StorageFile {} offset: {} length: {}>'.format(
+            self.path, self.offset, self.length)
+
+
+class Storage(object):
+    """
+    Maps the torrent's byte space onto its files.
+
+    The torrent is treated as one contiguous stream of bytes, a piece at
+    offset `index * piece length` may span several files. Files are
+    preallocated when opened (sparse by default, or fully with
+    posix_fallocate) and written with pwritev, so block buffers go to
+    disk without being joined first and without any seek state shared
+    between threads. All methods are blocking and meant to be run in an
+    executor, see FileSaver.
+
+    Skipped files are left alone by open(). If a piece that is wanted
+    spills over into one, the file is created when that piece is written,
+    sparse, and reads of a file that doesn't exist return zeros.
+    """
+
+    def __init__(
+            self, outdir : str, torrent, preallocate : str = PREALLOCATE_SPARSE,
+            skip_files=()):
+        self.preallocate = preallocate
+        self.files = self.get_files(outdir, torrent)
+        self.set_skipped(skip_files)
+        self.length = torrent.size
+        # Whether any file was on disk before we touched it, a previous
+        # download that could be resumed
+        self.has_existing_data = any(os.path.exists(f.path) for f in self.files)
+        self._offsets = [f.offset for f in self.files]
+        # Files opened lazily by concurrent writes
+        self._open_lock = threading.Lock()
+        self.closed = False
+
+    @staticmethod
+    def get_files(outdir : str, torrent) -> list:
+        files = []
+        offset = 0
+        for path, length in torrent.files:
+            if not path:
+                file_path = os.path.join(outdir, safe_path_component(torrent.name))
+            else:
+                file_path = os.path.join(
+                    outdir,
+                    safe_path_component(torrent.name),
+                    *[safe_path_component(p) for p in path]
+                )
+            files.append(StorageFile(file_path, length, offset))
+            offset += length
+        return files
+
+    def set_skipped(self, file_indices):
+        """
+        Skips the files at `file_indices` and no others. Only files that
+        aren't open yet are affected.
+        """
+        file_indices = set(file_indices)
+        for file_idx, f in enumerate(self.files):
+            f.skipped = file_idx in file_indices
+
+    def open(self):
+        self.closed = False
+        for f in self.files:
+            if f.fd is not None:
+                continue
+            exists = os.path.exists(f.path)
+            if f.skipped and not exists:
+                continue
+            if exists:
+                LOG.info('Previous download exists: {}'.format(f.path))
+            self._open_file(f)
+
+    def _open_file(self, f : StorageFile):
+        directory = os.path.dirname(f.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        f.fd = os.open(f.path, os.O_RDWR | os.O_CREAT)
+        if not f.skipped:
+            self._allocate(f)
+
+    def _fd_for_write(self, f : StorageFile) -> int:
+        if f.fd is None:
+            with self._open_lock:
+                if f.fd is None:
+                    self._open_file(f)
+        return f.fd
+
+    def _allocate(self, f : StorageFile):
+        if os.fstat(f.fd).st_size >= f.length or not f.length:
+            return
+        if self.preallocate == PREALLOCATE_FULL and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fd, 0, f.length)
+                return
+            except OSError as e:
+                LOG.warning('fallocate failed for {}: {}'.format(f.path, e))
+        # Sparse file, blocks are allocated as pieces are written
+        os.ftruncate(f.fd, f.length)
+
+    def close(self):
+        self.closed = True
+        for f in self.files:
+            if f.fd is not None:
+                os.close(f.fd)
+                f.fd = None
+
+    def map(self, offset : int, length : int) -> list:
+        """
+        Splits the torrent byte range [offset, offset + length) into
+        (StorageFile, file offset, length) parts
+        """
+        if offset < 0 or offset + length > self.length:
+            raise ValueError('Range {}+{} is outside of the torrent'.format(
+                offset, length))
+        parts = []
+        file_idx = bisect.bisect_right(self._offsets, offset) - 1
+        while length > 0:
+            f = self.files[file_idx]
+            file_offset = offset - f.offset
+            n = min(length, f.length - file_offset)
+            if n > 0:
+                parts.append((f, file_offset, n))
+                offset += n
+                length -= n
+            file_idx += 1
+        return parts
+
+    def write(self, offset : int, buffers : list):
+        """
+        Writes the concatenation of 'buffers' at torrent offset 'offset'
+        """
+        views = [memoryview(b).cast('B') for b in buffers]
+        total = sum(len(v) for v in views)
+        for f, file_offset, length in self.map(offset, total):
+            chunk, views = _split(views, length)
+            _pwritev_all(self._fd_for_write(f), chunk, file_offset)
+
+    def read(self, offset : int, length : int) -> bytes:
+        if self.closed:
+            raise ValueError('Read from closed storage')
+        parts = []
+        for f, file_offset, n in self.map(offset, length):
+            data = os.pread(f.fd, n, file_offset) if f.fd is not None else b''
+            if len(data) < n:
+                # Never written, sparse and skipped files read back as zeros
+                data += bytes(n - len(data))
+            parts.append(data)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+
+def safe_path_component(component : str) -> str:
+    """
+    Rejects torrent supplied path components that would escape the
+    download directory
+    """
+    if (not component or component in ('.', '..') or
+            '/' in component or os.sep in component or '\0' in component):
+        raise ValueError('Unsafe path component in torrent: {!r}'.format(component))
+    return component
+
+
+def _split(views : list, length : int):
+    """
+    Splits a list of memoryviews after 'length' bytes without copying
+    """
+    for i, view in enumerate(views):
+        if len(view) >= length:
+            if len(view) == length:
+                return views[:i + 1], views[i + 1:]
+            return views[:i] + [view[:length]], [view[length:]] + views[i + 1:]
+        length -= len(view)
+    return views, []
+
+
+def _pwritev_all(fd : int, views : list, offset : int):
+    if not hasattr(os, 'pwritev'):
+        for view in views:
+            _pwrite_all(fd, view, offset)
+            offset += len(view)
+        return
+
+    while views:
+        batch = views[:IOV_MAX]
+        expected = sum(len(v) for v in batch)
+        written = os.pwritev(fd, batch, offset)
+        if written < expected:
+            # Short write, finish this batch the slow way
+            _, rest = _split(batch, written)
+            for view in rest:
+                _pwrite_all(fd, view, offset + written)
+                written += len(view)
+        offset += expected
+        views = views[IOV_MAX:]
+
+
+def _pwrite_all(fd : int, view : memoryview, offset : int):
+    while len(view):
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
@@ -0,0 +1,262 @@
+import asyncio
+import binascii
+import mimetypes
+import re
+import time
+import urllib.parse as urlparse
+
+from metrics import REGISTRY
+from util import LOG
+
+STREAM_FIRST_BYTE = REGISTRY.histogram(
+    'battorrent_stream_first_byte_seconds',
+    'Time from a stream request to its first byte of content')
+# Largest write of a response, at most a piece
+STREAM_CHUNK_SIZE = 2**18
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_range(header : str, length : int):
+    """
+    (first, last) byte of a `Range: bytes=...` header, inclusive, or None
+    to send everything. Only the first of several ranges is served.
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.split(',')[0].strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # The last `last` bytes
+        first, last = max(0, length - int(last)), length - 1
+    else:
+        first = int(first)
+        last = min(int(last), length - 1) if last else length - 1
+    if first >= length or first > last:
+        raise RangeNotSatisfiable(header)
+    return first, last
+
+
+class PieceReader(object):
+    """
+    Reads a torrent's data while it downloads.
+
+    The pieces from the read position on, up to `window` of them, are made
+    time critical: the one being read is due now and each following one
+    `piece_interval` seconds later, so they're requested ahead of all
+    other pieces and in order. Reads wait for their pieces to be verified
+    and on disk, then go through the Uploader's ReadCache. With a window
+    of 0 reads just wait for the normal piece picking.
+    """
+
+    def __init__(
+            self, session, cache, window : int = 8,
+            piece_interval : float = 0.5, clock=time.monotonic):
+        self.session = session
+        self.cache = cache
+        self.window = window
+        self.piece_interval = piece_interval
+        self.clock = clock
+        # Pieces this reader gave deadlines, index -> deadline
+        self._deadlines : dict = {}
+
+    def seek(self, offset : int):
+        """
+        Moves the critical window to the piece at `offset`
+        """
+        session = self.session
+        first = offset // session.piece_size
+        last = min(first + self.window, session.number_of_pieces)
+        now = self.clock()
+        deadlines = {}
+        for piece_idx in range(first, last):
+            if not session.has_piece(piece_idx):
+                deadlines[piece_idx] = now + (piece_idx - first) * self.piece_interval
+        for piece_idx in self._deadlines.keys() - deadlines.keys():
+            self._clear(piece_idx)
+        for piece_idx, deadline in deadlines.items():
+            # A piece that's due sooner for another reader stays so
+            current = session.picker.deadlines.get(piece_idx)
+            mine = current == self._deadlines.get(piece_idx)
+            if current is None or mine or deadline < current:
+                session.set_piece_deadline(piece_idx, deadline)
+        self._deadlines = deadlines
+
+    def _clear(self, piece_idx : int):
+        if self.session.picker.deadlines.get(piece_idx) == self._deadlines.get(piece_idx):
+            self.session.set_piece_deadline(piece_idx, None)
+
+    async def read(self, offset : int, length : int) -> bytes:
+        """
+        `length` bytes of the torrent's data at `offset`
+        """
+        self.seek(offset)
+        piece_size = self.session.piece_size
+        chunks = []
+        end = offset + length
+        while offset < end:
+            piece_idx, begin = divmod(offset, piece_size)
+            size = min(end - offset, piece_size - begin)
+            await self.session.wait_for_piece(piece_idx)
+            chunks.append(await self.cache.read(piece_idx, begin, size))
+            offset += size
+        return b''.join(chunks)
+
+    def close(self):
+        for piece_idx in list(self._deadlines):
+            self._clear(piece_idx)
+        self._deadlines = {}
+
+
+class StreamServer(object):
+    """
+    Serves the files of running torrents over HTTP while they download,
+    at /<info hash in hex>/<file index>, optionally followed by /<name> so
+    players see a file extension. Range requests are answered as soon as
+    the pieces they start in are on disk, the rest streams as it arrives.
+
+    `torrents` maps info hashes to DownloadSessions, e.g. Session.torrents.
+    Every request gets its own PieceReader, so a seek moves the critical
+    window with it.
+    """
+
+    def __init__(
+            self, torrents : dict, host : str = '127.0.0.1', port : int = 0,
+            window : int = 8, piece_interval : float = 0.5,
+            timeout : float = 30):
+        self.torrents = torrents
+        self.host = host
+        self.port = port
+        self.window = window
+        self.piece_interval = piece_interval
+        self.timeout = timeout
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.on_connection, self.host, self.port)
+        sockets = self.server.sockets or []
+        if sockets:
+            self.port = sockets[0].getsockname()[1]
+        LOG.info('Streaming on http://{}:{}/'.format(self.host, self.port))
+        return self
+
+    def url(self, info_hash : bytes, file_index : int = 0) -> str:
+        return 'http://{}:{}/{}/{}'.format(
+            self.host, self.port, binascii.hexlify(info_hash).decode(), file_index)
+
+    def _find_file(self, path : str):
+        """
+        (DownloadSession, StorageFile) for a request path, None if there's
+        no such torrent or file
+        """
+        parts = urlparse.unquote(path).strip('/').split('/')
+        if len(parts) < 2 or not parts[1].isdigit():
+            return None
+        try:
+            session = self.torrents.get(binascii.unhexlify(parts[0]))
+        except (binascii.Error, ValueError):
+            return None
+        if session is None or session.uploader is None:
+            return None
+        files = session.uploader.file_saver.storage.files
+        file_index = int(parts[1])
+        if file_index >= len(files):
+            return None
+        return session, files[file_index]
+
+    async def on_connection(self, reader, writer):
+        started = time.monotonic()
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b'\r\n\r\n'), self.timeout)
+            lines = request.decode('latin-1').split('\r\n')
+            method, path = lines[0].split(' ')[:2]
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            await self.respond(writer, method, path, headers, started)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ConnectionError, ValueError) as e:
+            LOG.info('Stream request failed: {!r}'.format(e))
+        finally:
+            writer.close()
+
+    async def respond(self, writer, method : str, path : str, headers : dict, started : float):
+        if method not in ('GET', 'HEAD'):
+            self._send_head(writer, '405 Method Not Allowed', 0)
+            return
+        found = self._find_file(path.split('?', 1)[0])
+        if found is None:
+            self._send_head(writer, '404 Not Found', 0)
+            return
+        session, storage_file = found
+        try:
+            byte_range = parse_range(headers.get('range'), storage_file.length)
+        except RangeNotSatisfiable:
+            self._send_head(writer, '416 Range Not Satisfiable', 0, {
+                'Content-Range': 'bytes */{}'.format(storage_file.length)})
+            return
+
+        extra = {'Accept-Ranges': 'bytes'}
+        content_type = mimetypes.guess_type(storage_file.path)[0]
+        if byte_range is None:
+            status = '200 OK'
+            first, last = 0, storage_file.length - 1
+        else:
+            status = '206 Partial Content'
+            first, last = byte_range
+            extra['Content-Range'] = 'bytes {}-{}/{}'.format(
+                first, last, storage_file.length)
+        length = last - first + 1 if storage_file.length else 0
+        if method == 'HEAD' or not length:
+            self._send_head(writer, status, length, extra, content_type)
+            return
+
+        piece_reader = PieceReader(
+            session, session.uploader.cache, self.window, self.piece_interval)
+        try:
+            offset = storage_file.offset + first
+            end = offset + length
+            # The headers go out with the first data, so a client that
+            # times out waiting knows nothing was sent
+            head = True
+            while offset < end:
+                size = min(
+                    end - offset, STREAM_CHUNK_SIZE,
+                    session.piece_size - offset % session.piece_size)
+                data = await piece_reader.read(offset, size)
+                if head:
+                    self._send_head(writer, status, length, extra, content_type)
+                    head = False
+                    STREAM_FIRST_BYTE.observe(time.monotonic() - started)
+                writer.write(data)
+                await writer.drain()
+                offset += size
+        finally:
+            piece_reader.close()
+
+    @staticmethod
+    def _send_head(
+            writer, status : str, length : int, extra : dict = None,
+            content_type : str = None):
+        lines = ['HTTP/1.1 ' + status]
+        lines.append('Content-Type: ' + (content_type or 'application/octet-stream'))
+        lines.append('Content-Length: {}'.format(length))
+        lines.append('Connection: close')
+        for name, value in (extra or {}).items():
+            lines.append('{}: {}'.format(name, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
@@ -0,0 +1,55 @@
+import asyncio
+import hashlib
+
+import bencoder
+
+from torrent import Torrent
+
+
+def make_torrent(tmp_path, files, piece_length=8, name=b'pack', announce=b'http://t/'):
+    """
+    Writes a .torrent for 'files', a list of (path components, content).
+    A single (None, content) entry makes a single file torrent. Without
+    'announce' the torrent is trackerless.
+    """
+    data = b''.join(content for _, content in files)
+    info = {
+        b'name': name,
+        b'piece length': piece_length,
+        b'pieces': b''.join(
+            hashlib.sha1(data[i:i + piece_length]).digest()
+            for i in range(0, len(data), piece_length)
+        ),
+    }
+    if len(files) == 1 and files[0][0] is None:
+        info[b'length'] = len(data)
+    else:
+        info[b'files'] = [
+            {b'path': path, b'length': len(content)}
+            for path, content in files
+        ]
+    metainfo = {b'info': info}
+    if announce is not None:
+        metainfo[b'announce'] = announce
+    path = tmp_path / 'test.torrent'
+    path.write_bytes(bencoder.encode(metainfo))
+    return Torrent(str(path)), data
+
+
+class FakeClock(object):
+    """
+    A monotonic clock that only moves when `now` is changed
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
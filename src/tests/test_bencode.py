@@ -0,0 +1,71 @@
+import hashlib
+import random
+
+import bencoder
+import pytest
+
+import bencode
+from torrent import Torrent
+
+
+def random_value(depth=0):
+    kind = random.choice('ibld' if depth < 4 else 'ib')
+    if kind == 'i':
+        return random.randint(-2**70, 2**70)
+    if kind == 'b':
+        return bytes(random.getrandbits(8) for _ in range(random.randint(0, 20)))
+    if kind == 'l':
+        return [random_value(depth + 1) for _ in range(random.randint(0, 5))]
+    return {
+        bytes(random.getrandbits(8) for _ in range(random.randint(1, 8))): random_value(depth + 1)
+        for _ in range(random.randint(0, 5))
+    }
+
+
+def test_matches_bencoder():
+    random.seed(3)
+    for _ in range(200):
+        value = random_value()
+        encoded = bencoder.encode(value)
+        assert bencode.encode(value) == encoded
+        assert bencode.decode(encoded) == value
+
+
+def test_streaming_decode_in_any_chunks():
+    random.seed(4)
+    value = {b'peers': [random_value() for _ in range(50)], b'interval': 1800}
+    encoded = bencode.encode(value)
+    for chunk_size in (1, 7, 4096):
+        decoder = bencode.Decoder()
+        for i in range(0, len(encoded), chunk_size):
+            decoder.feed(encoded[i:i + chunk_size])
+        assert decoder.finish() == value
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'i12', b'l', b'd1:ae', b'i1x2e', b'x', b'i1ei2e', b'e', b'di1ei2ee', b'5:abc',
+])
+def test_invalid_data(data):
+    with pytest.raises(bencode.BencodeError):
+        bencode.decode(data)
+
+
+def test_info_hash_uses_the_original_bytes(tmp_path):
+    # Keys out of order, re-encoding would sort them and change the hash
+    info = b'd4:name1:a6:lengthi3e12:piece lengthi4e6:pieces20:' + bytes(20) + b'e'
+    assert bencode.encode(bencode.decode(info)) != info
+    path = tmp_path / 'odd.torrent'
+    path.write_bytes(b'd8:announce9:http://t/4:info' + info + b'e')
+
+    torrent = Torrent(str(path))
+    assert torrent.info_hash == hashlib.sha1(info).digest()
+    assert torrent.size == 3
+
+
+def test_large_strings_are_views():
+    pieces = bytes(range(200)) * 100
+    data = bencode.encode({b'name': b'x', b'pieces': pieces})
+    value = bencode.decode(data, lazy_threshold=1024)
+    assert isinstance(value[b'pieces'], memoryview)
+    assert isinstance(value[b'name'], bytes)
+    assert value[b'pieces'] == pieces
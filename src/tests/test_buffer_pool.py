@@ -0,0 +1,93 @@
+import asyncio
+
+import bitstring
+import pytest
+
+from buffer_pool import BufferPool, MemoryBudget, NoBufferAvailable
+from tests.helpers import make_torrent, run
+from torrio import DownloadSession
+
+
+def test_buffers_are_reused_within_budget():
+    pool = BufferPool(buffer_size=16, budget=40)
+    assert pool.capacity == 2
+
+    first = pool.try_acquire()
+    second = pool.try_acquire()
+    assert second is not None and second is not first
+    assert pool.try_acquire() is None
+    assert pool.stats()['stalls'] == 1
+    assert pool.stats()['occupancy'] == 1.0
+
+    pool.release(first)
+    assert pool.try_acquire() is first
+    assert pool.allocated == 2
+
+
+def test_waiters_wake_up_on_release():
+    pool = BufferPool(buffer_size=16, budget=16)
+
+    async def wait_for_release():
+        buf = pool.try_acquire()
+        waiter = asyncio.ensure_future(pool.wait_available())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        pool.release(buf)
+        await asyncio.wait_for(waiter, 1)
+        return pool.try_acquire()
+
+    assert run(wait_for_release()) is not None
+
+
+def test_pools_share_a_memory_budget():
+    shared = MemoryBudget(48)
+    small = BufferPool(buffer_size=16, budget=1000, shared=shared)
+    big = BufferPool(buffer_size=32, budget=1000, shared=shared)
+
+    first = small.try_acquire()
+    assert big.try_acquire() is not None
+    assert small.try_acquire() is None
+    # Nobody is waiting, the pool keeps the buffer for its next piece
+    small.release(first)
+    assert small.try_acquire() is first
+    assert shared.allocated == 48
+
+
+def test_released_buffer_goes_to_the_waiting_pool():
+    shared = MemoryBudget(32)
+    a = BufferPool(buffer_size=32, budget=1000, shared=shared)
+    b = BufferPool(buffer_size=32, budget=1000, shared=shared)
+
+    async def hand_over():
+        buf = a.try_acquire()
+        assert b.try_acquire() is None
+        waiting = asyncio.ensure_future(b.wait_available())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        a.release(buf)
+        await waiting
+        return b.try_acquire()
+
+    buf = run(hand_over())
+    assert buf is not None
+    assert a.allocated == 0
+    assert shared.allocated == 32
+    # Buffers still in use when the torrent stops go back when released
+    b.close()
+    assert shared.allocated == 32
+    b.release(buf)
+    assert shared.allocated == 0
+
+
+def test_session_stops_starting_pieces_when_budget_is_used(tmp_path):
+    torrent, data = make_torrent(tmp_path, [(None, b'x' * 64)], piece_length=16)
+    session = DownloadSession(torrent, memory_budget=32)
+    have = bitstring.BitArray(bin='1111')
+
+    session.get_piece_request(have)
+    session.get_piece_request(have)
+    with pytest.raises(NoBufferAvailable):
+        session.get_piece_request(have)
+
+    session.release_piece(session.pieces_in_progress[0])
+    assert session.get_piece_request(have).index == 0
@@ -0,0 +1,98 @@
+import random
+from collections import deque
+
+from choker import Choker
+from messages import Choke, Unchoke
+from seeder import Uploader
+from tests.helpers import FakeClock
+
+
+class FakeRate(object):
+    def __init__(self, rate):
+        self.rate = rate
+
+
+class FakePipeline(object):
+    def __init__(self, rate):
+        self.download_rate = FakeRate(rate)
+
+
+class FakePeer(object):
+    def __init__(self, name, download_rate=0.0, upload_rate=0.0):
+        self.name = name
+        self.pipeline = FakePipeline(download_rate)
+        self.upload_rate = FakeRate(upload_rate)
+        self.am_choking = True
+        self.peer_interested = False
+        self.upload_queue = deque()
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(type(message))
+
+    def __repr__(self):
+        return self.name
+
+
+def make_choker(peers, slots=4):
+    clock = FakeClock()
+    uploader = Uploader(None, max_upload_slots=slots)
+    for peer in peers:
+        uploader.on_interested(peer)
+    choker = Choker(
+        uploader, optimistic_interval=30, clock=clock, rng=random.Random(1))
+    return choker, uploader, clock
+
+
+def test_free_slots_are_given_out_on_interest():
+    peers = [FakePeer(str(i)) for i in range(6)]
+    _, uploader, _ = make_choker(peers)
+    assert uploader.unchoked == set(peers[:4])
+    assert peers[0].sent == [Unchoke]
+    assert peers[5].sent == []
+
+
+def test_fastest_uploaders_are_unchoked():
+    peers = [FakePeer(str(i), download_rate=i) for i in range(10)]
+    choker, uploader, _ = make_choker(peers)
+    choker.rechoke()
+
+    assert set(peers[7:]) <= uploader.unchoked
+    assert len(uploader.unchoked) == 4
+    assert choker.optimistic in peers[:7]
+    # Peers that lost their slot were told so
+    assert all(peer.am_choking for peer in peers if peer not in uploader.unchoked)
+
+
+def test_seeding_ranks_by_upload_rate():
+    peers = [FakePeer(str(i), download_rate=i, upload_rate=10 - i) for i in range(10)]
+    choker, uploader, _ = make_choker(peers)
+    choker.rechoke(seeding=True)
+    assert set(peers[:3]) <= uploader.unchoked
+
+
+def test_optimistic_unchoke_rotates():
+    peers = [FakePeer(str(i), download_rate=i) for i in range(20)]
+    choker, _, clock = make_choker(peers)
+    choker.rechoke()
+    first = choker.optimistic
+
+    clock.now += 10
+    choker.rechoke()
+    assert choker.optimistic is first
+
+    seen = {first}
+    for _ in range(10):
+        clock.now += 30
+        choker.rechoke()
+        seen.add(choker.optimistic)
+    assert len(seen) > 1
+
+
+def test_not_interested_peer_is_choked():
+    peers = [FakePeer(str(i)) for i in range(2)]
+    _, uploader, _ = make_choker(peers)
+    uploader.on_not_interested(peers[0])
+    assert peers[0] not in uploader.unchoked
+    assert peers[0].am_choking
+    assert peers[0].sent == [Unchoke, Choke]
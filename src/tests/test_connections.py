@@ -0,0 +1,210 @@
+import asyncio
+
+from connections import ConnectionLimits, ConnectionManager
+from messages import ProtocolError
+from tests.helpers import FakeClock, run
+
+
+class FakeRate(object):
+    total = 0
+
+
+class FakePipeline(object):
+    download_rate = FakeRate()
+
+
+class FakeWriter(object):
+    def close(self):
+        pass
+
+
+class FakePeer(object):
+    """
+    Connects when `connected` is set and stays connected until `closed`
+    is set. Hosts in `refusing` fail to connect, hosts in `misbehaving`
+    break the protocol once connected.
+    """
+    connected = None
+    closed = None
+    refusing = set()
+    misbehaving = set()
+    started = []
+
+    def __init__(self, session, host, port):
+        self.host = host
+        self.port = port
+        self.pipeline = FakePipeline()
+
+    async def connect(self, timeout):
+        FakePeer.started.append(self.host)
+        if self.host in FakePeer.refusing:
+            raise ConnectionRefusedError()
+        await FakePeer.connected.wait()
+        return None, FakeWriter()
+
+    async def run(self, reader, writer):
+        if self.host in FakePeer.misbehaving:
+            raise ProtocolError('Bad bitfield')
+        await FakePeer.closed.wait()
+
+    async def accept(self, reader, writer):
+        await FakePeer.closed.wait()
+
+
+def setup_fake_peers():
+    FakePeer.connected = asyncio.Event()
+    FakePeer.closed = asyncio.Event()
+    FakePeer.refusing = set()
+    FakePeer.misbehaving = set()
+    FakePeer.started = []
+
+
+async def settle():
+    for _ in range(50):
+        await asyncio.sleep(0)
+
+
+def test_connections_respect_half_open_and_total_limits():
+    async def scenario():
+        setup_fake_peers()
+        limits = ConnectionLimits(max_connections=5, max_half_open=2)
+        manager = ConnectionManager(
+            None, max_connections=4, limits=limits, peer_factory=FakePeer)
+        manager.add_peers(('10.0.0.{}'.format(i), 6881) for i in range(10))
+        task = asyncio.ensure_future(manager.run())
+
+        await settle()
+        assert manager.half_open == 2
+        assert len(FakePeer.started) == 2
+
+        FakePeer.connected.set()
+        await settle()
+        assert manager.active == 4
+        assert manager.half_open == 0
+        assert len(FakePeer.started) == 4
+        assert not manager.accepting
+
+        # Closed connections are replaced, within the half open cap
+        FakePeer.connected.clear()
+        FakePeer.closed.set()
+        await settle()
+        assert manager.active == 0
+        assert manager.half_open == 2
+        assert len(FakePeer.started) == 6
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    run(scenario())
+
+
+def test_failed_candidates_back_off_and_are_forgotten():
+    clock = FakeClock()
+    manager = ConnectionManager(
+        None, base_backoff=5, max_failures=3, clock=clock, peer_factory=FakePeer)
+    manager.add_peers([('10.0.0.1', 6881)])
+    candidate = manager.candidates[('10.0.0.1', 6881)]
+
+    manager._on_failure(candidate, ConnectionRefusedError())
+    assert candidate.next_attempt == 5
+    manager._on_failure(candidate, ConnectionRefusedError())
+    assert candidate.next_attempt == 10
+    assert manager.candidates
+    manager._on_failure(candidate, ConnectionRefusedError())
+    assert not manager.candidates
+
+
+def test_peers_breaking_the_protocol_are_not_redialled():
+    async def scenario():
+        setup_fake_peers()
+        FakePeer.connected.set()
+        FakePeer.misbehaving = {'10.0.0.1'}
+        manager = ConnectionManager(None, base_backoff=0.001, peer_factory=FakePeer)
+        manager.add_peers([('10.0.0.1', 1), ('10.0.0.2', 1)])
+        running = asyncio.ensure_future(manager.run(linger=True))
+        await asyncio.sleep(0.05)
+        running.cancel()
+        await asyncio.gather(running, return_exceptions=True)
+        return manager
+
+    manager = run(scenario())
+    assert sorted(FakePeer.started) == ['10.0.0.1', '10.0.0.2']
+    assert list(manager.candidates) == [('10.0.0.2', 1)]
+
+
+def test_candidates_that_gave_data_are_tried_first():
+    async def scenario():
+        setup_fake_peers()
+        manager = ConnectionManager(
+            None, max_connections=1, peer_factory=FakePeer)
+        manager.add_peers([('new', 1), ('failed', 1), ('good', 1)])
+        manager.candidates[('failed', 1)].failures = 2
+        good = manager.candidates[('good', 1)]
+        good.downloaded, good.connected_time = 1000, 10
+
+        manager.fill()
+        await settle()
+        assert FakePeer.started == ['good']
+        tasks = list(manager.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    run(scenario())
+
+
+def test_run_returns_once_everyone_failed():
+    async def scenario():
+        setup_fake_peers()
+        FakePeer.refusing = {'10.0.0.1', '10.0.0.2'}
+        manager = ConnectionManager(
+            None, base_backoff=0.001, max_failures=2, peer_factory=FakePeer)
+        manager.add_peers([('10.0.0.1', 1), ('10.0.0.2', 1)])
+        await asyncio.wait_for(manager.run(), 1)
+        assert sorted(FakePeer.started) == ['10.0.0.1'] * 2 + ['10.0.0.2'] * 2
+
+    run(scenario())
+
+
+def test_torrents_blocked_on_shared_limits_are_woken():
+    async def scenario():
+        setup_fake_peers()
+        limits = ConnectionLimits(max_connections=10, max_half_open=1)
+        first = ConnectionManager(None, limits=limits, peer_factory=FakePeer)
+        second = ConnectionManager(None, limits=limits, peer_factory=FakePeer)
+        first.add_peers([('10.0.0.1', 6881)])
+        second.add_peers([('10.0.0.2', 6881)])
+        tasks = [asyncio.ensure_future(m.run(linger=True)) for m in (first, second)]
+
+        await settle()
+        assert FakePeer.started == ['10.0.0.1']
+        # No polling, the second torrent connects as soon as there's room
+        FakePeer.connected.set()
+        await settle()
+        assert FakePeer.started == ['10.0.0.1', '10.0.0.2']
+        assert limits.connections == 2
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    run(asyncio.wait_for(scenario(), 0.5))
+
+
+def test_incoming_connections_close_when_run_stops():
+    async def scenario():
+        setup_fake_peers()
+        manager = ConnectionManager(None, peer_factory=FakePeer)
+        running = asyncio.ensure_future(manager.run(linger=True))
+        incoming = asyncio.ensure_future(manager.accept(
+            FakePeer(None, '10.0.0.1', 50000), None, FakeWriter()))
+        await settle()
+        assert manager.active == 1
+
+        running.cancel()
+        await asyncio.gather(running, return_exceptions=True)
+        assert manager.active == 0
+        assert not manager.tasks
+        await asyncio.gather(incoming, return_exceptions=True)
+        assert incoming.done()
+
+    run(asyncio.wait_for(scenario(), 0.5))
@@ -0,0 +1,147 @@
+import asyncio
+
+from dht import DHTError, DHTNode, RoutingTable, distance
+from tests.helpers import make_torrent, run
+from torrio import Session
+
+INFO_HASH = bytes(range(20))
+
+
+def node_id(first_byte : int) -> bytes:
+    return bytes([first_byte]) + bytes(19)
+
+
+def test_routing_table_buckets_and_closest():
+    now = [0.0]
+    table = RoutingTable(node_id(0), k=2, clock=lambda: now[0])
+    # Every id with the top bit set shares no prefix with ours, one bucket
+    assert table.add(node_id(0x80), '10.0.0.1', 1)
+    assert table.add(node_id(0x81), '10.0.0.2', 1)
+    assert table.add(node_id(0x82), '10.0.0.3', 1) is None
+    assert table.add(node_id(0x01), '10.0.0.4', 1)
+    assert table.add(node_id(0), '10.0.0.5', 1) is None
+
+    # A node that failed to answer makes room
+    table.failed(node_id(0x81))
+    assert table.add(node_id(0x82), '10.0.0.3', 1)
+    assert table.get(node_id(0x81)) is None
+    assert [n.id for n in table.closest(node_id(0x83), 2)] == [
+        node_id(0x82), node_id(0x80)]
+    assert len(table) == 3
+
+
+def test_lookups_find_announced_peers_in_a_cluster(tmp_path):
+    async def cluster():
+        # Knows everyone, like the public routers
+        nodes = [await DHTNode('127.0.0.1', 0, bootstrap=[], k=32, timeout=0.5).start()]
+        address = ('127.0.0.1', nodes[0].port)
+        for _ in range(15):
+            nodes.append(await DHTNode(
+                '127.0.0.1', 0, bootstrap=[address], timeout=0.5).start())
+        try:
+            for node in nodes[1:]:
+                await node.wait_bootstrapped()
+            found = await nodes[1].find_node(INFO_HASH)
+            others = sorted(
+                nodes[:1] + nodes[2:], key=lambda n: distance(n.node_id, INFO_HASH))
+            assert [n.id for n in found] == [n.node_id for n in others[:8]]
+
+            assert await nodes[1].announce_peer(INFO_HASH, 6881) == []
+            stored = sum(1 for node in nodes if INFO_HASH in node.peers)
+            peers = await nodes[-1].get_peers(INFO_HASH)
+            return stored, peers
+        finally:
+            for node in nodes:
+                node.close()
+
+    stored, peers = run(asyncio.wait_for(cluster(), 10))
+    assert stored == 8
+    assert peers == [('127.0.0.1', 6881)]
+
+
+def test_tokens_and_bad_queries():
+    now = [0.0]
+
+    async def query():
+        node = await DHTNode('127.0.0.1', 0, bootstrap=[], clock=lambda: now[0]).start()
+        other = await DHTNode('127.0.0.1', 0, bootstrap=[]).start()
+        try:
+            address = ('127.0.0.1', node.port)
+            response = await other.query(address, 'get_peers', {b'info_hash': INFO_HASH})
+            announce = {b'info_hash': INFO_HASH, b'port': 1, b'token': response[b'token']}
+            results = []
+            for elapsed in (0, 400, 400):
+                now[0] += elapsed
+                try:
+                    results.append(await other.query(address, 'announce_peer', announce))
+                except DHTError as e:
+                    results.append(e)
+            try:
+                await other.query(address, 'sample_infohashes')
+            except DHTError as e:
+                results.append(e)
+            return node.peers, results
+        finally:
+            node.close()
+            other.close()
+
+    peers, results = run(asyncio.wait_for(query(), 10))
+    assert list(peers[INFO_HASH]) == [('127.0.0.1', 1)]
+    # Good for one rotation of the secret but not two
+    assert isinstance(results[0], dict) and isinstance(results[1], dict)
+    assert 'Bad token' in str(results[2])
+    assert '204' in str(results[3])
+
+
+def test_routing_table_is_saved_for_the_next_start(tmp_path):
+    state = str(tmp_path / 'dht' / 'state')
+
+    async def restart():
+        first = await DHTNode('127.0.0.1', 0, bootstrap=[]).start()
+        node = await DHTNode(
+            '127.0.0.1', 0, bootstrap=[('127.0.0.1', first.port)],
+            state_file=state).start()
+        try:
+            await node.wait_bootstrapped()
+            node_id = node.node_id
+            node.close()
+            again = DHTNode('127.0.0.1', 0, bootstrap=[], state_file=state)
+            return first, node_id, again
+        finally:
+            first.close()
+
+    first, node_id, again = run(restart())
+    assert again.node_id == node_id
+    assert [n[0] for n in again.load_state()] == [first.node_id]
+
+
+def test_session_downloads_from_peers_the_dht_found(tmp_path):
+    content = bytes(range(256)) * 4
+    torrent, _ = make_torrent(
+        tmp_path, [(None, content)], piece_length=256, announce=None)
+    (tmp_path / 'seed').mkdir()
+    (tmp_path / 'seed' / torrent.name).write_bytes(content)
+
+    async def swarm():
+        router = await DHTNode('127.0.0.1', 0, bootstrap=[]).start()
+        bootstrap = [('127.0.0.1', router.port)]
+        seeder = await Session(
+            host='127.0.0.1', port=0, dht_port=0, dht_bootstrap=bootstrap).start()
+        leecher = None
+        try:
+            seeder.add(torrent.path, str(tmp_path / 'seed'), seed=True)
+            while torrent.info_hash not in router.peers:
+                await asyncio.sleep(0.01)
+            leecher = await Session(
+                host='127.0.0.1', port=0, dht_port=0, dht_bootstrap=bootstrap).start()
+            # No trackers and no peers given
+            return await leecher.download(torrent.path, str(tmp_path / 'leech'))
+        finally:
+            if leecher is not None:
+                await leecher.close()
+            await seeder.close()
+            router.close()
+
+    session = run(asyncio.wait_for(swarm(), 10))
+    assert session.is_on_disk()
+    assert (tmp_path / 'leech' / torrent.name).read_bytes() == content
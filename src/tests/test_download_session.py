@@ -1,10 +1,15 @@
+import asyncio
 import os
 
 import bitstring
 import pytest
 
+from file_saver import FileSaver
+from pipeline import RequestPipeline
+from tests.helpers import FakeClock, make_torrent, run
 from torrent import Torrent
 from torrio import DownloadSession
+from util import REQUEST_SIZE
 
 @pytest.fixture
 def torrent():
@@ -61,3 +66,148 @@ def test_get_piece_request_returns_all_requests(torrent):
         pass
 
     assert piece_block_combos == get_piece_block_tuples(all_requests)
+
+
+class FakePeer(object):
+    def __init__(self, number_of_pieces):
+        self.have_pieces = bitstring.BitArray(bin='1' * number_of_pieces)
+        self.pipeline = RequestPipeline()
+        self.cancelled = []
+
+    def cancel_request(self, index, begin, length):
+        self.pipeline.cancel(index, begin)
+        self.cancelled.append((index, begin))
+
+    def send(self, message):
+        pass
+
+    def wake_requests(self):
+        pass
+
+    def request(self, session, count):
+        blocks = session.next_requests(self, count)
+        for block in blocks:
+            self.pipeline.on_request_sent(block.piece, block.begin, block.length)
+        return [(block.piece, block.begin) for block in blocks]
+
+
+@pytest.fixture
+def small_session(tmp_path):
+    # 2 pieces of 2 blocks
+    torrent, data = make_torrent(
+        tmp_path, [(None, bytes(4 * REQUEST_SIZE))], piece_length=2 * REQUEST_SIZE)
+    session = DownloadSession(torrent)
+    peers = [FakePeer(torrent.number_of_pieces) for _ in range(3)]
+    session.peers.update(peers)
+    return session, peers
+
+
+def test_unrequested_blocks_of_started_pieces_come_first(small_session):
+    session, (a, b, _) = small_session
+    first = a.request(session, 1)
+    second = b.request(session, 1)
+    assert first[0][0] == second[0][0]
+    assert first != second
+    assert len(session.pieces_in_progress) == 1
+
+
+def test_endgame_duplicates_requests_and_cancels(small_session):
+    session, (a, b, c) = small_session
+    assert len(a.request(session, 10)) == 4
+    assert session.in_endgame
+
+    duplicates = b.request(session, 2)
+    assert len(duplicates) == 2
+    assert len(c.request(session, 10)) == 4
+    # Blocks requested from the fewest peers go first
+    assert not set(duplicates) & set(c.request(session, 10))
+
+    index, begin = duplicates[0]
+    session.on_block_received(index, begin, memoryview(bytes(REQUEST_SIZE)), b)
+    assert (index, begin) in a.cancelled
+    assert (index, begin) in c.cancelled
+    assert not b.cancelled
+
+    # A copy that crossed the cancel on the wire isn't counted twice
+    session.on_block_received(index, begin, memoryview(bytes(REQUEST_SIZE)), a)
+    assert session.downloaded == REQUEST_SIZE
+    assert session.wasted == REQUEST_SIZE
+
+
+def test_timed_out_requests_go_to_other_peers(small_session):
+    session, (a, b, _) = small_session
+    requested = a.request(session, 4)
+    session.request_timeout = 0
+    a.pipeline.clock = lambda: float('inf')
+    session.expire_requests()
+    assert not a.pipeline.inflight
+    assert not session.in_endgame
+    assert sorted(b.request(session, 4)) == sorted(requested)
+
+
+def test_disconnected_peer_gives_its_requests_back(small_session):
+    session, (a, b, _) = small_session
+    requested = a.request(session, 3)
+    session.on_peer_disconnected(a)
+    assert sorted(b.request(session, 4)) == sorted(requested + [(1, REQUEST_SIZE)])
+
+
+def test_idle_peer_takes_blocks_a_slow_peer_is_late_with(tmp_path):
+    torrent, _ = make_torrent(
+        tmp_path, [(None, bytes(8 * REQUEST_SIZE))], piece_length=2 * REQUEST_SIZE)
+    session = DownloadSession(torrent)
+    slow, fast = FakePeer(4), FakePeer(4)
+    session.peers.update([slow, fast])
+    clock = FakeClock()
+    slow.pipeline.clock = clock
+    # The fast peer only has the piece the slow one is working on
+    fast.have_pieces = bitstring.BitArray(bin='1000')
+
+    requested = slow.request(session, 2)
+    assert fast.request(session, 2) == []
+
+    # Late, but not timed out yet
+    clock.now += slow.pipeline.max_deadline + 1
+    session.expire_requests()
+    assert sorted(fast.request(session, 2)) == sorted(requested)
+    # The slow peer keeps its requests, the first copy in wins
+    assert len(slow.pipeline.inflight) == 2
+    session.on_block_received(0, 0, memoryview(bytes(REQUEST_SIZE)), fast)
+    assert slow.cancelled == [(0, 0)]
+
+
+def test_pieces_that_fail_to_be_written_are_downloaded_again(tmp_path):
+    torrent, data = make_torrent(
+        tmp_path, [(None, bytes(range(256)) * 128)], piece_length=2 * REQUEST_SIZE)
+    have = bitstring.BitArray(bin='1' * torrent.number_of_pieces)
+
+    async def download_first_piece():
+        saver = FileSaver(str(tmp_path / 'out'), torrent)
+        failures = []
+
+        def failing_write(offset, buffers):
+            failures.append(offset)
+            raise OSError(28, 'No space left on device')
+        saver.storage.write = failing_write
+        session = DownloadSession(torrent, saver.get_received_blocks_queue())
+        waiting = asyncio.ensure_future(session.wait_on_disk())
+        piece = session.get_piece_request(have)
+        for block in piece.blocks:
+            offset = piece.index * torrent.piece_length + block.begin
+            session.on_block_received(
+                piece.index, block.begin, memoryview(data[offset:offset + block.length]))
+        while not failures:
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.01)
+        await saver.received_blocks_queue.put(None)
+        await saver.task
+        assert not waiting.done()
+        waiting.cancel()
+        return session, piece.index
+
+    session, index = run(download_first_piece())
+    assert not session.received_pieces[index]
+    assert session.bytes_left == torrent.size
+    assert session.buffer_pool.in_use == 0
+    assert not session.is_complete()
+    assert session.get_piece_request(have).index == index
@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bitstring
+
+from hasher import PieceHasher, sha1_digest
+from tests.helpers import make_torrent, run
+from torrio import DownloadSession
+from util import REQUEST_SIZE
+
+
+def test_digest_of_buffers_matches_joined_data():
+    buffers = [b'a' * 100, memoryview(b'b' * 5000), bytearray(b'c')]
+    assert sha1_digest(buffers) == hashlib.sha1(b''.join(buffers)).digest()
+
+
+def test_process_pool_hashes_views():
+    hasher = PieceHasher(workers=1, use_processes=True)
+    try:
+        digest = run(hasher.hash([memoryview(b'abc'), b'def']))
+    finally:
+        hasher.shutdown()
+    assert digest == hashlib.sha1(b'abcdef').digest()
+
+
+def test_pending_hashes_are_bounded():
+    lock = threading.Lock()
+    concurrency = {'now': 0, 'peak': 0}
+
+    class CountingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args):
+            def counted():
+                with lock:
+                    concurrency['now'] += 1
+                    concurrency['peak'] = max(concurrency['peak'], concurrency['now'])
+                time.sleep(0.01)
+                with lock:
+                    concurrency['now'] -= 1
+                return fn(*args)
+            return super().submit(counted)
+
+    hasher = PieceHasher(max_pending=2, executor=CountingExecutor(8))
+
+    async def hash_many():
+        return await asyncio.gather(*[
+            hasher.hash([bytes([i])]) for i in range(10)
+        ])
+
+    results = run(hash_many())
+    assert results == [hashlib.sha1(bytes([i])).digest() for i in range(10)]
+    assert concurrency['peak'] == 2
+    assert hasher.pending == 0
+
+
+def test_session_verifies_pieces_off_the_loop(tmp_path):
+    content = bytes(range(256)) * 256
+    torrent, data = make_torrent(
+        tmp_path, [(None, content)], piece_length=2 * REQUEST_SIZE)
+
+    async def download_first_piece(corrupt):
+        session = DownloadSession(torrent, asyncio.Queue())
+        session.get_piece_request(bitstring.BitArray(bin='1' * torrent.number_of_pieces))
+        first = data[:REQUEST_SIZE]
+        if corrupt:
+            first = b'x' * REQUEST_SIZE
+        session.on_block_received(0, 0, memoryview(first))
+        session.on_block_received(0, REQUEST_SIZE, memoryview(data[REQUEST_SIZE:2 * REQUEST_SIZE]))
+        assert session.pieces_verifying == {0}
+        while session.pieces_verifying:
+            await asyncio.sleep(0.001)
+        return session
+
+    session = run(download_first_piece(corrupt=False))
+    assert session.received_pieces[0]
+    offset, buffers, on_written = session.received_blocks.get_nowait()
+    assert offset == 0
+    assert b''.join(buffers) == data[:2 * REQUEST_SIZE]
+    assert session.buffer_pool.in_use == 1
+    assert not session.has_piece(0)
+    on_written(True)
+    assert session.buffer_pool.in_use == 0
+    assert session.has_piece(0)
+
+    session = run(download_first_piece(corrupt=True))
+    assert not session.received_pieces[0]
+    assert session.received_blocks.empty()
+    # Failed pieces give their buffer back and can be picked again
+    assert session.buffer_pool.in_use == 0
+    assert 0 not in session.pieces_in_progress
+
+
+def test_session_gives_up_pieces_the_hasher_cannot_verify(tmp_path):
+    content = bytes(range(256)) * 256
+    torrent, data = make_torrent(
+        tmp_path, [(None, content)], piece_length=2 * REQUEST_SIZE)
+    hasher = PieceHasher(workers=1)
+    hasher.shutdown()
+
+    async def download_first_piece():
+        session = DownloadSession(torrent, asyncio.Queue(), hasher=hasher)
+        session.get_piece_request(bitstring.BitArray(bin='1' * torrent.number_of_pieces))
+        session.on_block_received(0, 0, memoryview(data[:REQUEST_SIZE]))
+        session.on_block_received(0, REQUEST_SIZE, memoryview(data[REQUEST_SIZE:2 * REQUEST_SIZE]))
+        assert len(session.verify_tasks) == 1
+        await asyncio.gather(*session.verify_tasks)
+        return session
+
+    session = run(download_first_piece())
+    assert not session.verify_tasks
+    assert not session.pieces_verifying
+    assert not session.received_pieces[0]
+    assert session.received_blocks.empty()
+    assert session.buffer_pool.in_use == 0
+    assert 0 not in session.pieces_in_progress
+
+
+def test_cancelled_verifications_give_their_pieces_up(tmp_path):
+    content = bytes(range(256)) * 256
+    torrent, data = make_torrent(
+        tmp_path, [(None, content)], piece_length=2 * REQUEST_SIZE)
+    executor = ThreadPoolExecutor(max_workers=1)
+    blocked = threading.Event()
+    executor.submit(blocked.wait)
+    hasher = PieceHasher(executor=executor)
+
+    async def cancel_mid_verification():
+        session = DownloadSession(torrent, asyncio.Queue(), hasher=hasher)
+        session.get_piece_request(bitstring.BitArray(bin='1' * torrent.number_of_pieces))
+        session.on_block_received(0, 0, memoryview(data[:REQUEST_SIZE]))
+        session.on_block_received(0, REQUEST_SIZE, memoryview(data[REQUEST_SIZE:2 * REQUEST_SIZE]))
+        await asyncio.sleep(0.01)
+        await session.cancel_verifications()
+        return session
+
+    try:
+        session = run(cancel_mid_verification())
+    finally:
+        blocked.set()
+        executor.shutdown()
+    assert not session.verify_tasks
+    assert not session.pieces_verifying
+    assert session.received_blocks.empty()
+    assert session.buffer_pool.in_use == 0
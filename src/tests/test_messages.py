@@ -0,0 +1,87 @@
+import struct
+
+import pytest
+
+from messages import (
+    Bitfield, Cancel, Choke, Extended, Have, KeepAlive, MessageParser, Piece,
+    ProtocolError, Request, Unchoke, UnknownMessage
+)
+
+
+def parse_all(parser, data, chunk_size):
+    messages = []
+    for i in range(0, len(data), chunk_size):
+        parser.feed(data[i:i + chunk_size])
+        messages.extend(parser)
+    return messages
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 100, 2**16])
+def test_parser_frames_messages_across_chunks(chunk_size):
+    block = bytes(range(256)) * 64
+    expected = [
+        KeepAlive(),
+        Choke(),
+        Unchoke(),
+        Have(42),
+        Bitfield(b'\xff\x80'),
+        Request(1, 2**14, 2**14),
+        Piece(3, 0, block),
+        Cancel(1, 2**14, 2**14),
+    ]
+    stream = b''.join(message.encode() for message in expected)
+
+    messages = parse_all(MessageParser(), stream, chunk_size)
+
+    assert messages == expected
+
+
+def test_piece_payload_is_a_view():
+    parser = MessageParser()
+    parser.feed(Piece(0, 0, b'abcd').encode())
+    message = next(iter(parser))
+    assert isinstance(message.block, memoryview)
+    assert message.block.tobytes() == b'abcd'
+
+
+def test_payload_views_survive_later_feeds():
+    first = Piece(0, 0, b'x' * 10).encode()
+    second = Piece(0, 10, b'y' * 10).encode()
+    parser = MessageParser()
+    parser.feed(first + second[:5])
+    message = next(iter(parser))
+    parser.feed(second[5:])
+    assert message.block.tobytes() == b'x' * 10
+    assert next(iter(parser)).block.tobytes() == b'y' * 10
+
+
+def test_unknown_message_is_returned():
+    parser = MessageParser()
+    parser.feed(struct.pack('>IB', 3, 42) + b'hi')
+    message = next(iter(parser))
+    assert isinstance(message, UnknownMessage)
+    assert message.id == 42
+    assert message.data.tobytes() == b'hi'
+
+
+def test_extended_message():
+    message = Extended(3, b'd1:ai1ee')
+    parser = MessageParser()
+    parser.feed(message.encode() + struct.pack('>IB', 1, 20))
+    assert next(iter(parser)) == message
+    with pytest.raises(ProtocolError):
+        next(iter(parser))
+
+
+def test_oversized_length_prefix_raises():
+    parser = MessageParser(max_length=1024)
+    parser.feed(struct.pack('>I', 4096))
+    with pytest.raises(ProtocolError):
+        list(parser)
+
+
+def test_truncated_payload_raises():
+    parser = MessageParser()
+    parser.feed(struct.pack('>IB', 3, Have.id) + b'\x00\x00')
+    with pytest.raises(ProtocolError):
+        list(parser)
@@ -0,0 +1,149 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+
+import pytest
+
+from file_saver import FileSaver
+from magnet import Magnet, MagnetError
+from messages import (
+    Extended, HANDSHAKE_LENGTH, MessageParser, RESERVED_EXTENSIONS,
+    encode_extended_handshake, encode_handshake
+)
+from metadata import (
+    METADATA_BLOCK_SIZE, METADATA_DATA, METADATA_REJECT, METADATA_REQUEST,
+    UT_METADATA, UT_METADATA_ID, MetadataCache, MetadataFetcher,
+    decode_metadata_message, encode_metadata_message, metadata_reply
+)
+from seeder import PeerServer, Uploader
+from tests.helpers import make_torrent, run
+from torrio import DownloadSession, open_magnet
+
+
+def test_magnet_parsing():
+    info_hash = bytes(range(20))
+    hex_hash = binascii.hexlify(info_hash).decode()
+    magnet = Magnet(
+        'magnet:?xt=urn:btih:{}&dn=Some+File&tr=http%3A%2F%2Ft%2Fa'
+        '&tr=udp://u:80&tr=http%3A%2F%2Ft%2Fa&x.pe=10.0.0.1:6881'
+        '&x.pe=[::1]:51413&x.pe=nonsense&xl=1000'.format(hex_hash))
+    assert magnet.info_hash == info_hash
+    assert magnet.name == 'Some File'
+    assert magnet.announce_list == [['http://t/a'], ['udp://u:80']]
+    assert magnet.peers == [('10.0.0.1', 6881), ('::1', 51413)]
+    assert magnet.size == 1000
+
+    b32 = base64.b32encode(info_hash).decode().lower()
+    magnet = Magnet('magnet:?xt=urn:btih:' + b32)
+    assert magnet.info_hash == info_hash
+    assert magnet.announce_url is None
+    assert magnet.name == hex_hash
+
+    for uri in ('http://x/', 'magnet:?dn=x', 'magnet:?xt=urn:btih:abc'):
+        with pytest.raises(MagnetError):
+            Magnet(uri)
+
+
+def test_metadata_messages():
+    metadata = bytes(range(256)) * 100
+    msg_type, piece, block = decode_metadata_message(metadata_reply(metadata, 1))
+    assert (msg_type, piece) == (METADATA_DATA, 1)
+    assert block == metadata[METADATA_BLOCK_SIZE:]
+    assert decode_metadata_message(metadata_reply(metadata, 2))[0] == METADATA_REJECT
+    assert decode_metadata_message(
+        encode_metadata_message(METADATA_REQUEST, 5)) == (METADATA_REQUEST, 5, b'')
+
+
+def test_cache_keeps_info_dict_bytes(tmp_path):
+    torrent, _ = make_torrent(tmp_path, [(None, bytes(100))])
+    cache = MetadataCache(str(tmp_path / 'cache'))
+    assert cache.load(torrent.info_hash) is None
+
+    cached = cache.store(torrent.info_hash, bytes(torrent.info_bytes), ['http://t/'])
+    assert cached.info_hash == torrent.info_hash
+    assert cached.announce_list == [['http://t/']]
+    assert cache.load(torrent.info_hash).size == 100
+    assert cache.load(hashlib.sha1(b'other').digest()) is None
+
+
+async def lying_peer(info_hash, size):
+    """
+    Serves the right sized metadata, all zeros
+    """
+    async def on_connection(reader, writer):
+        try:
+            await reader.readexactly(HANDSHAKE_LENGTH)
+            writer.write(encode_handshake(info_hash, b'-LIAR-'.ljust(20, b'x'), RESERVED_EXTENSIONS))
+            writer.write(encode_extended_handshake(
+                {UT_METADATA: 7}, metadata_size=size).encode())
+            parser = MessageParser()
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                parser.feed(data)
+                for message in parser:
+                    if isinstance(message, Extended) and message.ext_id == 7:
+                        _, piece, _ = decode_metadata_message(message.data)
+                        writer.write(Extended(
+                            UT_METADATA_ID, metadata_reply(bytes(size), piece)).encode())
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(on_connection, '127.0.0.1', 0)
+
+
+def test_fetch_metadata_bans_liars(tmp_path):
+    # Big enough for a few metadata blocks
+    torrent, data = make_torrent(tmp_path, [(None, bytes(range(256)) * 160)], piece_length=16)
+    assert len(torrent.info_bytes) > 2 * METADATA_BLOCK_SIZE
+    (tmp_path / 'seed').mkdir()
+    (tmp_path / 'seed' / 'pack').write_bytes(data)
+
+    async def fetch():
+        saver = FileSaver(str(tmp_path / 'seed'), torrent)
+        session = DownloadSession(
+            torrent, saver.get_received_blocks_queue(), uploader=Uploader(saver))
+        servers = [
+            await PeerServer(session, host='127.0.0.1', port=0).start()
+            for _ in range(2)
+        ]
+        liar = await lying_peer(torrent.info_hash, len(torrent.info_bytes))
+        liar_address = ('127.0.0.1', liar.sockets[0].getsockname()[1])
+
+        fetcher = MetadataFetcher(torrent.info_hash)
+        fetcher.add_peers([liar_address])
+        fetching = asyncio.ensure_future(fetcher.fetch())
+        try:
+            while not fetcher.banned:
+                await asyncio.sleep(0.01)
+            assert fetcher.banned == {liar_address}
+            fetcher.add_peers([('127.0.0.1', server.port) for server in servers])
+            return await fetching, fetcher
+        finally:
+            fetching.cancel()
+            liar.close()
+            for server in servers:
+                server.close()
+            await saver.received_blocks_queue.put(None)
+            await asyncio.sleep(0.05)
+
+    metadata, fetcher = run(asyncio.wait_for(fetch(), 10))
+    assert metadata == bytes(torrent.info_bytes)
+    # Both seeds were asked for blocks
+    assert len(fetcher.peers) == 2
+
+
+def test_open_magnet_uses_the_cache(tmp_path):
+    torrent, _ = make_torrent(tmp_path, [(None, bytes(100))])
+    cache = MetadataCache(str(tmp_path / 'cache'))
+    uri = 'magnet:?xt=urn:btih:' + binascii.hexlify(torrent.info_hash).decode()
+    with pytest.raises(MagnetError):
+        run(open_magnet(uri, cache))
+
+    cache.store(torrent.info_hash, bytes(torrent.info_bytes))
+    cached, peers = run(open_magnet(uri + '&x.pe=10.0.0.1:1', cache))
+    assert cached.info_hash == torrent.info_hash
+    assert peers == [('10.0.0.1', 1)]
@@ -0,0 +1,146 @@
+import asyncio
+import gc
+import json
+
+import pytest
+
+from metrics import REGISTRY, MetricsServer, Registry, dump_metrics
+from tests.helpers import make_torrent, run
+from torrio import Session
+
+
+def sample(name, **labels):
+    """
+    Sum of the REGISTRY samples called `name` with `labels`
+    """
+    return sum(
+        sample['value']
+        for metric in REGISTRY.to_dict().values()
+        for sample in metric['samples']
+        if sample['name'] == name and labels.items() <= sample['labels'].items()
+    )
+
+
+class Tracked(object):
+    def __init__(self, depth):
+        self.depth = depth
+
+
+def test_prometheus_text():
+    registry = Registry()
+    messages = registry.counter('messages_total', 'Messages', ('type',))
+    messages.labels('Have').inc()
+    messages.labels('Have').inc(2)
+    assert registry.counter('messages_total', 'Messages', ('type',)) is messages
+    latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        latency.observe(value)
+
+    assert registry.to_prometheus() == (
+        '# HELP latency_seconds Latency\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{le="0.1"} 2\n'
+        'latency_seconds_bucket{le="1"} 3\n'
+        'latency_seconds_bucket{le="+Inf"} 4\n'
+        'latency_seconds_sum 5.65\n'
+        'latency_seconds_count 4\n'
+        '# HELP messages_total Messages\n'
+        '# TYPE messages_total counter\n'
+        'messages_total{type="Have"} 3\n'
+    )
+    with pytest.raises(ValueError):
+        registry.gauge('messages_total', 'Messages')
+    with pytest.raises(ValueError):
+        messages.labels('Have', 'extra')
+
+
+def test_gauges_track_live_objects():
+    registry = Registry()
+    depth = registry.gauge('queue_depth', 'Queued', ('queue',))
+    one, two, three = Tracked(1), Tracked(2), Tracked(4)
+    depth.track(one, lambda obj: obj.depth, 'disk')
+    depth.track(two, lambda obj: obj.depth, 'disk')
+    depth.track(three, lambda obj: obj.depth, 'hash')
+
+    def values():
+        return {
+            sample['labels']['queue']: sample['value']
+            for sample in registry.to_dict()['queue_depth']['samples']
+        }
+    assert values() == {'disk': 3, 'hash': 4}
+    two.depth = 5
+    depth.untrack(one)
+    del three
+    gc.collect()
+    assert values() == {'disk': 5}
+
+
+def test_metrics_endpoint_and_dump(tmp_path):
+    registry = Registry()
+    registry.counter('things_total', 'Things').inc(7)
+    dump = str(tmp_path / 'metrics.json')
+
+    async def scrape():
+        server = await MetricsServer(registry, port=0).start()
+        dumping = asyncio.ensure_future(dump_metrics(dump, 60, registry))
+        responses = []
+        try:
+            for path in ('/metrics', '/metrics.json', '/nothing'):
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+                writer.write('GET {} HTTP/1.1\r\nHost: x\r\n\r\n'.format(path).encode())
+                responses.append(await reader.read())
+                writer.close()
+        finally:
+            server.close()
+            dumping.cancel()
+            await asyncio.gather(dumping, return_exceptions=True)
+        return responses
+
+    text, as_json, missing = run(asyncio.wait_for(scrape(), 5))
+    assert text.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert text.endswith(b'\r\n\r\n' + registry.to_prometheus().encode())
+    body = json.loads(as_json.split(b'\r\n\r\n', 1)[1].decode())
+    assert body['things_total']['samples'][0]['value'] == 7
+    assert missing.startswith(b'HTTP/1.0 404')
+    # The dump is written when it's cancelled
+    with open(dump) as f:
+        assert json.load(f) == registry.to_dict()
+
+
+def test_download_is_instrumented(tmp_path):
+    content = bytes(range(256)) * 16
+    torrent, _ = make_torrent(
+        tmp_path, [(None, content)], piece_length=1024, announce=None)
+    (tmp_path / 'seed').mkdir()
+    (tmp_path / 'seed' / torrent.name).write_bytes(content)
+
+    async def swarm():
+        seeder = await Session(host='127.0.0.1', port=0).start()
+        leecher = await Session(host='127.0.0.1', port=0).start()
+        try:
+            seeder.add(torrent.path, str(tmp_path / 'seed'), seed=True)
+            while not seeder.torrents or not all(
+                    s.is_on_disk() for s in seeder.torrents.values()):
+                await asyncio.sleep(0.01)
+            await leecher.download(
+                torrent.path, str(tmp_path / 'leech'),
+                peers=[('127.0.0.1', seeder.port)])
+        finally:
+            await leecher.close()
+            await seeder.close()
+
+    names = (
+        'battorrent_pieces_verified_total', 'battorrent_piece_seconds_count',
+        'battorrent_hash_seconds_count', 'battorrent_disk_write_seconds_count',
+        'battorrent_uploaded_bytes_total',
+    )
+    before = [sample(name) for name in names]
+    pieces = sample('battorrent_messages_received_total', type='Piece')
+    run(asyncio.wait_for(swarm(), 10))
+    # 4 pieces downloaded, the seeder checking its files may have hashed
+    # some more
+    counts = [sample(name) - count for name, count in zip(names, before)]
+    assert counts[:2] == [4, 4]
+    assert counts[2] >= 4 and counts[3] >= 4
+    assert counts[4] == len(content)
+    assert sample('battorrent_messages_received_total', type='Piece') - pieces == 4
@@ -0,0 +1,41 @@
+import socket
+import struct
+
+from peer_list import (
+    decode_compact_peers, decode_compact_peers6, decode_peers,
+    encode_compact_peers
+)
+
+
+def test_compact_peers_round_trip():
+    peers = [('10.0.0.1', 6881), ('192.168.1.20', 51413)]
+    data = encode_compact_peers(peers)
+    assert len(data) == 12
+    assert decode_compact_peers(data) == peers
+    # A truncated record is ignored
+    assert decode_compact_peers(data + b'\x01\x02') == peers
+
+
+def test_compact_peers6():
+    data = socket.inet_pton(socket.AF_INET6, '2001:db8::1') + struct.pack('>H', 6881)
+    assert decode_compact_peers6(data) == [('2001:db8::1', 6881)]
+
+
+def test_dict_model_skips_malformed_entries():
+    peers = [
+        {b'peer id': b'x' * 20, b'ip': b'10.0.0.1', b'port': 6881},
+        {b'ip': b'tracker.example.org', b'port': 80},
+        {b'ip': b'10.0.0.2'},
+        {b'ip': 5, b'port': 1},
+        b'garbage',
+    ]
+    assert decode_peers(peers) == [('10.0.0.1', 6881), ('tracker.example.org', 80)]
+
+
+def test_decode_peers_dedupes_and_excludes():
+    peers = [('10.0.0.1', 6881), ('10.0.0.2', 6881), ('10.0.0.1', 6881),
+             ('10.0.0.3', 0), ('10.0.0.4', 59696)]
+    peers6 = socket.inet_pton(socket.AF_INET6, '::1') + struct.pack('>H', 1)
+    assert decode_peers(
+        encode_compact_peers(peers), peers6, exclude={('10.0.0.4', 59696)}
+    ) == [('10.0.0.1', 6881), ('10.0.0.2', 6881), ('::1', 1)]
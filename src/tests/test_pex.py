@@ -0,0 +1,98 @@
+import bencode
+from connections import ConnectionManager
+from messages import Extended
+from pex import (
+    FLAG_REACHABLE, PeerExchange, UT_PEX, decode_pex_message,
+    encode_pex_message
+)
+from tests.helpers import FakeClock
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.peers = set()
+
+
+class FakePeer(object):
+    def __init__(self, host, listen_port, outgoing=True, pex=True):
+        self.host = host
+        self.listen_port = listen_port
+        self.outgoing = outgoing
+        self.extensions = {UT_PEX: 3} if pex else {}
+        self.pex_advertised = set()
+        self.pex_received_at = None
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+def test_pex_message_roundtrip():
+    data = encode_pex_message(
+        [('10.0.0.1', 1), ('::1', 2), ('10.0.0.2', 3)], [('10.0.0.3', 4)],
+        bytes([FLAG_REACHABLE, 0, 0]))
+    # The IPv6 peer and its flag are left out
+    assert bencode.decode(data)[b'added.f'] == bytes([FLAG_REACHABLE, 0])
+    assert decode_pex_message(data) == (
+        [('10.0.0.1', 1), ('10.0.0.2', 3)], [('10.0.0.3', 4)])
+
+
+def test_connected_peers_are_advertised_as_they_change():
+    session = FakeSession()
+    a = FakePeer('10.0.0.1', 6881)
+    b = FakePeer('10.0.0.2', 6882, outgoing=False)
+    # Incoming, and its handshake had no listen port
+    c = FakePeer('10.0.0.3', None, outgoing=False, pex=False)
+    session.peers.update([a, b, c])
+    pex = PeerExchange(session, ConnectionManager(session))
+
+    pex.send_updates()
+    message = a.sent.pop()
+    assert isinstance(message, Extended) and message.ext_id == 3
+    assert decode_pex_message(message.data) == ([('10.0.0.2', 6882)], [])
+    assert bencode.decode(message.data)[b'added.f'] == bytes([0])
+    assert decode_pex_message(b.sent.pop().data) == ([('10.0.0.1', 6881)], [])
+    assert not c.sent
+
+    # Nothing changed, nothing sent
+    pex.send_updates()
+    assert not a.sent and not b.sent
+
+    session.peers.discard(b)
+    pex.send_updates()
+    assert decode_pex_message(a.sent.pop().data) == ([], [('10.0.0.2', 6882)])
+
+
+def test_received_peers_are_deduplicated_and_rate_limited():
+    clock = FakeClock()
+    session = FakeSession()
+    peer = FakePeer('10.0.0.1', 6881)
+    session.peers.add(peer)
+    connections = ConnectionManager(session)
+    connections.add_peers([('10.0.0.2', 1)])
+    pex = PeerExchange(
+        session, connections, listen_port=6881, peers_per_minute=30,
+        own_addresses=['10.0.0.9'], clock=clock)
+
+    def receive(addresses):
+        pex.on_message(peer, encode_pex_message(addresses))
+
+    receive([('10.0.0.1', 6881), ('10.0.0.2', 1), ('10.0.0.9', 6881), ('10.0.0.3', 1)])
+    # Only the one we didn't know of, not the peer itself or us
+    assert list(connections.candidates) == [('10.0.0.2', 1), ('10.0.0.3', 1)]
+
+    # Too soon after the last message from the same peer
+    clock.now += 1
+    receive([('10.0.0.4', 1)])
+    assert ('10.0.0.4', 1) not in connections.candidates
+
+    # A flood goes over the budget, the next message has to wait for it
+    clock.now += 60
+    receive([('10.1.0.{}'.format(i), 1) for i in range(100)])
+    assert len(connections.candidates) == 2 + 50
+    clock.now += 30
+    receive([('10.0.0.5', 1)])
+    assert ('10.0.0.5', 1) not in connections.candidates
+    clock.now += 60
+    receive([('10.0.0.5', 1)])
+    assert ('10.0.0.5', 1) in connections.candidates
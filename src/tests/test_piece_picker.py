@@ -0,0 +1,178 @@
+import random
+
+import bitstring
+import pytest
+
+from piece_picker import (
+    HIGH, LOW, NORMAL, NoPieceAvailable, PiecePicker, RANDOM_FIRST,
+    RAREST_FIRST, SEQUENTIAL, SKIP
+)
+
+
+def bits(s):
+    return bitstring.BitArray(bin=s)
+
+
+def test_rarest_first_prefers_least_available():
+    picker = PiecePicker(4, RAREST_FIRST)
+    picker.add_peer(bits('1111'))
+    picker.add_peer(bits('1101'))
+    picker.add_peer(bits('0100'))
+
+    assert picker.availability.tolist() == [2, 3, 1, 2]
+    assert picker.pick(bits('1111')) == 2
+    assert picker.pick(bits('1111')) == 0
+    assert picker.pick(bits('1111')) == 3
+    assert picker.pick(bits('1111')) == 1
+    with pytest.raises(NoPieceAvailable):
+        picker.pick(bits('1111'))
+
+
+def test_have_and_disconnect_update_availability():
+    picker = PiecePicker(3, RAREST_FIRST)
+    picker.add_peer(bits('110'))
+    picker.increment(2)
+    picker.increment(2)
+    picker.remove_peer(bits('110'))
+
+    assert picker.availability.tolist() == [0, 0, 2]
+    assert picker.pick(bits('111')) == 0
+
+
+def test_only_picks_pieces_the_peer_has():
+    picker = PiecePicker(4, RAREST_FIRST)
+    assert picker.pick(bits('0010')) == 2
+    with pytest.raises(NoPieceAvailable):
+        picker.pick(bits('0010'))
+    # Skipped pieces are still pickable
+    assert picker.pick(bits('1111')) == 0
+
+
+def test_sequential_ignores_availability():
+    picker = PiecePicker(3, SEQUENTIAL)
+    picker.add_peer(bits('001'))
+    assert [picker.pick(bits('111')) for _ in range(3)] == [0, 1, 2]
+
+
+def test_released_pieces_are_picked_again():
+    picker = PiecePicker(2, RAREST_FIRST)
+    first = picker.pick(bits('11'))
+    picker.release(first)
+    assert picker.pick(bits('11')) == first
+
+
+def test_done_pieces_are_never_picked():
+    picker = PiecePicker(2, RANDOM_FIRST)
+    picker.mark_done(0)
+    assert picker.pick(bits('11')) == 1
+    assert len(picker) == 1
+
+
+def test_spare_bitfield_bits_are_ignored():
+    picker = PiecePicker(3, RAREST_FIRST)
+    picker.add_peer(bitstring.BitArray(bytes([0xff])))
+    assert picker.availability.tolist() == [1, 1, 1]
+
+
+def test_deadlines_come_first_earliest_first():
+    picker = PiecePicker(6, RAREST_FIRST)
+    picker.add_peer(bits('111100'))
+    picker.set_deadline(5, 2.0)
+    picker.set_deadline(3, 1.0)
+    picker.set_deadline(4, 3.0)
+    # The peer lacks 4 and 5, they stay critical for others
+    assert picker.pick(bits('111101')) == 3
+    assert picker.pick(bits('111101')) == 5
+    picker.set_deadline(4, None)
+    assert picker.deadlines == {3: 1.0, 5: 2.0}
+
+    # Released pieces keep their deadline, done pieces lose it
+    picker.set_deadline(1, 5.0)
+    assert picker.pick(bits('111111')) == 1
+    picker.release(1)
+    assert picker.pick(bits('111111')) == 1
+    picker.mark_done(1)
+    assert 1 not in picker.deadlines
+
+
+@pytest.mark.parametrize('policy', [RAREST_FIRST, SEQUENTIAL])
+def test_priorities_and_skipped_pieces(policy):
+    picker = PiecePicker(5, policy)
+    picker.add_peer(bits('11111'))
+    picker.add_peer(bits('00001'))
+    picker.set_priorities([LOW, SKIP, SKIP, HIGH, LOW])
+    assert len(picker) == 3
+    assert picker.pick(bits('11111')) == 3
+    # Then the low ones, 4 is both the more available and the later one
+    assert picker.pick(bits('11111')) == 0
+    assert picker.pick(bits('11111')) == 4
+    with pytest.raises(NoPieceAvailable):
+        picker.pick(bits('11111'))
+
+    # Skipping a piece in progress keeps it from being picked again
+    picker.set_priority(0, SKIP)
+    picker.release(0)
+    assert len(picker) == 2
+    picker.set_priority(2, HIGH)
+    assert picker.pick(bits('11111')) == 2
+    picker.mark_done(3)
+    picker.mark_done(4)
+    picker.mark_done(2)
+    assert len(picker) == 0
+
+
+def test_random_first_picks_the_highest_priority_first():
+    for _ in range(20):
+        picker = PiecePicker(64, RANDOM_FIRST)
+        picker.add_peer(bits('1' * 64))
+        picker.set_priorities([LOW] * 60 + [HIGH, SKIP, HIGH, NORMAL])
+        # The peer lacks piece 62
+        have = bits('1' * 62 + '01')
+        assert picker.pick(have) == 60
+        assert picker.pick(have) == 63
+        assert picker.pick(have) in range(60)
+
+
+@pytest.mark.parametrize('policy', [RAREST_FIRST, SEQUENTIAL])
+def test_picks_match_a_linear_scan(policy):
+    rand = random.Random(7)
+    number_of_pieces = 37
+    picker = PiecePicker(number_of_pieces, policy)
+    peers = []
+    for _ in range(300):
+        action = rand.random()
+        if action < 0.2 or not peers:
+            have = bits(''.join(rand.choice('01') for _ in range(number_of_pieces)))
+            peers.append(have)
+            picker.add_peer(have)
+        elif action < 0.3:
+            picker.remove_peer(peers.pop(rand.randrange(len(peers))))
+        elif action < 0.45:
+            have, index = rand.choice(peers), rand.randrange(number_of_pieces)
+            if not have[index]:
+                have[index] = True
+                picker.increment(index)
+        elif action < 0.55:
+            picker.set_priority(
+                rand.randrange(number_of_pieces), rand.choice([SKIP, LOW, NORMAL, HIGH]))
+        elif action < 0.65:
+            picker.release(rand.randrange(number_of_pieces))
+        elif action < 0.7:
+            picker.mark_done(rand.randrange(number_of_pieces))
+        else:
+            have = rand.choice(peers)
+            wanted = [
+                index for index in range(number_of_pieces)
+                if have[index] and picker.priorities[index] != SKIP and
+                not picker.is_done(index) and not picker._in_progress[index]
+            ]
+
+            def rank(index):
+                if policy == SEQUENTIAL:
+                    return -picker.priorities[index], index
+                return -picker.priorities[index], picker.availability[index], index
+            if not wanted:
+                with pytest.raises(NoPieceAvailable):
+                    picker.pick(have)
+            else:
+                assert picker.pick(have) == min(wanted, key=rank)
@@ -0,0 +1,100 @@
+from pipeline import RateMeter, RequestPipeline
+from tests.helpers import FakeClock
+from util import REQUEST_SIZE
+
+
+def test_rate_meter_is_unbiased_while_warming_up():
+    clock = FakeClock()
+    meter = RateMeter(time_constant=5.0, clock=clock)
+    for _ in range(10):
+        clock.now += 0.1
+        meter.add(1000)
+    assert 9000 < meter.rate < 11000
+
+
+def test_rate_meter_decays_when_idle():
+    clock = FakeClock()
+    meter = RateMeter(time_constant=1.0, clock=clock)
+    clock.now += 1
+    meter.add(1000)
+    rate = meter.rate
+    clock.now += 5
+    assert meter.rate < rate / 100
+
+
+def simulate(pipeline, clock, bandwidth, rtt, duration):
+    """
+    Keeps the pipeline full over a link with the given bandwidth
+    (bytes/s) and round trip time
+    """
+    deliveries = []
+    link_free = 0.0
+    block = 0
+    while clock.now < duration:
+        for _ in range(pipeline.room()):
+            block += 1
+            pipeline.on_request_sent(0, block, REQUEST_SIZE)
+            link_free = max(clock.now + rtt / 2, link_free) + REQUEST_SIZE / bandwidth
+            deliveries.append((link_free + rtt / 2, block))
+        clock.now, delivered = deliveries.pop(0)
+        pipeline.on_block_received(0, delivered, REQUEST_SIZE)
+
+
+def test_depth_follows_bandwidth_delay_product():
+    clock = FakeClock()
+    pipeline = RequestPipeline(clock=clock)
+    assert pipeline.room() == 4
+
+    # 10 MiB/s at 100ms is 64 blocks in flight
+    simulate(pipeline, clock, 10 * 2**20, 0.1, duration=10)
+    assert 64 <= pipeline.depth <= 3 * 64
+    assert pipeline.download_rate.rate > 9 * 2**20
+
+
+def test_depth_is_clamped():
+    clock = FakeClock()
+    pipeline = RequestPipeline(min_depth=2, max_depth=8, clock=clock)
+    simulate(pipeline, clock, 10 * 2**20, 0.1, duration=2)
+    assert pipeline.depth == 8
+
+
+def test_stats_and_unrequested_blocks():
+    clock = FakeClock()
+    pipeline = RequestPipeline(clock=clock)
+    pipeline.on_request_sent(1, 0, REQUEST_SIZE)
+    pipeline.on_request_sent(1, REQUEST_SIZE, REQUEST_SIZE)
+    clock.now += 0.05
+    assert pipeline.on_block_received(1, 0, REQUEST_SIZE)
+    assert not pipeline.on_block_received(2, 0, REQUEST_SIZE)
+
+    stats = pipeline.stats()
+    assert stats['inflight'] == 1
+    assert stats['rtt'] == stats['min_rtt'] == 0.05
+    assert pipeline.clear() == [(1, REQUEST_SIZE, REQUEST_SIZE)]
+
+
+def test_deadlines_follow_the_rate_and_queue():
+    clock = FakeClock()
+    pipeline = RequestPipeline(min_deadline=0.5, max_deadline=30, slack=2, clock=clock)
+    pipeline.on_request_sent(0, 0, REQUEST_SIZE)
+    # Nothing measured yet
+    assert pipeline.inflight[(0, 0)][2] == 30
+
+    # 1 MiB/s with a 0.1s RTT
+    simulate(pipeline, clock, 2**20, 0.1, duration=5)
+    pipeline.clear()
+    pipeline.on_request_sent(1, 0, REQUEST_SIZE)
+    for begin in range(REQUEST_SIZE, 64 * REQUEST_SIZE, REQUEST_SIZE):
+        pipeline.on_request_sent(1, begin, REQUEST_SIZE)
+    first = pipeline.inflight[(1, 0)][2] - clock.now
+    last = pipeline.inflight[(1, 63 * REQUEST_SIZE)][2] - clock.now
+    assert 0.5 <= first < 1
+    # 64 blocks queued ahead take about a second to come in
+    assert 2 < last < 4
+
+    assert pipeline.late() == []
+    clock.now += first + 0.01
+    late = pipeline.late()
+    assert late[0] == (1, 0, REQUEST_SIZE)
+    assert (1, 63 * REQUEST_SIZE, REQUEST_SIZE) not in late
+    assert pipeline.inflight_bytes == 64 * REQUEST_SIZE
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from ratelimit import TokenBucket
+from tests.helpers import FakeClock, make_torrent, run
+from torrio import Session
+
+
+def test_bucket_goes_into_debt_and_refills():
+    clock = FakeClock()
+    bucket = TokenBucket(1000, clock=clock)
+    assert bucket.consume(600) == 0
+    assert bucket.consume(600) == 0.2
+    clock.now += 0.1
+    assert abs(bucket.delay() - 0.1) < 1e-9
+    # Idle time refills no more than the burst
+    clock.now += 10
+    assert bucket.tokens <= 1000 and bucket.delay() == 0
+    assert bucket.consume(1000) == 0
+    assert bucket.consume(1) > 0
+
+
+def test_unlimited_buckets_never_wait():
+    bucket = TokenBucket(parent=TokenBucket())
+    assert bucket.consume(2**30) == 0
+
+
+def test_children_take_from_their_parents():
+    clock = FakeClock()
+    shared = TokenBucket(1000, clock=clock)
+    one = TokenBucket(parent=shared, clock=clock)
+    two = TokenBucket(800, parent=shared, clock=clock)
+    assert one.consume(500) == 0
+    # The tighter of the two is the parent's
+    assert two.consume(700) == 0.2
+    assert one.delay() == 0.2
+
+    shared.set_rate(None)
+    assert one.delay() == 0 and two.delay() == 0
+    assert two.consume(200) == 0.125
+
+
+def test_set_rate_wakes_waiters():
+    bucket = TokenBucket(100)
+
+    async def wait():
+        bucket.consume(1100)
+        waiting = asyncio.ensure_future(bucket.wait())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        started = time.monotonic()
+        bucket.set_rate(None)
+        await waiting
+        return time.monotonic() - started
+
+    assert run(asyncio.wait_for(wait(), 2)) < 0.5
+
+
+def test_session_upload_rate(tmp_path):
+    content = bytes(range(256)) * 512
+    torrent, _ = make_torrent(
+        tmp_path, [(None, content)], piece_length=2**14, announce=None)
+    (tmp_path / 'seed').mkdir()
+    (tmp_path / 'seed' / torrent.name).write_bytes(content)
+
+    async def swarm():
+        seeder = await Session(host='127.0.0.1', port=0, max_upload_rate=2**16).start()
+        leecher = await Session(host='127.0.0.1', port=0).start()
+        try:
+            seeder.add(torrent.path, str(tmp_path / 'seed'), seed=True)
+            while not seeder.torrents or not all(
+                    s.is_on_disk() for s in seeder.torrents.values()):
+                await asyncio.sleep(0.01)
+            started = time.monotonic()
+            await leecher.download(
+                torrent.path, str(tmp_path / 'leech'),
+                peers=[('127.0.0.1', seeder.port)])
+            return time.monotonic() - started
+        finally:
+            await leecher.close()
+            await seeder.close()
+
+    elapsed = run(asyncio.wait_for(swarm(), 10))
+    assert (tmp_path / 'leech' / torrent.name).read_bytes() == content
+    # The second 64KiB at 64KiB/s, after the first second's burst
+    assert elapsed > 0.5
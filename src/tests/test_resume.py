@@ -0,0 +1,82 @@
+import os
+
+from resume import ResumeData, recheck
+from storage import Storage
+from tests.helpers import make_torrent
+
+
+def setup_download(tmp_path, corrupt_piece=None):
+    content = bytes(range(256)) * 4
+    torrent, data = make_torrent(tmp_path, [
+        ([b'a'], content[:300]),
+        ([b'b'], content[300:]),
+    ], piece_length=64)
+    storage = Storage(str(tmp_path / 'out'), torrent)
+    storage.open()
+    if corrupt_piece is not None:
+        data = bytearray(data)
+        data[corrupt_piece * 64] ^= 0xff
+    storage.write(0, [data])
+    storage.close()
+    return torrent, storage
+
+
+def test_recheck_finds_valid_pieces_across_files(tmp_path):
+    torrent, storage = setup_download(tmp_path, corrupt_piece=4)
+    valid, stats = recheck(storage, torrent, workers=2)
+    assert list(valid) == [1, 1, 1, 1, 0] + [1] * 11
+    assert stats['pieces'] == 16
+    assert stats['valid'] == 15
+    assert stats['bytes'] == 1024
+
+
+def test_recheck_only_checks_given_pieces(tmp_path):
+    torrent, storage = setup_download(tmp_path)
+    only = bytearray(16)
+    only[3] = only[4] = 1
+    valid, stats = recheck(storage, torrent, pieces=only)
+    assert [i for i, v in enumerate(valid) if v] == [3, 4]
+    assert stats['pieces'] == 2
+
+
+def test_recheck_of_missing_files(tmp_path):
+    content = b'x' * 100
+    torrent, data = make_torrent(tmp_path, [(None, content)], piece_length=64)
+    storage = Storage(str(tmp_path / 'nothing-here'), torrent)
+    valid, _ = recheck(storage, torrent)
+    assert not any(valid)
+
+
+def test_resume_roundtrip(tmp_path):
+    torrent, storage = setup_download(tmp_path)
+    resume = ResumeData(str(tmp_path / 'r.resume'), torrent, storage)
+    assert resume.load() is None
+
+    pieces = bytearray([1, 0] * 8)
+    resume.save(pieces)
+    assert resume.load() == (pieces, False)
+    assert not os.path.exists(str(tmp_path / 'r.resume.tmp'))
+
+
+def test_resume_needs_check_after_files_change(tmp_path):
+    torrent, storage = setup_download(tmp_path)
+    resume = ResumeData(str(tmp_path / 'r.resume'), torrent, storage)
+    resume.save(bytearray(16))
+
+    path = storage.files[1].path
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert resume.load() == (bytearray(16), True)
+
+    with open(path, 'ab') as f:
+        f.write(b'!')
+    assert resume.load() is None
+
+
+def test_resume_data_of_another_torrent_is_ignored(tmp_path):
+    torrent, storage = setup_download(tmp_path)
+    other_dir = tmp_path / 'other'
+    other_dir.mkdir()
+    other, _ = make_torrent(other_dir, [(None, b'y' * 1024)], piece_length=64)
+    ResumeData(str(tmp_path / 'r.resume'), other, storage).save(bytearray(16))
+    assert ResumeData(str(tmp_path / 'r.resume'), torrent, storage).load() is None
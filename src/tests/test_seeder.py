@@ -0,0 +1,168 @@
+import asyncio
+from collections import deque
+
+from file_saver import FileSaver
+from messages import Request
+from pipeline import RateMeter
+from ratelimit import TokenBucket
+from tests.helpers import make_torrent, run
+from tests.test_choker import FakePeer
+from peer import Peer
+from seeder import PeerServer, ReadCache, UploadSlots, Uploader
+from torrio import DownloadSession
+
+
+class FakeSaver(object):
+    def __init__(self, torrent, data):
+        self.torrent = torrent
+        self.storage = self
+        self.data = data
+        self.reads = 0
+
+    def read(self, offset, length):
+        self.reads += 1
+        return self.data[offset:offset + length]
+
+    async def run_in_executor(self, func, *args):
+        return func(*args)
+
+
+def test_read_cache_serves_blocks_of_a_piece_from_one_read(tmp_path):
+    torrent, data = make_torrent(tmp_path, [(None, bytes(range(40)))])
+    saver = FakeSaver(torrent, data)
+    cache = ReadCache(saver, max_bytes=16)
+
+    async def read_all():
+        return [bytes(await cache.read(1, begin, 4)) for begin in (0, 4)]
+
+    assert run(read_all()) == [data[8:12], data[12:16]]
+    assert saver.reads == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_read_cache_evicts_least_recently_used(tmp_path):
+    torrent, data = make_torrent(tmp_path, [(None, bytes(range(40)))])
+    saver = FakeSaver(torrent, data)
+    cache = ReadCache(saver, max_bytes=16)
+
+    async def read(*pieces):
+        for idx in pieces:
+            await cache.read(idx, 0, 8)
+
+    run(read(0, 1, 0, 2))
+    assert list(cache._pieces) == [0, 2]
+    assert cache.size == 16
+
+    run(read(1))
+    assert saver.reads == 4
+
+
+def test_upload_slots_are_shared_between_uploaders():
+    slots = UploadSlots(2)
+    first = Uploader(None, max_upload_slots=4, slots=slots)
+    second = Uploader(None, max_upload_slots=4, slots=slots)
+    a, b, c = FakePeer('a'), FakePeer('b'), FakePeer('c')
+
+    async def disconnect_a():
+        first.on_peer_disconnected(a)
+        assert slots.used == 1
+        await asyncio.sleep(0)
+
+    first.on_interested(a)
+    first.on_interested(b)
+    second.on_interested(c)
+    assert (first.unchoked, second.unchoked) == ({a, b}, set())
+    assert c.am_choking
+
+    # The freed slot goes to the other torrent's waiting peer
+    run(disconnect_a())
+    assert second.unchoked == {c}
+    assert not c.am_choking
+    assert slots.used == 2
+
+
+class FakeWriter(object):
+    def __init__(self):
+        self.written = bytearray()
+
+    def write(self, data):
+        self.written += data
+
+    async def drain(self):
+        pass
+
+
+class UploadingPeer(object):
+    def __init__(self, requests):
+        self.upload_queue = deque(requests)
+        self.am_choking = False
+        self.upload_limit = TokenBucket()
+        self.upload_rate = RateMeter()
+        self.writer = FakeWriter()
+
+
+def test_blocks_of_files_not_on_disk_are_served_from_the_cache(tmp_path):
+    content = bytes(range(256)) * 3
+    torrent, _ = make_torrent(
+        tmp_path, [([b'a'], content[:300]), ([b'b'], content[300:])],
+        piece_length=64)
+    (tmp_path / 'seed' / 'pack').mkdir(parents=True)
+    (tmp_path / 'seed' / 'pack' / 'a').write_bytes(content[:300])
+
+    async def upload():
+        # b is skipped and was never created
+        saver = FileSaver(str(tmp_path / 'seed'), torrent, skip_files=[1])
+        await saver.opened
+        uploader = Uploader(saver, use_sendfile=True)
+        peer = UploadingPeer([Request(5, 0, 64)])
+        try:
+            await uploader.serve(peer)
+        finally:
+            uploader.close()
+            await saver.received_blocks_queue.put(None)
+            await saver.task
+        return uploader, peer
+
+    uploader, peer = run(asyncio.wait_for(upload(), 5))
+    assert uploader.uploaded == 64
+    assert peer.writer.written[13:] == bytes(64)
+
+
+def test_peer_downloads_from_peer_server(tmp_path):
+    content = bytes(range(256)) * 3
+    torrent, data = make_torrent(
+        tmp_path, [([b'a'], content[:300]), ([b'b'], content[300:])],
+        piece_length=64)
+    (tmp_path / 'seed' / 'pack').mkdir(parents=True)
+    (tmp_path / 'seed' / 'pack' / 'a').write_bytes(content[:300])
+    (tmp_path / 'seed' / 'pack' / 'b').write_bytes(content[300:])
+
+    async def swarm():
+        seed_saver = FileSaver(str(tmp_path / 'seed'), torrent)
+        seed_session = DownloadSession(
+            torrent, seed_saver.get_received_blocks_queue(),
+            uploader=Uploader(seed_saver))
+        seed_session.mark_pieces_done(bytearray(b'\x01' * torrent.number_of_pieces))
+        server = await PeerServer(seed_session, host='127.0.0.1', port=0).start()
+
+        saver = FileSaver(str(tmp_path / 'leech'), torrent)
+        session = DownloadSession(torrent, saver.get_received_blocks_queue())
+        peer = asyncio.ensure_future(
+            Peer(session, '127.0.0.1', server.port).download())
+        try:
+            while not all(saver.written_pieces):
+                await asyncio.sleep(0.01)
+        finally:
+            peer.cancel()
+            server.close()
+            await asyncio.gather(peer, return_exceptions=True)
+            await saver.received_blocks_queue.put(None)
+            await seed_saver.received_blocks_queue.put(None)
+            await asyncio.sleep(0.05)
+        return seed_session.uploader.uploaded, session
+
+    uploaded, session = run(asyncio.wait_for(swarm(), 10))
+    assert uploaded == len(data)
+    assert all(session.has_piece(idx) for idx in range(torrent.number_of_pieces))
+    assert (tmp_path / 'leech' / 'pack' / 'a').read_bytes() == content[:300]
+    assert (tmp_path / 'leech' / 'pack' / 'b').read_bytes() == content[300:]
@@ -0,0 +1,90 @@
+import asyncio
+
+from piece_picker import HIGH, SKIP
+from tests.helpers import make_torrent, run
+from torrio import Session
+
+
+def test_sessions_share_one_port_between_torrents(tmp_path):
+    torrents = []
+    for name in (b'one', b'two'):
+        directory = tmp_path / name.decode()
+        directory.mkdir()
+        content = bytes(range(256)) * (3 if name == b'one' else 5)
+        torrent, _ = make_torrent(
+            directory, [(None, content)], piece_length=64, name=name, announce=None)
+        (tmp_path / 'seed').mkdir(exist_ok=True)
+        (tmp_path / 'seed' / name.decode()).write_bytes(content)
+        torrents.append((torrent, content))
+
+    async def swarm():
+        seeder = await Session(host='127.0.0.1', port=0).start()
+        leecher = await Session(host='127.0.0.1', port=0, memory_budget=256).start()
+        try:
+            for torrent, _ in torrents:
+                seeder.add(torrent.path, str(tmp_path / 'seed'), seed=True)
+            while len(seeder.torrents) < 2 or not all(
+                    s.is_on_disk() for s in seeder.torrents.values()):
+                await asyncio.sleep(0.01)
+
+            sessions = await asyncio.gather(*[
+                leecher.download(
+                    torrent.path, str(tmp_path / 'leech'),
+                    peers=[('127.0.0.1', seeder.port)])
+                for torrent, _ in torrents
+            ])
+            return sessions, seeder.stats(), leecher.stats()
+        finally:
+            await leecher.close()
+            await seeder.close()
+
+    sessions, seeder_stats, leecher_stats = run(asyncio.wait_for(swarm(), 10))
+    assert all(session.is_on_disk() for session in sessions)
+    for torrent, content in torrents:
+        assert (tmp_path / 'leech' / torrent.name).read_bytes() == content
+    assert seeder_stats['torrents'] == 2
+    # Both torrents' buffers came out of a 256 byte budget and went back
+    assert leecher_stats['torrents'] == 0
+    assert leecher_stats['memory'] <= 256
+
+
+def test_skipped_files_are_not_downloaded(tmp_path):
+    files = [
+        ([b'a.bin'], bytes(range(20))),
+        ([b'b.bin'], bytes(range(100, 120))),
+        ([b'c.bin'], bytes(range(200, 224))),
+    ]
+    torrent, data = make_torrent(tmp_path, files, announce=None)
+    for path, content in files:
+        (tmp_path / 'seed' / 'pack').mkdir(parents=True, exist_ok=True)
+        (tmp_path / 'seed' / 'pack' / path[0].decode()).write_bytes(content)
+
+    async def swarm():
+        seeder = await Session(host='127.0.0.1', port=0).start()
+        leecher = await Session(host='127.0.0.1', port=0).start()
+        try:
+            seeder.add(torrent.path, str(tmp_path / 'seed'), seed=True)
+            while not seeder.torrents or not all(
+                    s.is_on_disk() for s in seeder.torrents.values()):
+                await asyncio.sleep(0.01)
+            session = await leecher.download(
+                torrent.path, str(tmp_path / 'leech'),
+                peers=[('127.0.0.1', seeder.port)],
+                file_priorities=[SKIP, HIGH, SKIP])
+            # Again from the resume data, with nobody to download from
+            resumed = await leecher.download(
+                torrent.path, str(tmp_path / 'leech'),
+                file_priorities=[SKIP, HIGH, SKIP])
+            return session, resumed
+        finally:
+            await leecher.close()
+            await seeder.close()
+
+    session, resumed = run(asyncio.wait_for(swarm(), 10))
+    # b.bin is pieces 2 to 4, piece 2 starts in a.bin
+    assert bytes(session.received_pieces) == bytes([0, 0, 1, 1, 1, 0, 0, 0])
+    assert bytes(resumed.received_pieces) == bytes(session.received_pieces)
+    out = tmp_path / 'leech' / 'pack'
+    assert (out / 'b.bin').read_bytes() == files[1][1]
+    assert (out / 'a.bin').read_bytes() == bytes(16) + files[0][1][16:]
+    assert not (out / 'c.bin').exists()
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from storage import Storage
+from tests.helpers import make_torrent
+
+
+def test_pieces_spanning_files_are_split(tmp_path):
+    torrent, data = make_torrent(tmp_path, [
+        ([b'a.bin'], b'0123456789'),
+        ([b'empty'], b''),
+        ([b'sub', b'b.bin'], b'abc'),
+        ([b'c.bin'], b'ABCDEFGH'),
+    ])
+    storage = Storage(str(tmp_path / 'out'), torrent)
+    storage.open()
+    try:
+        for offset in range(0, len(data), 8):
+            piece = data[offset:offset + 8]
+            # Written from separate block buffers
+            storage.write(offset, [piece[:3], memoryview(piece)[3:]])
+        assert storage.read(0, len(data)) == data
+    finally:
+        storage.close()
+
+    out = tmp_path / 'out' / 'pack'
+    assert (out / 'a.bin').read_bytes() == b'0123456789'
+    assert (out / 'empty').read_bytes() == b''
+    assert (out / 'sub' / 'b.bin').read_bytes() == b'abc'
+    assert (out / 'c.bin').read_bytes() == b'ABCDEFGH'
+
+
+def test_files_are_preallocated(tmp_path):
+    torrent, data = make_torrent(tmp_path, [(None, b'x' * 100)], name=b'single')
+    storage = Storage(str(tmp_path), torrent)
+    storage.open()
+    storage.close()
+    assert os.path.getsize(str(tmp_path / 'single')) == 100
+
+
+def test_skipped_files_are_created_only_when_written(tmp_path):
+    torrent, data = make_torrent(tmp_path, [
+        ([b'a.bin'], b'0123456789'),
+        ([b'b.bin'], b'abcdefghij'),
+    ])
+    storage = Storage(str(tmp_path / 'out'), torrent, skip_files=[0])
+    storage.open()
+    try:
+        out = tmp_path / 'out' / 'pack'
+        assert not (out / 'a.bin').exists()
+        assert os.path.getsize(str(out / 'b.bin')) == 10
+        assert storage.read(0, 12) == bytes(12)
+        # The piece spanning both files is wanted
+        storage.write(8, [data[8:16]])
+        assert storage.read(0, 20) == bytes(8) + data[8:16] + bytes(4)
+    finally:
+        storage.close()
+    # Sparse, up to what was written
+    assert (out / 'a.bin').read_bytes() == bytes(8) + b'89'
+
+
+def test_map_rejects_ranges_outside_the_torrent(tmp_path):
+    torrent, data = make_torrent(tmp_path, [(None, b'x' * 10)])
+    storage = Storage(str(tmp_path), torrent)
+    with pytest.raises(ValueError):
+        storage.map(5, 6)
+
+
+def test_path_traversal_is_rejected(tmp_path):
+    torrent, data = make_torrent(tmp_path, [
+        ([b'..', b'evil'], b'x'),
+        ([b'ok'], b'y'),
+    ])
+    with pytest.raises(ValueError):
+        Storage(str(tmp_path), torrent)
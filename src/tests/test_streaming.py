@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from piece_picker import HIGH, SKIP
+from streaming import RangeNotSatisfiable, parse_range
+from tests.helpers import make_torrent, run
+from torrio import Session
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range('bytes=10-19', 100) == (10, 19)
+    assert parse_range('bytes=90-', 100) == (90, 99)
+    assert parse_range('bytes=50-500', 100) == (50, 99)
+    assert parse_range('bytes=-10', 100) == (90, 99)
+    assert parse_range('bytes=0-0, 5-9', 100) == (0, 0)
+    assert parse_range('items=0-1', 100) is None
+    for header in ('bytes=100-', 'bytes=20-10'):
+        with pytest.raises(RangeNotSatisfiable):
+            parse_range(header, 100)
+
+
+async def get(url : str, headers : dict = None):
+    host, port = url.split('/')[2].split(':')
+    reader, writer = await asyncio.open_connection(host, int(port))
+    request = ['GET /{} HTTP/1.1'.format(url.split('/', 3)[3]), 'Host: x']
+    request += ['{}: {}'.format(name, value) for name, value in (headers or {}).items()]
+    writer.write(('\r\n'.join(request) + '\r\n\r\n').encode())
+    head = (await reader.readuntil(b'\r\n\r\n')).decode().split('\r\n')
+    body = await reader.read()
+    writer.close()
+    fields = dict(line.split(': ', 1) for line in head[1:] if line)
+    return head[0], fields, body
+
+
+def test_seek_is_served_before_the_download_finishes(tmp_path):
+    content = bytes(range(256)) * 1024
+    torrent, _ = make_torrent(
+        tmp_path, [(None, content)], piece_length=2**14, announce=None)
+    (tmp_path / 'seed').mkdir()
+    (tmp_path / 'seed' / torrent.name).write_bytes(content)
+
+    async def stream():
+        # 256KiB at 64KiB/s takes about 3 seconds
+        seeder = await Session(host='127.0.0.1', port=0, max_upload_rate=2**16).start()
+        leecher = await Session(host='127.0.0.1', port=0, stream_port=0).start()
+        try:
+            seeder.add(torrent.path, str(tmp_path / 'seed'), seed=True)
+            while not seeder.torrents or not all(
+                    s.is_on_disk() for s in seeder.torrents.values()):
+                await asyncio.sleep(0.01)
+            # Seeds once done, so the torrent stays up for the streams
+            downloading = leecher.add(
+                torrent.path, str(tmp_path / 'leech'),
+                peers=[('127.0.0.1', seeder.port)], seed=True)
+            while torrent.info_hash not in leecher.torrents:
+                await asyncio.sleep(0.01)
+            session = leecher.torrents[torrent.info_hash]
+            url = leecher.stream_url(torrent.info_hash)
+
+            # Streams as the pieces come in
+            whole = asyncio.ensure_future(get(url + '/pack'))
+            response = await get(url, {'Range': 'bytes=200000-200099'})
+            received = bytes(session.received_pieces)
+            assert not session.is_on_disk()
+            missing = await get(url[:-1] + '1')
+            whole = await whole
+            downloading.cancel()
+            return response, received, whole, missing
+        finally:
+            await leecher.close()
+            await seeder.close()
+
+    partial, received, whole, missing = run(asyncio.wait_for(stream(), 20))
+    status, headers, body = partial
+    assert status == 'HTTP/1.1 206 Partial Content'
+    assert headers['Content-Range'] == 'bytes 200000-200099/262144'
+    assert body == content[200000:200100]
+    # Its piece went ahead of some of the 12 before it, which rarest-first
+    # alone picks in index order from a single seeder
+    assert received[12]
+    assert not all(received[:12])
+
+    status, headers, body = whole
+    assert status == 'HTTP/1.1 200 OK' and headers['Accept-Ranges'] == 'bytes'
+    assert body == content
+    assert missing[0] == 'HTTP/1.1 404 Not Found'
+
+
+def test_skipped_files_are_downloaded_when_streamed(tmp_path):
+    files = [
+        ([b'a.bin'], bytes(range(256)) * 64),
+        ([b'b.bin'], bytes(range(255, -1, -1)) * 64),
+    ]
+    torrent, _ = make_torrent(tmp_path, files, piece_length=2**14, announce=None)
+    for path, content in files:
+        (tmp_path / 'seed' / 'pack').mkdir(parents=True, exist_ok=True)
+        (tmp_path / 'seed' / 'pack' / path[0].decode()).write_bytes(content)
+
+    async def stream():
+        seeder = await Session(host='127.0.0.1', port=0).start()
+        leecher = await Session(host='127.0.0.1', port=0, stream_port=0).start()
+        try:
+            seeder.add(torrent.path, str(tmp_path / 'seed'), seed=True)
+            while not seeder.torrents or not all(
+                    s.is_on_disk() for s in seeder.torrents.values()):
+                await asyncio.sleep(0.01)
+            downloading = leecher.add(
+                torrent.path, str(tmp_path / 'leech'),
+                peers=[('127.0.0.1', seeder.port)], seed=True,
+                file_priorities=[HIGH, SKIP])
+            while torrent.info_hash not in leecher.torrents:
+                await asyncio.sleep(0.01)
+            session = leecher.torrents[torrent.info_hash]
+            await session.wait_on_disk()
+            response = await get(
+                leecher.stream_url(torrent.info_hash, 1), {'Range': 'bytes=100-199'})
+            downloading.cancel()
+            return response
+        finally:
+            await leecher.close()
+            await seeder.close()
+
+    status, _, body = run(asyncio.wait_for(stream(), 10))
+    assert status == 'HTTP/1.1 206 Partial Content'
+    assert body == files[1][1][100:200]
@@ -0,0 +1,219 @@
+import asyncio
+import struct
+from urllib import parse as urlparse
+
+import bencoder
+
+from tests.helpers import make_torrent, run
+from tracker import (
+    DEFAULT_INTERVAL, EVENT_STARTED, EVENT_STOPPED, MIN_ANNOUNCE_INTERVAL,
+    Tracker, TrackerError, UDPTracker
+)
+
+PEERS = [('10.0.0.1', 6881), ('10.0.0.2', 51413)]
+COMPACT_PEERS = b'\x0a\x00\x00\x01\x1a\xe1\x0a\x00\x00\x02\xc8\xd5'
+
+
+class StandInHTTPTracker(object):
+    """
+    Answers every announce with `response` and records the query strings
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.announces = []
+        self.connections = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = 'http://127.0.0.1:{}/announce'.format(port)
+        return self
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                path = request.split(b' ')[1].decode()
+                self.announces.append(
+                    urlparse.parse_qs(urlparse.urlsplit(path).query))
+                body = bencoder.encode(self.response)
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\nContent-Length: ' +
+                    str(len(body)).encode() + b'\r\n\r\n' + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+class StandInUDPTracker(asyncio.DatagramProtocol):
+    """
+    BEP 15 tracker that drops the first `drop` datagrams it gets
+    """
+    CONNECTION_ID = 0x1122334455667788
+
+    def __init__(self, drop=0):
+        self.drop = drop
+        self.announces = []
+        self.transport = None
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=('127.0.0.1', 0))
+        port = self.transport.get_extra_info('sockname')[1]
+        self.url = 'udp://127.0.0.1:{}/announce'.format(port)
+        return self
+
+    def datagram_received(self, data, addr):
+        if self.drop:
+            self.drop -= 1
+            return
+        connection_id, action, transaction_id = struct.unpack_from('>QII', data)
+        if action == 0:
+            assert connection_id == UDPTracker.PROTOCOL_ID
+            self.transport.sendto(
+                struct.pack('>IIQ', 0, transaction_id, self.CONNECTION_ID), addr)
+        elif action == 1:
+            assert connection_id == self.CONNECTION_ID
+            fields = struct.unpack_from('>20s20sQQQIIIiH', data, 16)
+            self.announces.append(dict(zip(
+                ('info_hash', 'peer_id', 'downloaded', 'left', 'uploaded',
+                 'event', 'ip', 'key', 'numwant', 'port'),
+                fields
+            )))
+            self.transport.sendto(
+                struct.pack('>IIIII', 1, transaction_id, 900, 3, 7) + COMPACT_PEERS,
+                addr)
+
+    def close(self):
+        self.transport.close()
+
+
+def make_tracker_torrent(tmp_path, tiers):
+    torrent, _ = make_torrent(tmp_path, [(None, b'x' * 40)])
+    torrent.info[b'announce'] = tiers[0][0].encode()
+    torrent.info[b'announce-list'] = [[url.encode() for url in tier] for tier in tiers]
+    return torrent
+
+
+def stats():
+    return {'uploaded': 123, 'downloaded': 456, 'left': 7}
+
+
+def test_http_announce_reports_stats_and_reuses_connections(tmp_path):
+    async def scenario():
+        stand_in = await StandInHTTPTracker({
+            b'interval': 900, b'min interval': 1200, b'peers': COMPACT_PEERS,
+        }).start()
+        tracker = Tracker(make_tracker_torrent(tmp_path, [[stand_in.url]]), stats=stats)
+        try:
+            peers = await tracker.get_peers()
+            await tracker.announce()
+        finally:
+            await tracker.close()
+            stand_in.close()
+        return tracker, peers, stand_in
+
+    tracker, peers, stand_in = run(scenario())
+    assert peers == PEERS
+    # A min interval longer than the interval is ignored
+    assert tracker.next_interval == 900
+    first, second = stand_in.announces
+    assert first['event'] == [EVENT_STARTED]
+    assert 'event' not in second
+    assert (first['uploaded'], first['downloaded'], first['left']) == (['123'], ['456'], ['7'])
+    assert stand_in.connections == 1
+
+
+def test_intervals_are_clamped(tmp_path):
+    tracker = Tracker(make_tracker_torrent(tmp_path, [['http://tracker']]))
+    tracker._on_response({b'interval': 0, b'min interval': 30, b'peers': b''})
+    assert tracker.interval == MIN_ANNOUNCE_INTERVAL
+    assert tracker.next_interval == MIN_ANNOUNCE_INTERVAL
+    # Malformed intervals fall back to the defaults
+    tracker._on_response({b'interval': b'soon', b'min interval': [], b'peers': b''})
+    assert tracker.interval == DEFAULT_INTERVAL
+    assert tracker.min_interval == 0
+
+
+def test_http_failure_reason_is_an_error(tmp_path):
+    async def scenario():
+        stand_in = await StandInHTTPTracker({b'failure reason': b'go away'}).start()
+        tracker = Tracker(make_tracker_torrent(tmp_path, [[stand_in.url]]))
+        try:
+            await tracker.announce()
+        except TrackerError as e:
+            return str(e)
+        finally:
+            await tracker.close()
+            stand_in.close()
+
+    assert 'go away' in run(scenario())
+
+
+def test_udp_announce_retries_lost_datagrams(tmp_path):
+    async def scenario():
+        stand_in = await StandInUDPTracker(drop=1).start()
+        tracker = Tracker(
+            make_tracker_torrent(tmp_path, [[stand_in.url]]), stats=stats,
+            udp_timeout=0.05)
+        try:
+            peers = await tracker.announce(EVENT_STARTED)
+        finally:
+            await tracker.close()
+            stand_in.close()
+        return tracker, peers, stand_in
+
+    tracker, peers, stand_in = run(scenario())
+    assert peers == PEERS
+    assert tracker.interval == 900
+    announce, = stand_in.announces
+    assert (announce['uploaded'], announce['downloaded'], announce['left']) == (123, 456, 7)
+    assert announce['event'] == 2
+    assert announce['numwant'] == 50
+
+
+def test_next_tier_is_tried_when_a_tier_fails(tmp_path):
+    async def scenario():
+        dead = await StandInUDPTracker(drop=100).start()
+        stand_in = await StandInHTTPTracker({b'interval': 60, b'peers': COMPACT_PEERS}).start()
+        tracker = Tracker(
+            make_tracker_torrent(tmp_path, [[dead.url], [stand_in.url]]),
+            udp_timeout=0.01, udp_retries=1)
+        try:
+            peers = await tracker.announce()
+        finally:
+            await tracker.close()
+            dead.close()
+            stand_in.close()
+        return peers
+
+    assert run(scenario()) == PEERS
+
+
+def test_run_reannounces_and_stops(tmp_path):
+    async def scenario():
+        stand_in = await StandInHTTPTracker({b'interval': 0, b'peers': COMPACT_PEERS}).start()
+        tracker = Tracker(
+            make_tracker_torrent(tmp_path, [[stand_in.url]]), min_announce_interval=0)
+        received = []
+        task = asyncio.ensure_future(tracker.run(received.append))
+        while len(received) < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await tracker.close()
+        stand_in.close()
+        return received, stand_in.announces
+
+    received, announces = run(scenario())
+    assert received[0] == PEERS
+    assert announces[0]['event'] == [EVENT_STARTED]
+    assert 'event' not in announces[1]
+    assert announces[-1]['event'] == [EVENT_STOPPED]
@@ -1,42 +1,126 @@
 import copy
 import hashlib
+import math
 from pprint import pformat
 
-import bencoder
+import bencode
+
+# Strings at least this long (the piece hashes) are left as views into
+# the file's bytes instead of being copied out
+LAZY_STRING_SIZE = 4096
 
 
 class Torrent(object):
     def __init__(self, path : str):
         self.path = path
         self.info = self.read_torrent_file(path)
+        self._size = None
 
     def __getitem__(self, item):
         return self.info[item]
 
     def get_piece_hash(self, piece_idx):
-        return self.info[b'info'][b'pieces'][piece_idx*20: (piece_idx*20) + 20]
+        return bytes(self.info[b'info'][b'pieces'][piece_idx*20: (piece_idx*20) + 20])
 
     @property
     def announce_url(self) -> str:
+        """
+        None for trackerless torrents, e.g. from a magnet link without
+        trackers
+        """
+        if b'announce' not in self.info:
+            return None
         return self.info[b'announce'].decode('utf-8')
 
     @property
-    def info_hash(self):
-        return hashlib.sha1(
-            bencoder.encode(self.info[b'info'])
-        ).digest()
+    def announce_list(self) -> list:
+        """
+        Tiers of tracker URLs (BEP 12), just `announce` when the torrent
+        has no announce-list
+        """
+        tiers = [
+            [url.decode('utf-8') for url in tier]
+            for tier in self.info.get(b'announce-list', [])
+        ]
+        tiers = [tier for tier in tiers if tier]
+        if not tiers and b'announce' in self.info:
+            tiers = [[self.announce_url]]
+        return tiers
+
+    @property
+    def is_private(self) -> bool:
+        """
+        Private torrents (BEP 27) only get peers from their trackers
+        """
+        return self.info[b'info'].get(b'private') == 1
+
+    @property
+    def info_hash(self) -> bytes:
+        """
+        SHA-1 of the info dict exactly as it is encoded in the file,
+        computed once
+        """
+        return self._info_hash
 
     @property
     def size(self):
+        if self._size is None:
+            info = self.info[b'info']
+            if b'length' in info:
+                self._size = int(info[b'length'])
+            else:
+                self._size = sum([int(f[b'length']) for f in info[b'files']])
+        return self._size
+
+    @property
+    def name(self) -> str:
+        return self.info[b'info'][b'name'].decode('utf-8')
+
+    @property
+    def files(self) -> list:
+        """
+        List of (path components, length) in the order the files are laid
+        out in the torrent. Single file torrents have one entry with an
+        empty path.
+        """
         info = self.info[b'info']
         if b'length' in info:
-            return int(info[b'length'])
-        else:
-            return sum([int(f[b'length']) for f in info[b'files']])
+            return [((), int(info[b'length']))]
+        return [
+            (tuple(p.decode('utf-8') for p in f[b'path']), int(f[b'length']))
+            for f in info[b'files']
+        ]
+
+    @property
+    def piece_length(self) -> int:
+        return int(self.info[b'info'][b'piece length'])
+
+    @property
+    def number_of_pieces(self) -> int:
+        return math.ceil(self.size / self.piece_length)
+
+    def get_piece_length(self, piece_idx : int) -> int:
+        """
+        Length of piece 'piece_idx', only the last piece can be shorter
+        """
+        return min(
+            self.piece_length,
+            self.size - piece_idx * self.piece_length
+        )
 
     def read_torrent_file(self, path : str) -> dict:
         with open(path, 'rb') as f:
-            return bencoder.decode(f.read())
+            raw = f.read()
+        info, spans = bencode.decode_with_spans(
+            raw, span_keys=(b'info',), lazy_threshold=LAZY_STRING_SIZE)
+        if not isinstance(info, dict) or b'info' not in spans:
+            raise bencode.BencodeError('{} has no info dict'.format(path))
+        start, end = spans[b'info']
+        # The info dict as encoded in the file, served to magnet link
+        # peers as the torrent's metadata
+        self.info_bytes = memoryview(raw)[start:end]
+        self._info_hash = hashlib.sha1(self.info_bytes).digest()
+        return info
 
     def __str__(self):
         # info = copy.deepcopy(self.info)
@@ -3,15 +3,55 @@ import bitstring
 import hashlib
 import logging
 import math
+import os
 import sys
-from typing import Dict, List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set
 from pprint import pformat
 
+from buffer_pool import BufferPool, MemoryBudget, NoBufferAvailable
+from choker import Choker
+from connections import ConnectionLimits, ConnectionManager
+from dht import BOOTSTRAP_NODES, DHTNode
 from file_saver import FileSaver
+from hasher import PieceHasher
+from magnet import Magnet, MagnetError, is_magnet
+from messages import Cancel, Have, Request
+from metadata import MetadataCache, MetadataFetcher
+from metrics import REGISTRY, MetricsServer, dump_metrics
 from peer import Peer
+from pex import PeerExchange
+from resume import ResumeData, recheck
+from seeder import PeerServer, UploadSlots, Uploader
+from streaming import StreamServer
+from piece_picker import LOW, NoPieceAvailable, PiecePicker, RAREST_FIRST, SKIP
+from ratelimit import TokenBucket
 from torrent import Torrent
-from tracker import Tracker
-from util import LOG, REQUEST_SIZE
+from tracker import Tracker, TrackerError
+from util import (
+    DHT_STATE_FILE, LISTEN_PORT, LOG, METADATA_CACHE_DIR, METRICS_PORT, REQUEST_SIZE
+)
+
+# Memory for pieces in progress and pieces waiting to be written
+DEFAULT_MEMORY_BUDGET = 2**28
+# Requests are given to another peer when unanswered for this long
+REQUEST_TIMEOUT = 60
+# In endgame a block is requested from at most this many peers at once
+ENDGAME_DUPLICATES = 3
+
+PIECES_VERIFIED = REGISTRY.counter(
+    'battorrent_pieces_verified_total', 'Downloaded pieces hashed', ('result',))
+PIECE_SECONDS = REGISTRY.histogram(
+    'battorrent_piece_seconds',
+    'Time from picking a piece to it passing its hash check')
+WASTED_BYTES = REGISTRY.counter(
+    'battorrent_wasted_bytes_total',
+    'Bytes of blocks that had already come in from another peer')
+PIECES_IN_PROGRESS = REGISTRY.gauge(
+    'battorrent_pieces_in_progress', 'Pieces being downloaded or verified')
+PEERS_CONNECTED = REGISTRY.gauge(
+    'battorrent_peers_connected', 'Connected peers of every torrent')
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,40 +61,74 @@ logging.basicConfig(
 
 
 class Piece(object):
+    """
+    A piece that is being downloaded. These only exist for pieces in
+    progress, see PieceList. Blocks are copied into 'buffer', a piece
+    sized buffer from the session's BufferPool. 'requested' counts the
+    requests outstanding for every block.
+    """
+    __slots__ = (
+        'index', 'blocks', 'length', 'downloaded_blocks', 'requested',
+        'received', 'buffer', 'started'
+    )
+
     def __init__(self, index : int, blocks : list):
         self.index : int = index
         self.blocks : list = blocks
-        self.downloaded_blocks : bitstring.BitArray = \
-            bitstring.BitArray(bin='0'*len(blocks))
+        self.length : int = sum(block.length for block in blocks)
+        self.downloaded_blocks : bytearray = bytearray(len(blocks))
+        self.requested : bytearray = bytearray(len(blocks))
+        self.received : int = 0
+        self.buffer : bytearray = None
+        # When the piece was picked, for the completion time metric
+        self.started : float = None
 
     def flush(self):
-        [block.flush() for block in self.blocks]
+        self.downloaded_blocks = bytearray(len(self.blocks))
+        self.requested = bytearray(len(self.blocks))
+        self.received = 0
 
     def is_complete(self) -> bool:
         """
         Return True if all the Blocks in this piece exist
         """
-        return all(self.downloaded_blocks)
+        return self.received == len(self.blocks)
 
-    def save_block(self, begin : int, data : bytes):
+    def save_block(self, begin : int, data : memoryview) -> bool:
         """
-        Writes block 'data' into block object
+        Copies block 'data' into the piece buffer. This is the only copy
+        a block goes through between the socket and the disk. Returns
+        False for blocks that don't belong to this piece.
         """
-        for block_idx, block in enumerate(self.blocks):
-            if block.begin == begin:
-                block.data = data
-                self.downloaded_blocks[block_idx] = True
+        block_idx = begin // REQUEST_SIZE
+        if block_idx >= len(self.blocks):
+            return False
+        block = self.blocks[block_idx]
+        if block.begin != begin or block.length != len(data):
+            return False
+        self.buffer[begin:begin + block.length] = data
+        if not self.downloaded_blocks[block_idx]:
+            self.downloaded_blocks[block_idx] = 1
+            self.received += 1
+        return True
+
+    @property
+    def view(self) -> memoryview:
+        """
+        The piece data in its buffer, without copying it
+        """
+        return memoryview(self.buffer)[:self.length]
 
     @property
     def data(self) -> bytes:
         """
         Returns Piece data
         """
-        return b''.join([block.data for block in self.blocks])
+        return bytes(self.view)
 
     @property
     def hash(self):
-        return hashlib.sha1(self.data)
+        return hashlib.sha1(self.view)
 
     def __repr__(self):
         return '<Piece: {} Blocks: {}>'.format(
@@ -64,14 +138,12 @@ class Piece(object):
 
 
 class Block(object):
+    __slots__ = ('piece', 'begin', 'length')
+
     def __init__(self, piece, begin, length):
         self.piece = piece
         self.begin = begin
         self.length = length
-        self.data = None
-
-    def flush(self):
-        self.data = None
 
     def __repr__(self):
         return '[Block ({}, {}, {})]'.format(
@@ -81,100 +153,665 @@ class Block(object):
         )
 
 
-# TODO: check if file isn't already downloaded
+class PieceList(object):
+    """
+    Sequence of all the pieces of a torrent. Piece and Block objects are
+    derived from the piece index when accessed instead of being kept for
+    the whole torrent, so a 100 GB torrent doesn't start out with millions
+    of objects. Holding on to the pieces that are in progress is up to
+    the caller.
+    """
+
+    def __init__(self, torrent : Torrent):
+        self.torrent = torrent
+        self.number_of_pieces = torrent.number_of_pieces
+
+    def __len__(self):
+        return self.number_of_pieces
+
+    def __iter__(self):
+        for piece_idx in range(self.number_of_pieces):
+            yield self.make_piece(piece_idx)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [
+                self.make_piece(piece_idx)
+                for piece_idx in range(*item.indices(self.number_of_pieces))
+            ]
+        if item < 0:
+            item += self.number_of_pieces
+        if not 0 <= item < self.number_of_pieces:
+            raise IndexError('Piece index out of range: {}'.format(item))
+        return self.make_piece(item)
+
+    def make_piece(self, piece_idx : int) -> Piece:
+        piece_length = self.torrent.get_piece_length(piece_idx)
+        blocks = [
+            Block(
+                piece_idx,
+                begin,
+                min(REQUEST_SIZE, piece_length - begin)
+            )
+            for begin in range(0, piece_length, REQUEST_SIZE)
+        ]
+        return Piece(piece_idx, blocks)
+
+
+def _pieces_in_progress(session) -> int:
+    return len(session.pieces_in_progress)
+
+
+def _peers_connected(session) -> int:
+    return len(session.peers)
+
+
 class DownloadSession(object):
     def __init__(
-            self, torrent : Torrent, received_blocks : asyncio.Queue = None):
+            self, torrent : Torrent, received_blocks : asyncio.Queue = None,
+            picker_policy : str = RAREST_FIRST, hasher : PieceHasher = None,
+            memory_budget : int = DEFAULT_MEMORY_BUDGET, uploader : Uploader = None,
+            shared_memory : MemoryBudget = None,
+            download_limit : TokenBucket = None, upload_limit : TokenBucket = None,
+            peer_download_rate : float = None, peer_upload_rate : float = None):
         self.torrent : Torrent = torrent
-        self.piece_size : int = self.torrent[b'info'][b'piece length']
-        self.number_of_pieces : int = math.ceil(
-            self.torrent[b'info'][b'length'] / self.piece_size)
-        self.pieces : list = self.get_pieces()
+        self.piece_size : int = self.torrent.piece_length
+        self.number_of_pieces : int = self.torrent.number_of_pieces
+        self.pieces : PieceList = self.get_pieces()
         self.pieces_in_progress : Dict[int, Piece] = {}
-        self.received_pieces : Dict[int, Piece]= {}
+        # Pieces in progress with blocks nobody has been asked for
+        self.partial_pieces : Dict[int, Piece] = {}
+        # (piece index, begin) -> peers the block is requested from
+        self.requests : Dict[tuple, list] = {}
+        self.request_timeout : float = REQUEST_TIMEOUT
+        # Blocks whose every request is past its deadline, other peers
+        # with room may request them too
+        self.late_requests : Dict[tuple, None] = {}
+        # 1 for every piece that has been verified
+        self.received_pieces : bytearray = bytearray(self.number_of_pieces)
         self.received_blocks : asyncio.Queue = received_blocks
+        self.picker : PiecePicker = PiecePicker(
+            self.number_of_pieces, picker_policy)
+        self.hasher : PieceHasher = hasher or PieceHasher()
+        # Pieces whose blocks are all in and are waiting for their hash
+        self.pieces_verifying : Set[int] = set()
+        self.verify_tasks : Set[asyncio.Future] = set()
+        # Counters reported to the tracker
+        self.downloaded = 0
+        # Duplicate blocks, e.g. from endgame, which `downloaded` leaves out
+        self.wasted = 0
+        self.bytes_left = torrent.size
+        self.buffer_pool : BufferPool = BufferPool(
+            self.piece_size, memory_budget, shared=shared_memory)
+        self.uploader : Uploader = uploader
+        self.peers : Set[Peer] = set()
+        # Pieces on disk that we can upload, in wire format
+        self.have_bitfield : bytearray = bytearray(
+            math.ceil(self.number_of_pieces / 8))
+        self.pieces_on_disk = 0
+        self._on_disk_waiters : list = []
+        # piece index -> futures waiting for it to be on disk
+        self._piece_waiters : Dict[int, list] = {}
+        PIECES_IN_PROGRESS.track(self, _pieces_in_progress)
+        PEERS_CONNECTED.track(self, _peers_connected)
+        # Bandwidth limits of the torrent in bytes per second, its peers'
+        # limits take from these
+        self.download_limit : TokenBucket = download_limit or TokenBucket()
+        self.upload_limit : TokenBucket = upload_limit or TokenBucket()
+        self.peer_download_rate = peer_download_rate
+        self.peer_upload_rate = peer_upload_rate
+        # Peer exchange, off for private torrents
+        self.pex : PeerExchange = None
 
-    def on_block_received(self, piece_idx, begin, data):
+    def mark_pieces_done(self, pieces : bytearray):
+        """
+        Marks pieces that are already on disk from an earlier run
         """
-        TODO: implement writing off downloaded piece
-        1. Removes piece from self.pieces
-        2. Verifies piece hash
-        3. Sets self.have_pieces[piece.index] = True if hash is valid
-        4. Else re-inserts piece into self.pieces
+        for piece_idx, is_done in enumerate(pieces):
+            if is_done:
+                self.received_pieces[piece_idx] = 1
+                self.picker.mark_done(piece_idx)
+                self.bytes_left -= self.torrent.get_piece_length(piece_idx)
+                self.have_bitfield[piece_idx >> 3] |= 0x80 >> (piece_idx & 7)
+                self.pieces_on_disk += 1
 
-        :return:  None
+    def is_complete(self) -> bool:
+        """
+        Every wanted piece is verified
         """
+        return not len(self.picker)
 
-        piece = self.pieces[piece_idx]
-        piece.save_block(begin, data)
+    def set_file_priorities(self, priorities : list):
+        """
+        Sets the priority of every file of the torrent, see piece_picker's
+        SKIP to HIGH. A piece gets the highest priority of the files it
+        overlaps, so one spanning a skipped file and a wanted one is still
+        downloaded. Pieces in progress that are now skipped are given up.
+        """
+        files = self.torrent.files
+        if len(priorities) != len(files):
+            raise ValueError('{} priorities for {} files'.format(
+                len(priorities), len(files)))
+        piece_priorities = bytearray(self.number_of_pieces)
+        offset = 0
+        for (_, length), priority in zip(files, priorities):
+            if length:
+                first = offset // self.piece_size
+                last = (offset + length - 1) // self.piece_size
+                for piece_idx in range(first, last + 1):
+                    if priority > piece_priorities[piece_idx]:
+                        piece_priorities[piece_idx] = priority
+            offset += length
+        self.picker.set_priorities(piece_priorities)
+
+        for piece in list(self.pieces_in_progress.values()):
+            if (piece_priorities[piece.index] == SKIP and
+                    piece.index not in self.pieces_verifying):
+                for block in piece.blocks:
+                    for peer in self.requests.get((piece.index, block.begin), ()):
+                        peer.cancel_request(piece.index, block.begin, block.length)
+                self.release_piece(piece)
+        if self.uploader is not None:
+            self.uploader.file_saver.storage.set_skipped(
+                file_idx for file_idx, priority in enumerate(priorities)
+                if priority == SKIP)
+        if self.is_on_disk():
+            self._wake_on_disk_waiters()
+        self.wake_peers()
+
+    def set_peer_rates(self, download : float = None, upload : float = None):
+        """
+        Changes the limit of each peer, None lifts it
+        """
+        self.peer_download_rate = download
+        self.peer_upload_rate = upload
+        for peer in self.peers:
+            peer.download_limit.set_rate(download)
+            peer.upload_limit.set_rate(upload)
+
+    def is_on_disk(self) -> bool:
+        """
+        Every wanted piece is verified and written
+        """
+        return self.is_complete() and self.pieces_on_disk == self.picker.completed
+
+    async def wait_on_disk(self):
+        while not self.is_on_disk():
+            waiter = asyncio.get_event_loop().create_future()
+            self._on_disk_waiters.append(waiter)
+            await waiter
+
+    async def wait_for_piece(self, piece_idx : int):
+        """
+        Waits until the piece is verified and on disk
+        """
+        while not self.has_piece(piece_idx):
+            waiter = asyncio.get_event_loop().create_future()
+            self._piece_waiters.setdefault(piece_idx, []).append(waiter)
+            await waiter
+
+    def cancel_waiters(self):
+        """
+        The download is stopping, whoever waits for pieces gives up
+        """
+        waiters = self._on_disk_waiters
+        for piece_waiters in self._piece_waiters.values():
+            waiters += piece_waiters
+        self._on_disk_waiters, self._piece_waiters = [], {}
+        for waiter in waiters:
+            waiter.cancel()
+
+    async def cancel_verifications(self):
+        """
+        Cancels the pieces being verified and waits for them to be given
+        up, so none is handed to the disk or the hasher afterwards
+        """
+        tasks = list(self.verify_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def set_piece_deadline(self, piece_idx : int, deadline : float = None):
+        """
+        Makes a piece time critical: it's requested before any other piece
+        without a deadline, earliest deadline first, and once the deadline
+        (time.monotonic) has passed its blocks are requested from several
+        peers like in endgame. None makes it a normal piece again. A
+        skipped piece is wanted after all, its priority goes up to LOW.
+        """
+        if self.received_pieces[piece_idx]:
+            return
+        if deadline is not None and self.picker.priorities[piece_idx] == SKIP:
+            self.picker.set_priority(piece_idx, LOW)
+        self.picker.set_deadline(piece_idx, deadline)
+        if deadline is not None:
+            self.wake_peers()
+
+    def transfer_stats(self) -> dict:
+        """
+        What we report to the tracker
+        """
+        return {
+            'uploaded': self.uploader.uploaded if self.uploader is not None else 0,
+            'downloaded': self.downloaded,
+            'left': self.bytes_left,
+        }
+
+    def has_piece(self, piece_idx : int) -> bool:
+        """
+        Whether the piece is on disk and can be uploaded
+        """
+        return bool(self.have_bitfield[piece_idx >> 3] & (0x80 >> (piece_idx & 7)))
+
+    def get_bitfield(self):
+        """
+        The BITFIELD to send to new peers, None while we have nothing
+        """
+        if not any(self.have_bitfield):
+            return None
+        return bytes(self.have_bitfield)
+
+    def on_peer_connected(self, peer : Peer):
+        self.peers.add(peer)
+
+    def on_peer_disconnected(self, peer : Peer):
+        self.peers.discard(peer)
+        self.on_requests_cancelled(peer, peer.pipeline.clear())
+        self.forget_peer_pieces(peer.have_pieces)
+        if self.uploader is not None:
+            self.uploader.on_peer_disconnected(peer)
+
+    def on_peer_exchange(self, peer : Peer, data : bytes):
+        if self.pex is not None:
+            self.pex.on_message(peer, data)
+
+    def on_peer_bitfield(self, have_pieces : bitstring.BitArray):
+        self.picker.add_peer(have_pieces)
+
+    def on_peer_have(self, piece_idx : int):
+        self.picker.increment(piece_idx)
+
+    def forget_peer_pieces(self, have_pieces : bitstring.BitArray):
+        self.picker.remove_peer(have_pieces)
+
+    def on_peer_interested(self, peer : Peer):
+        if self.uploader is not None:
+            self.uploader.on_interested(peer)
+
+    def on_peer_not_interested(self, peer : Peer):
+        if self.uploader is not None:
+            self.uploader.on_not_interested(peer)
+
+    def on_peer_request(self, peer : Peer, request : Request):
+        if self.uploader is not None:
+            self.uploader.on_request(peer, request)
+
+    def on_peer_cancel(self, peer : Peer, cancel : Cancel):
+        if self.uploader is not None:
+            self.uploader.on_cancel(peer, cancel)
+
+    def on_block_received(self, piece_idx, begin, data, peer : Peer = None):
+        """
+        Stores a block of a piece in progress and schedules the piece for
+        verification once all its blocks are in. Blocks of pieces we
+        didn't ask for are dropped. In endgame the block is cancelled with
+        the other peers it was requested from.
+        """
+        piece = self.pieces_in_progress.get(piece_idx)
+        if piece is None or piece_idx in self.pieces_verifying:
+            return
+
+        block_idx = begin // REQUEST_SIZE
+        duplicate = (
+            block_idx < len(piece.blocks) and piece.downloaded_blocks[block_idx])
+        if not piece.save_block(begin, data):
+            LOG.info('Dropping unexpected block ({}, {})'.format(piece_idx, begin))
+            return
+        if duplicate:
+            # Only the first copy of a block counts as downloaded
+            self.wasted += len(data)
+            WASTED_BYTES.inc(len(data))
+        else:
+            self.downloaded += len(data)
+        for other in self.requests.pop((piece_idx, begin), ()):
+            if other is not peer:
+                other.cancel_request(piece_idx, begin, len(data))
 
         # Verify all blocks in the Piece have been downloaded
         if not piece.is_complete():
             return
 
-        piece_data = piece.data
+        self.pieces_verifying.add(piece.index)
+        task = asyncio.ensure_future(self.verify_piece(piece))
+        self.verify_tasks.add(task)
+        task.add_done_callback(self.verify_tasks.discard)
 
-        res_hash = hashlib.sha1(piece_data).digest()
-        exp_hash = self.torrent.get_piece_hash(piece.index)
+    async def verify_piece(self, piece : Piece):
+        """
+        Hashes the piece on the hasher pool, straight from its buffer. If
+        that fails, or is cancelled, the piece is given up like one whose
+        hash doesn't match.
+        """
+        is_valid = None
+        try:
+            is_valid = await self.hasher.verify(
+                [piece.view],
+                self.torrent.get_piece_hash(piece.index)
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOG.warning('Could not verify Piece {}: {!r}'.format(piece.index, e))
+            return
+        finally:
+            self.pieces_verifying.discard(piece.index)
+            if is_valid is None:
+                self.release_piece(piece)
+        self.on_piece_verified(piece, is_valid)
 
-        if res_hash != exp_hash:
-            # TODO: re-enqueue request
+    def on_piece_verified(self, piece : Piece, is_valid : bool):
+        if not is_valid:
             LOG.info('Hash check failed for Piece {}'.format(piece.index))
-            piece.flush()
+            PIECES_VERIFIED.labels('invalid').inc()
+            self.release_piece(piece)
             return
-        else:
-            import pdb; pdb.set_trace()
-            LOG.info('Piece {} hash is valid'.format(piece.index))
+        PIECES_VERIFIED.labels('valid').inc()
+        if piece.started is not None:
+            PIECE_SECONDS.observe(time.monotonic() - piece.started)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Piece {} hash is valid'.format(piece.index))
+
+        del self.pieces_in_progress[piece.index]
+        self.received_pieces[piece.index] = 1
+        self.picker.mark_done(piece.index)
+        self.bytes_left -= piece.length
+
+        # The buffer goes back to the pool once it's on disk
+        buffer = piece.buffer
 
-        self.received_blocks.put_nowait((piece.index * self.piece_size, piece_data))
+        def on_written(written):
+            self.buffer_pool.release(buffer)
+            if written:
+                self.on_piece_written(piece.index)
+            else:
+                self.on_piece_write_failed(piece.index, piece.length)
 
-    def get_pieces(self) -> list:
+        self.received_blocks.put_nowait((
+            piece.index * self.piece_size,
+            [piece.view],
+            on_written
+        ))
+
+    def on_piece_written(self, piece_idx : int):
         """
-        Generates list of pieces and their blocks
+        The piece is on disk, tell everyone we can upload it
         """
+        self.have_bitfield[piece_idx >> 3] |= 0x80 >> (piece_idx & 7)
+        self.pieces_on_disk += 1
+        have = Have(piece_idx)
+        for peer in self.peers:
+            peer.send(have)
+        for waiter in self._piece_waiters.pop(piece_idx, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+        if self.is_on_disk():
+            self._wake_on_disk_waiters()
 
-        # TODO: fix bug where blocks are incorrectly generated for
-        # files less than the REQUEST_SIZE
+    def on_piece_write_failed(self, piece_idx : int, length : int):
+        """
+        The piece didn't make it to disk, it has to be downloaded again
+        """
+        self.received_pieces[piece_idx] = 0
+        self.picker.mark_undone(piece_idx)
+        self.bytes_left += length
+        self.wake_peers()
 
-        pieces = []
-        blocks_per_piece = math.ceil(self.piece_size / REQUEST_SIZE)
-        for piece_idx in range(self.number_of_pieces):
-            blocks = []
-            for block_idx in range(blocks_per_piece):
-                is_last_block = (blocks_per_piece - 1) == block_idx
-                block_length = (
-                    (self.piece_size % REQUEST_SIZE) or REQUEST_SIZE
-                    if is_last_block
-                    else REQUEST_SIZE
-                )
-                blocks.append(
-                    Block(
-                        piece_idx,
-                        block_length * block_idx,
-                        block_length
-                    )
-                )
-            pieces.append(Piece(piece_idx, blocks))
-        return pieces
+    def _wake_on_disk_waiters(self):
+        waiters, self._on_disk_waiters = self._on_disk_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
 
-    def get_piece_request(self, have_pieces):
+    def release_piece(self, piece : Piece):
         """
-        Determines next piece for downloading. Expects BitArray
-        of pieces a peer can request
+        Gives up on a piece in progress, it can be picked again
+        """
+        self.pieces_in_progress.pop(piece.index, None)
+        self.partial_pieces.pop(piece.index, None)
+        for block in piece.blocks:
+            self.requests.pop((piece.index, block.begin), None)
+        self.picker.release(piece.index)
+        if piece.buffer is not None:
+            self.buffer_pool.release(piece.buffer)
+            piece.buffer = None
+        self.wake_peers()
+
+    @property
+    def in_endgame(self) -> bool:
+        """
+        Every block we still need has been requested at least once
+        """
+        return (
+            not self.partial_pieces and
+            0 < len(self.picker) == len(self.pieces_in_progress)
+        )
+
+    def next_requests(self, peer : Peer, count : int) -> List[Block]:
+        """
+        Up to 'count' blocks to request from 'peer': blocks of pieces in
+        progress that nobody has been asked for, then blocks of newly
+        picked pieces. In endgame, blocks already requested from other
+        peers. Raises NoBufferAvailable if the memory budget is what
+        stops us from starting a piece.
         """
-        for piece in self.pieces:
-            # Don't create request out of pieces we already have
-            is_piece_downloaded = piece.index in self.received_pieces
-            is_piece_in_progress = piece.index in self.pieces_in_progress
+        blocks = []
+        deadlines = self.picker.deadlines
+        if deadlines:
+            self._take_overdue(peer, count, blocks)
+        partial_pieces = list(self.partial_pieces.values())
+        if deadlines:
+            partial_pieces.sort(
+                key=lambda piece: deadlines.get(piece.index, math.inf))
+        for piece in partial_pieces:
+            if len(blocks) >= count:
+                break
+            if peer.have_pieces[piece.index]:
+                self._take_unrequested(peer, piece, count - len(blocks), blocks)
+
+        while len(blocks) < count and not self.in_endgame:
+            try:
+                piece = self.get_piece_request(peer.have_pieces)
+            except NoPieceAvailable:
+                break
+            except NoBufferAvailable:
+                if blocks:
+                    break
+                raise
+            self.partial_pieces[piece.index] = piece
+            self._take_unrequested(peer, piece, count - len(blocks), blocks)
 
-            # Skip pieces we already have
-            if is_piece_downloaded or is_piece_in_progress:
+        if len(blocks) < count and self.late_requests:
+            self._take_late(peer, count - len(blocks), blocks)
+        if len(blocks) < count and self.in_endgame:
+            self._take_endgame(peer, count - len(blocks), blocks)
+        return blocks
+
+    def _take_unrequested(self, peer : Peer, piece : Piece, count : int, blocks : list):
+        for block_idx, block in enumerate(piece.blocks):
+            if not count:
+                return
+            if piece.downloaded_blocks[block_idx] or piece.requested[block_idx]:
                 continue
+            piece.requested[block_idx] = 1
+            self.requests.setdefault((piece.index, block.begin), []).append(peer)
+            blocks.append(block)
+            count -= 1
+        self.partial_pieces.pop(piece.index, None)
+
+    def _take_late(self, peer : Peer, count : int, blocks : list):
+        """
+        Requests blocks that slower peers haven't delivered in time. The
+        slow peer keeps its request, whichever copy arrives first cancels
+        the other.
+        """
+        for key in list(self.late_requests):
+            if not count:
+                return
+            piece_idx, begin = key
+            holders = self.requests.get(key)
+            piece = self.pieces_in_progress.get(piece_idx)
+            if (holders is None or piece is None or
+                    piece_idx in self.pieces_verifying):
+                del self.late_requests[key]
+                continue
+            block_idx = begin // REQUEST_SIZE
+            if (peer in holders or not peer.have_pieces[piece_idx] or
+                    piece.downloaded_blocks[block_idx]):
+                continue
+            del self.late_requests[key]
+            piece.requested[block_idx] += 1
+            holders.append(peer)
+            blocks.append(piece.blocks[block_idx])
+            count -= 1
+
+    def _take_overdue(self, peer : Peer, count : int, blocks : list):
+        """
+        Duplicates the outstanding requests of critical pieces that are
+        past their deadline, the most overdue first
+        """
+        now = time.monotonic()
+        overdue = []
+        for piece in self.pieces_in_progress.values():
+            deadline = self.picker.deadlines.get(piece.index)
+            if deadline is not None and deadline <= now:
+                overdue.append((deadline, piece))
+        if overdue:
+            overdue.sort(key=lambda entry: entry[0])
+            self._take_endgame(
+                peer, count, blocks, [piece for _, piece in overdue])
+
+    def _take_endgame(self, peer : Peer, count : int, blocks : list, pieces=None):
+        """
+        Duplicates outstanding requests of 'pieces', all pieces in progress
+        by default. Blocks requested from the fewest peers go first, then
+        the earlier pieces.
+        """
+        candidates = []
+        if pieces is None:
+            pieces = self.pieces_in_progress.values()
+        for piece in pieces:
+            if piece.index in self.pieces_verifying or not peer.have_pieces[piece.index]:
+                continue
+            for block_idx, block in enumerate(piece.blocks):
+                requested = piece.requested[block_idx]
+                if (piece.downloaded_blocks[block_idx] or
+                        requested >= ENDGAME_DUPLICATES or
+                        peer in self.requests.get((piece.index, block.begin), ())):
+                    continue
+                candidates.append((requested, piece, block_idx))
+        # Stable, so the order of 'pieces' decides ties
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        for _, piece, block_idx in candidates[:count]:
+            block = piece.blocks[block_idx]
+            piece.requested[block_idx] += 1
+            self.requests.setdefault((piece.index, block.begin), []).append(peer)
+            blocks.append(block)
+
+    def on_requests_cancelled(self, peer : Peer, requests : list):
+        """
+        'peer' won't answer these (index, begin, length) requests: it timed
+        out, choked us or went away. Blocks nobody else was asked for can
+        be requested again.
+        """
+        if not requests:
+            return
+        for piece_idx, begin, _ in requests:
+            holders = self.requests.get((piece_idx, begin))
+            if holders is None or peer not in holders:
+                continue
+            holders.remove(peer)
+            if not holders:
+                del self.requests[(piece_idx, begin)]
+
+            piece = self.pieces_in_progress.get(piece_idx)
+            if piece is None or piece_idx in self.pieces_verifying:
+                continue
+            block_idx = begin // REQUEST_SIZE
+            if piece.requested[block_idx]:
+                piece.requested[block_idx] -= 1
+            if not piece.requested[block_idx] and not piece.downloaded_blocks[block_idx]:
+                if not piece.received and not any(piece.requested):
+                    # Nothing downloaded and nobody working on it, the
+                    # buffer and the piece may be better used elsewhere
+                    self.release_piece(piece)
+                else:
+                    self.partial_pieces[piece_idx] = piece
+        self.wake_peers()
+
+    def expire_requests(self):
+        """
+        Takes back the requests peers have left unanswered for too long,
+        and makes blocks whose every request is past its deadline
+        available to other peers
+        """
+        late = {}
+        for peer in list(self.peers):
+            expired = peer.pipeline.expired(self.request_timeout)
+            if expired:
+                LOG.info('[{}] {} requests timed out'.format(peer, len(expired)))
+                for piece_idx, begin, length in expired:
+                    peer.send(Cancel(piece_idx, begin, length))
+                self.on_requests_cancelled(peer, expired)
+            for piece_idx, begin, _ in peer.pipeline.late():
+                key = (piece_idx, begin)
+                late[key] = late.get(key, 0) + 1
+
+        self.late_requests = {
+            key: None for key, late_peers in late.items()
+            if late_peers == len(self.requests.get(key, ()))
+        }
+        if self.late_requests or self.picker.deadlines:
+            self.wake_peers()
+
+    async def run_request_timeouts(self, interval : float = 1):
+        while True:
+            await asyncio.sleep(interval)
+            self.expire_requests()
+
+    def wake_peers(self):
+        """
+        Lets idle peers know there may be something to request
+        """
+        for peer in self.peers:
+            peer.wake_requests()
 
-            if have_pieces[piece.index]:
-                self.pieces_in_progress[piece.index] = piece
-                return piece
-        raise Exception('Not eligible for valid pieces')
+    def get_pieces(self) -> PieceList:
+        """
+        Generates list of pieces and their blocks
+        """
+        return PieceList(self.torrent)
+
+    def get_piece_request(self, have_pieces):
+        """
+        Determines next piece for downloading. Expects BitArray
+        of pieces a peer can request. Raises NoPieceAvailable if the
+        peer has nothing we still need and NoBufferAvailable if the
+        memory budget is used up.
+        """
+        buffer = self.buffer_pool.try_acquire()
+        if buffer is None:
+            raise NoBufferAvailable('Piece buffers are all in use')
+        try:
+            piece_idx = self.picker.pick(have_pieces)
+        except NoPieceAvailable:
+            self.buffer_pool.release(buffer)
+            raise
+        piece = self.pieces[piece_idx]
+        piece.buffer = buffer
+        piece.started = time.monotonic()
+        self.pieces_in_progress[piece.index] = piece
+        return piece
 
     def __repr__(self):
         data = {
@@ -185,34 +822,370 @@ class DownloadSession(object):
         return pformat(data)
 
 
-async def download(torrent_file : str, download_location : str, loop=None):
-    # Parse torrent file
-    torrent = Torrent(torrent_file)
-    LOG.info('Torrent: {}'.format(torrent))
+async def resume_download(
+        session : DownloadSession, file_saver : FileSaver, resume : ResumeData,
+        force_recheck : bool = False):
+    """
+    Skips pieces an earlier run already saved. Uses the resume data when
+    it's intact and falls back to hashing what's on disk
+    """
+    storage = file_saver.storage
+    state = None if force_recheck else resume.load()
+    if state is not None:
+        pieces, needs_check = state
+        if needs_check:
+            LOG.info('Files changed since resume data was saved, rechecking')
+            pieces, _ = await file_saver.run_in_executor(
+                recheck, storage, session.torrent, pieces)
+    elif force_recheck or storage.has_existing_data:
+        pieces, _ = await file_saver.run_in_executor(
+            recheck, storage, session.torrent)
+    else:
+        return
+
+    session.mark_pieces_done(pieces)
+    file_saver.written_pieces[:] = pieces
+    LOG.info('Resuming with {} of {} pieces'.format(
+        sum(pieces), session.number_of_pieces))
 
-    torrent_writer = FileSaver(download_location, torrent)
-    session = DownloadSession(torrent, torrent_writer.get_received_blocks_queue())
 
-    # Instantiate tracker object
-    tracker = Tracker(torrent)
+async def open_magnet(
+        uri : str, cache : MetadataCache, port : int = LISTEN_PORT,
+        dht : DHTNode = None) -> tuple:
+    """
+    Returns (torrent, peers) for a magnet link. The torrent comes from the
+    metadata cache, or else its metadata is fetched from the peers the
+    link, its trackers and the DHT give us, which are returned to
+    download from.
+    """
+    magnet = Magnet(uri)
+    torrent = cache.load(magnet.info_hash)
+    if torrent is not None:
+        LOG.info('Using cached metadata {}'.format(cache.path(magnet.info_hash)))
+        return torrent, magnet.peers
+    if not magnet.trackers and not magnet.peers and dht is None:
+        raise MagnetError('Magnet link has neither trackers nor peers')
 
-    peers_info = await tracker.get_peers()
+    fetcher = MetadataFetcher(magnet.info_hash)
+    fetcher.add_peers(magnet.peers)
+    tracker = Tracker(magnet, port=port)
+    announcers = []
+    if magnet.trackers:
+        announcers.append(asyncio.ensure_future(tracker.run(fetcher.add_peers)))
+    if dht is not None:
+        announcers.append(asyncio.ensure_future(
+            dht.run(magnet.info_hash, fetcher.add_peers)))
+    try:
+        metadata = await fetcher.fetch()
+    finally:
+        for announcer in announcers:
+            announcer.cancel()
+        await asyncio.gather(*announcers, return_exceptions=True)
+        await tracker.close()
+    torrent = cache.store(magnet.info_hash, metadata, magnet.trackers)
+    return torrent, fetcher.peers
 
-    seen_peers = set()
-    peers = [
-        Peer(session, host, port)
-        for host, port in peers_info
-    ]
-    seen_peers.update([str(p) for p in peers])
 
-    LOG.info('[Peers] {}'.format(seen_peers))
+class Session(object):
+    """
+    Runs any number of torrents in one event loop.
 
-    await (
-        asyncio.gather(*[
-            peer.download()
-            for peer in peers
+    The torrents share one listening port, whose connections the
+    PeerServer routes by info hash, and global budgets: connections
+    (ConnectionLimits), piece buffer memory (MemoryBudget), upload slots
+    (UploadSlots), bandwidth (TokenBuckets) and the disk I/O and hashing
+    thread pools. The per torrent limits still apply within those.
+
+    With `metrics_port` the metrics are served over HTTP on localhost,
+    with `metrics_file` they are written there as JSON every
+    `metrics_interval` seconds.
+
+    With `stream_port` the files of the torrents are served over HTTP on
+    localhost while they download, see `stream_url`. Reads make the
+    `stream_window` pieces from where they are time critical.
+
+    With `dht_port` a DHT node finds peers for every torrent that isn't
+    private, on top of the trackers. It joins through the `dht_bootstrap`
+    nodes and keeps its routing table in `dht_state` between runs.
+
+    Rates are in bytes per second, None is unlimited. They can be changed
+    while running with `set_rate` on `download_limit` and `upload_limit`,
+    or on a torrent's.
+    """
+
+    def __init__(
+            self, host : str = '0.0.0.0', port : int = LISTEN_PORT,
+            max_connections : int = 200, max_half_open : int = 16,
+            memory_budget : int = DEFAULT_MEMORY_BUDGET,
+            max_upload_slots : int = 16, disk_workers : int = 4,
+            hasher : PieceHasher = None,
+            metadata_cache : str = METADATA_CACHE_DIR,
+            resume_interval : float = 30, max_download_rate : float = None,
+            max_upload_rate : float = None, metrics_port : int = None,
+            metrics_file : str = None, metrics_interval : float = 60,
+            stream_port : int = None, stream_window : int = 8,
+            dht_port : int = None, dht_state : str = None,
+            dht_bootstrap=BOOTSTRAP_NODES):
+        self.limits = ConnectionLimits(max_connections, max_half_open)
+        self.memory = MemoryBudget(memory_budget)
+        self.upload_slots = UploadSlots(max_upload_slots)
+        self.download_limit = TokenBucket(max_download_rate)
+        self.upload_limit = TokenBucket(max_upload_rate)
+        self.disk_executor = ThreadPoolExecutor(
+            max_workers=disk_workers, thread_name_prefix='disk-io')
+        self.hasher = hasher or PieceHasher()
+        self.server = PeerServer(host=host, port=port)
+        self.metadata_cache = MetadataCache(metadata_cache)
+        self.resume_interval = resume_interval
+        # info hash -> DownloadSession of every running torrent
+        self.torrents : Dict[bytes, DownloadSession] = {}
+        self.tasks : set = set()
+        # Teardowns of downloads that are stopping
+        self.stopping : set = set()
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(port=metrics_port)
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.metrics_task = None
+        self.stream_server = None
+        if stream_port is not None:
+            self.stream_server = StreamServer(
+                self.torrents, port=stream_port, window=stream_window)
+        self.dht = None
+        if dht_port is not None:
+            self.dht = DHTNode(
+                host=host, port=dht_port, state_file=dht_state,
+                bootstrap=dht_bootstrap)
+
+    @property
+    def port(self) -> int:
+        return self.server.port
+
+    async def start(self):
+        await self.server.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        if self.stream_server is not None:
+            await self.stream_server.start()
+        if self.dht is not None:
+            await self.dht.start()
+        if self.metrics_file is not None:
+            self.metrics_task = asyncio.ensure_future(
+                dump_metrics(self.metrics_file, self.metrics_interval))
+        return self
+
+    def add(self, torrent_file : str, download_location : str, **kwargs) -> asyncio.Future:
+        """
+        Runs `download` in the background
+        """
+        task = asyncio.ensure_future(
+            self.download(torrent_file, download_location, **kwargs))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def download(
+            self, torrent_file : str, download_location : str, peers=(),
+            seed : bool = False, force_recheck : bool = False,
+            download_rate : float = None, upload_rate : float = None,
+            peer_download_rate : float = None,
+            peer_upload_rate : float = None,
+            file_priorities : list = None) -> DownloadSession:
+        """
+        Downloads a .torrent file or magnet link into `download_location`
+        from `peers` and whoever the trackers and the DHT give us. Returns
+        once every wanted piece is on disk, or with `seed` keeps uploading
+        until cancelled. The rates limit the torrent and each of its peers.
+        `file_priorities` has a priority per file of the torrent, see
+        DownloadSession.set_file_priorities.
+        """
+        # Parse torrent file, or get it from peers for a magnet link
+        if is_magnet(torrent_file):
+            torrent, found = await open_magnet(
+                torrent_file, self.metadata_cache, port=self.port, dht=self.dht)
+        else:
+            torrent, found = Torrent(torrent_file), []
+        if torrent.info_hash in self.torrents:
+            raise ValueError('{} is already running'.format(torrent.name))
+        LOG.info('Torrent: {}'.format(torrent.name))
+        skip_files = []
+        if file_priorities is not None:
+            if len(file_priorities) != len(torrent.files):
+                raise ValueError('{} priorities for {} files'.format(
+                    len(file_priorities), len(torrent.files)))
+            skip_files = [
+                file_idx for file_idx, priority in enumerate(file_priorities)
+                if priority == SKIP
+            ]
+
+        torrent_writer = FileSaver(
+            download_location, torrent, executor=self.disk_executor,
+            skip_files=skip_files)
+        uploader = Uploader(torrent_writer, slots=self.upload_slots)
+        session = DownloadSession(
+            torrent, torrent_writer.get_received_blocks_queue(),
+            hasher=self.hasher, uploader=uploader, shared_memory=self.memory,
+            download_limit=TokenBucket(download_rate, parent=self.download_limit),
+            upload_limit=TokenBucket(upload_rate, parent=self.upload_limit),
+            peer_download_rate=peer_download_rate,
+            peer_upload_rate=peer_upload_rate)
+        if file_priorities is not None:
+            session.set_file_priorities(file_priorities)
+        resume = ResumeData(
+            os.path.join(download_location, torrent.name + '.resume'),
+            torrent,
+            torrent_writer.storage
+        )
+        self.torrents[torrent.info_hash] = session
+        tasks = []
+        tracker = None
+        try:
+            await resume_download(
+                session, torrent_writer, resume, force_recheck=force_recheck)
+            connections = ConnectionManager(session, limits=self.limits)
+            connections.add_peers(list(peers) + found)
+            if not torrent.is_private:
+                session.pex = PeerExchange(session, connections, listen_port=self.port)
+                tasks.append(asyncio.ensure_future(session.pex.run()))
+            self.server.add_torrent(session, connections)
+            tasks.append(asyncio.ensure_future(
+                resume.run(torrent_writer, self.resume_interval)))
+            tasks.append(asyncio.ensure_future(
+                Choker(uploader).run(session.is_complete)))
+            tasks.append(asyncio.ensure_future(session.run_request_timeouts()))
+            if torrent.announce_list:
+                tracker = Tracker(torrent, stats=session.transfer_stats, port=self.port)
+                tasks.append(asyncio.ensure_future(
+                    self._announce(tracker, connections, session)))
+            if self.dht is not None and not torrent.is_private:
+                tasks.append(asyncio.ensure_future(self.dht.run(
+                    torrent.info_hash, connections.add_peers, port=self.port)))
+
+            running = asyncio.ensure_future(connections.run(linger=True))
+            tasks.append(running)
+            if seed:
+                await running
+            else:
+                on_disk = asyncio.ensure_future(session.wait_on_disk())
+                tasks.append(on_disk)
+                await asyncio.wait(
+                    [running, on_disk], return_when=asyncio.FIRST_COMPLETED)
+                if running.done():
+                    running.result()
+            return session
+        finally:
+            self.server.remove_torrent(torrent.info_hash)
+            del self.torrents[torrent.info_hash]
+            session.cancel_waiters()
+            for task in tasks:
+                task.cancel()
+            # In its own task so cancelling the download again can't leave
+            # the torrent half stopped, `close` waits for it
+            stopping = asyncio.ensure_future(self._stop_download(
+                session, tasks, tracker, torrent_writer, resume))
+            self.stopping.add(stopping)
+            stopping.add_done_callback(self.stopping.discard)
+            await asyncio.shield(stopping)
+
+    async def _stop_download(
+            self, session : DownloadSession, tasks : list, tracker : Tracker,
+            torrent_writer : FileSaver, resume : ResumeData):
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Nothing may reach the disk queue or the hasher after this
+        await session.cancel_verifications()
+        if tracker is not None:
+            await tracker.close()
+        session.uploader.close()
+        session.buffer_pool.close()
+        # Let pending writes finish before recording what's on disk
+        await torrent_writer.received_blocks_queue.put(None)
+        await asyncio.gather(torrent_writer.task, return_exceptions=True)
+        resume.save(torrent_writer.written_pieces)
+
+    async def _announce(
+            self, tracker : Tracker, connections : ConnectionManager,
+            session : DownloadSession):
+        started = False
+        try:
+            connections.add_peers(await tracker.get_peers())
+            started = True
+        except TrackerError as e:
+            LOG.warning('First announce failed: {}'.format(e))
+        await tracker.run(connections.add_peers, session.is_complete, started=started)
+
+    def stream_url(self, info_hash : bytes, file_index : int = 0) -> str:
+        """
+        Where the stream server serves a file of a running torrent
+        """
+        if self.stream_server is None:
+            raise ValueError('Streaming is off, see stream_port')
+        return self.stream_server.url(info_hash, file_index)
+
+    def stats(self) -> dict:
+        return {
+            'torrents': len(self.torrents),
+            'connections': self.limits.connections,
+            'half_open': self.limits.half_open,
+            'memory': self.memory.allocated,
+            'upload_slots': self.upload_slots.used,
+            'download_rate': self.download_limit.rate,
+            'upload_rate': self.upload_limit.rate,
+            'dht_nodes': len(self.dht) if self.dht is not None else 0,
+        }
+
+    async def close(self):
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Torrents still stopping may be verifying pieces, the hasher only
+        # goes once nothing can use it
+        await asyncio.gather(*self.stopping, return_exceptions=True)
+        self.server.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.stream_server is not None:
+            self.stream_server.close()
+        if self.dht is not None:
+            self.dht.close()
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+            await asyncio.gather(self.metrics_task, return_exceptions=True)
+        self.hasher.shutdown()
+        self.disk_executor.shutdown(wait=False)
+
+
+async def download(
+        torrent_file : str, download_location : str, loop=None,
+        force_recheck : bool = False, resume_interval : float = 30,
+        metadata_cache : str = METADATA_CACHE_DIR, seed : bool = False):
+    session = await Session(
+        metadata_cache=metadata_cache, resume_interval=resume_interval).start()
+    try:
+        return await session.download(
+            torrent_file, download_location, seed=seed,
+            force_recheck=force_recheck)
+    finally:
+        await session.close()
+
+
+async def main(args : list):
+    """
+    Downloads every .torrent file and magnet link in `args` into the
+    current directory with one Session
+    """
+    force_recheck = '--recheck' in args
+    session = await Session(
+        metrics_port=METRICS_PORT, dht_port=LISTEN_PORT,
+        dht_state=DHT_STATE_FILE).start()
+    try:
+        await asyncio.gather(*[
+            session.download(source, '.', force_recheck=force_recheck)
+            for source in args if not source.startswith('--')
         ])
-    )
+    finally:
+        await session.close()
 
 
 if __name__ == '__main__':
@@ -221,5 +1194,5 @@ if __name__ == '__main__':
     # loop.set_debug(True)
     # loop.slow_callback_duration = 0.001
     # warnings.simplefilter('always', ResourceWarning)
-    loop.run_until_complete(download(sys.argv[1], '.', loop=loop))
+    loop.run_until_complete(main(sys.argv[1:]))
     loop.close()
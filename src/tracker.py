@@ -1,79 +1,411 @@
-import ipaddress
+import asyncio
+import random
 import socket
 import struct
+import time
 from urllib import parse as urlparse
 
 import aiohttp
-import bencoder
 # import yarl
 
+import bencode
+
+from peer_list import decode_peers
 from torrent import Torrent
-from util import LOG, PEER_ID
+from util import LISTEN_PORT, LOG, OWN_ADDRESSES, PEER_ID
+
+EVENT_STARTED = 'started'
+EVENT_COMPLETED = 'completed'
+EVENT_STOPPED = 'stopped'
+
+# Used until a tracker tells us its interval, and between retries of a
+# failed announce
+DEFAULT_INTERVAL = 1800
+RETRY_INTERVAL = 60
+# We never announce more often than this, whatever the tracker asks for
+MIN_ANNOUNCE_INTERVAL = 60
+
+
+class TrackerError(Exception):
+    pass
+
+
+def _seconds(response : dict, key : bytes, default : int) -> int:
+    """
+    An interval of a tracker response, `default` if it's missing or isn't
+    a number
+    """
+    value = response.get(key, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        LOG.warning('Ignoring malformed {} {!r}'.format(key.decode(), value))
+        return default
+
+
+class HTTPTracker(object):
+    """
+    Announces to an HTTP(S) tracker. The aiohttp session is shared so its
+    connection pool is reused across announces and trackers.
+    """
+
+    def __init__(self, url : str, http_session : aiohttp.ClientSession, timeout : float = 30):
+        self.url = url
+        self.http_session = http_session
+        self.timeout = timeout
+        self.tracker_id = None
+
+    async def announce(self, params : dict) -> dict:
+        params = dict(params)
+        if self.tracker_id is not None:
+            params['trackerid'] = self.tracker_id
+        separator = '&' if urlparse.urlsplit(self.url).query else '?'
+        url = self.url + separator + urlparse.urlencode(params)
+        try:
+            resp = await asyncio.wait_for(self.http_session.get(url), self.timeout)
+            try:
+                data = await asyncio.wait_for(self._read_response(resp), self.timeout)
+            finally:
+                resp.release()
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            raise TrackerError('Announce to {} failed: {!r}'.format(self.url, e))
+        except bencode.BencodeError as e:
+            LOG.error('Failed to decode Tracker response: {}'.format(e))
+            raise TrackerError('Invalid response from {}'.format(self.url))
+        if not isinstance(data, dict):
+            raise TrackerError('Invalid response from {}'.format(self.url))
+        if b'failure reason' in data:
+            raise TrackerError('{} refused announce: {}'.format(
+                self.url, data[b'failure reason'].decode('utf-8', 'replace')))
+        if b'tracker id' in data:
+            self.tracker_id = data[b'tracker id']
+        return data
+
+    async def _read_response(self, resp):
+        """
+        Decodes the response as it comes in rather than buffering all of
+        it first, responses with thousands of peers are large
+        """
+        decoder = bencode.Decoder()
+        while True:
+            chunk = await resp.content.read(65536)
+            if not chunk:
+                return decoder.finish()
+            decoder.feed(chunk)
+
+    def close(self):
+        pass
+
+
+class _UDPTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        # transaction id -> future of the response
+        self.waiting : dict = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        _, transaction_id = struct.unpack_from('>II', data)
+        waiter = self.waiting.pop(transaction_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc):
+        for waiter in self.waiting.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        self.waiting.clear()
+
+    def connection_lost(self, exc):
+        self.error_received(exc or ConnectionError('Socket closed'))
+
+
+class UDPTracker(object):
+    """
+    Announces over the UDP tracker protocol (BEP 15): one connect round
+    trip whose connection id is good for a minute, then a single datagram
+    each way per announce. Lost datagrams are retried after
+    `timeout * 2**n` seconds, the BEP's 15s base but fewer than its 8
+    retries so a dead tracker doesn't hold up its tier for hours.
+    """
+    PROTOCOL_ID = 0x41727101980
+    ACTION_CONNECT = 0
+    ACTION_ANNOUNCE = 1
+    ACTION_ERROR = 3
+    CONNECTION_ID_LIFETIME = 60
+    EVENTS = {None: 0, EVENT_COMPLETED: 1, EVENT_STARTED: 2, EVENT_STOPPED: 3}
+
+    def __init__(
+            self, url : str, timeout : float = 15, retries : int = 2,
+            clock=time.monotonic):
+        self.url = url
+        parsed = urlparse.urlsplit(url)
+        if not parsed.hostname or not parsed.port:
+            raise TrackerError('Invalid UDP tracker URL: {}'.format(url))
+        self.address = (parsed.hostname, parsed.port)
+        self.timeout = timeout
+        self.retries = retries
+        self.clock = clock
+        self.key = random.getrandbits(32)
+        self.protocol = None
+        self.connection_id = None
+        self._connected_at = 0.0
+
+    async def _open(self):
+        if self.protocol is None or self.protocol.transport.is_closing():
+            loop = asyncio.get_event_loop()
+            try:
+                _, self.protocol = await loop.create_datagram_endpoint(
+                    _UDPTrackerProtocol, remote_addr=self.address)
+            except OSError as e:
+                raise TrackerError('Cannot reach {}: {!r}'.format(self.url, e))
+            self.connection_id = None
+
+    async def _request(self, build) -> bytes:
+        """
+        Sends the datagram `build(transaction id)` and waits for the
+        matching response, retrying with exponential backoff
+        """
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.retries + 1):
+            transaction_id = random.getrandbits(32)
+            waiter = loop.create_future()
+            self.protocol.waiting[transaction_id] = waiter
+            self.protocol.transport.sendto(build(transaction_id))
+            try:
+                data = await asyncio.wait_for(waiter, self.timeout * 2 ** attempt)
+            except asyncio.TimeoutError:
+                continue
+            except OSError as e:
+                raise TrackerError('Announce to {} failed: {!r}'.format(self.url, e))
+            finally:
+                self.protocol.waiting.pop(transaction_id, None)
+
+            action, = struct.unpack_from('>I', data)
+            if action == self.ACTION_ERROR:
+                raise TrackerError('{} refused announce: {}'.format(
+                    self.url, data[8:].decode('utf-8', 'replace')))
+            return data
+        raise TrackerError('{} timed out'.format(self.url))
+
+    async def connect(self):
+        data = await self._request(lambda transaction_id: struct.pack(
+            '>QII', self.PROTOCOL_ID, self.ACTION_CONNECT, transaction_id))
+        if len(data) < 16:
+            raise TrackerError('Short connect response from {}'.format(self.url))
+        self.connection_id, = struct.unpack_from('>Q', data, 8)
+        self._connected_at = self.clock()
+
+    async def announce(self, params : dict) -> dict:
+        await self._open()
+        if (self.connection_id is None or
+                self.clock() - self._connected_at > self.CONNECTION_ID_LIFETIME):
+            await self.connect()
+
+        def build(transaction_id):
+            return struct.pack(
+                '>QII20s20sQQQIIIiH',
+                self.connection_id, self.ACTION_ANNOUNCE, transaction_id,
+                params['info_hash'], params['peer_id'].encode(),
+                params['downloaded'], params['left'], params['uploaded'],
+                self.EVENTS[params.get('event')], 0, self.key,
+                params.get('numwant', -1), params['port']
+            )
+
+        data = await self._request(build)
+        if len(data) < 20:
+            raise TrackerError('Short announce response from {}'.format(self.url))
+        interval, leechers, seeders = struct.unpack_from('>III', data, 8)
+        # Trackers answer over IPv6 with 18 byte peers
+        family = self.protocol.transport.get_extra_info('socket').family
+        return {
+            b'interval': interval,
+            b'incomplete': leechers,
+            b'complete': seeders,
+            b'peers6' if family == socket.AF_INET6 else b'peers': data[20:],
+        }
+
+    def close(self):
+        if self.protocol is not None:
+            self.protocol.transport.close()
+            self.protocol = None
 
 
 class Tracker(object):
-    def __init__(self, torrent : Torrent):
+    """
+    Announces to the torrent's trackers.
+
+    Trackers are grouped in the tiers of the announce-list (BEP 12), tried
+    in order; within a tier the trackers are shuffled once and whichever
+    answers is moved to the front. `run` re-announces every `interval`
+    seconds as the tracker asks, never more often than its `min interval`
+    or `min_announce_interval`, with real upload/download counters from
+    `stats`.
+    """
+
+    def __init__(
+            self, torrent : Torrent, stats=None,
+            http_session : aiohttp.ClientSession = None, numwant : int = 50,
+            udp_timeout : float = 15, udp_retries : int = 2,
+            own_addresses=OWN_ADDRESSES, port : int = LISTEN_PORT,
+            min_announce_interval : float = MIN_ANNOUNCE_INTERVAL):
         self.torrent = torrent
         self.tracker_url = torrent.announce_url
+        self.stats = stats
+        self.numwant = numwant
+        self.udp_timeout = udp_timeout
+        self.udp_retries = udp_retries
+        self.port = port
+        # Trackers may hand us back to ourselves
+        self.own_peers = frozenset((host, port) for host in own_addresses)
         self.peers = []
+        self.min_announce_interval = min_announce_interval
+        self.interval = DEFAULT_INTERVAL
+        self.min_interval = 0
+        self.last_response : dict = {}
+
+        self.tiers = [list(tier) for tier in torrent.announce_list]
+        for tier in self.tiers:
+            random.shuffle(tier)
+        self._http_session = http_session
+        self._owns_http_session = http_session is None
+        self._trackers : dict = {}
+
+    @property
+    def http_session(self) -> aiohttp.ClientSession:
+        if self._http_session is None:
+            self._http_session = aiohttp.ClientSession()
+        return self._http_session
+
+    def get_tracker(self, url : str):
+        tracker = self._trackers.get(url)
+        if tracker is None:
+            scheme = urlparse.urlsplit(url).scheme
+            if scheme == 'udp':
+                tracker = UDPTracker(url, self.udp_timeout, self.udp_retries)
+            elif scheme in ('http', 'https'):
+                tracker = HTTPTracker(url, self.http_session)
+            else:
+                raise TrackerError('Unsupported tracker: {}'.format(url))
+            self._trackers[url] = tracker
+        return tracker
 
     async def get_peers(self):
-        peers_resp = await self.request_peers()
-        peers = self.parse_peers(peers_resp[b'peers'])
-        return peers
-
-    async def request_peers(self):
-        async with aiohttp.ClientSession() as session:
-            resp = await session.get(self.tracker_url, params=self._get_request_params())
-            resp_data = await resp.read()
-            LOG.info('Tracker response: {}'.format(resp))
-            LOG.info('Tracker response data: {}'.format(resp_data))
-            peers = None
+        return await self.announce(EVENT_STARTED)
+
+    async def announce(self, event : str = None) -> list:
+        """
+        Announces to the first tracker that answers and returns the peers
+        it gave us
+        """
+        params = self._get_request_params(event)
+        errors = []
+        for tier in self.tiers:
+            for url in list(tier):
+                try:
+                    response = await self.get_tracker(url).announce(params)
+                except TrackerError as e:
+                    LOG.warning(str(e))
+                    errors.append(e)
+                    continue
+                # The tracker that answered is tried first next time
+                tier.remove(url)
+                tier.insert(0, url)
+                return self._on_response(response)
+        raise TrackerError('No tracker answered: {}'.format(errors))
+
+    def _on_response(self, response : dict) -> list:
+        self.last_response = response
+        # A tracker answering interval 0 mustn't make us announce in a loop
+        self.interval = max(
+            _seconds(response, b'interval', DEFAULT_INTERVAL),
+            self.min_announce_interval)
+        min_interval = _seconds(response, b'min interval', 0)
+        # A min interval longer than the interval is nonsense, ignored
+        self.min_interval = min_interval if min_interval <= self.interval else 0
+        self.peers = decode_peers(
+            response.get(b'peers', b''),
+            response.get(b'peers6', b''),
+            exclude=self.own_peers
+        )
+        LOG.info('Tracker returned {} peers, next announce in {}s'.format(
+            len(self.peers), self.next_interval))
+        return self.peers
+
+    @property
+    def next_interval(self) -> float:
+        return max(self.interval, self.min_interval)
+
+    async def run(self, on_peers, is_complete=lambda: False, started : bool = False):
+        """
+        Announces until cancelled, handing the peers of every response to
+        `on_peers`. Sends `completed` once the download finishes and
+        `stopped` when cancelled. With `started` the first announce has
+        already been made and the next one waits for the interval.
+        """
+        completed = is_complete()
+        retry = RETRY_INTERVAL
+        try:
+            if started:
+                event = await self._wait(is_complete, completed)
+                completed = completed or event == EVENT_COMPLETED
+            else:
+                event = EVENT_STARTED
+            while True:
+                try:
+                    on_peers(await self.announce(event))
+                except TrackerError as e:
+                    LOG.warning('Announce failed, retrying in {}s: {}'.format(retry, e))
+                    await asyncio.sleep(retry)
+                    retry = min(retry * 2, self.next_interval)
+                    continue
+                retry = RETRY_INTERVAL
+                event = await self._wait(is_complete, completed)
+                completed = completed or event == EVENT_COMPLETED
+        except asyncio.CancelledError:
             try:
-                peers = bencoder.decode(resp_data)
-                LOG.info('Tracker response data bdecoded: {}'.format(peers))
-            except AssertionError:
-                LOG.error('Failed to decode Tracker response: {}'.format(resp_data))
-                LOG.error('Tracker request URL: {}'.format(str(resp.url).split('&')))
-                raise RuntimeError('Failed to get Peers from Tracker')
-            return peers
-
-    def _get_request_params(self):
-        return {
+                await asyncio.wait_for(self.announce(EVENT_STOPPED), 5)
+            except (TrackerError, asyncio.TimeoutError):
+                pass
+            raise
+
+    async def _wait(self, is_complete, completed : bool):
+        """
+        Sleeps until the next announce is due, or returns early with the
+        `completed` event when the download finishes
+        """
+        deadline = time.monotonic() + self.next_interval
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(1, deadline - time.monotonic()))
+            if not completed and is_complete():
+                return EVENT_COMPLETED
+        return None
+
+    def _get_request_params(self, event : str = None) -> dict:
+        stats = self.stats() if self.stats is not None else {}
+        params = {
             'info_hash': self.torrent.info_hash,
             'peer_id': PEER_ID,
             'compact': 1,
             'no_peer_id': 0,
-            'event': 'started',
-            'port': 59696,
-            'uploaded': 0,
-            'downloaded': 0,
-            'left': self.torrent.size
+            'port': self.port,
+            'uploaded': stats.get('uploaded', 0),
+            'downloaded': stats.get('downloaded', 0),
+            'left': stats.get('left', self.torrent.size),
+            'numwant': self.numwant,
         }
+        if event is not None:
+            params['event'] = event
+        return params
 
-    def parse_peers(self, peers : bytes):
-        self_addr = socket.gethostbyname(socket.gethostname())
-        self_addr = '192.168.99.1'
-        LOG.info('Self addr is: {}'.format(self_addr))
-        def handle_bytes(peers_data):
-            peers = []
-            for i in range(0, len(peers_data), 6):
-                addr_bytes, port_bytes = (
-                    peers_data[i:i + 4], peers_data[i + 4:i + 6]
-                )
-                ip_addr = str(ipaddress.IPv4Address(addr_bytes))
-                if ip_addr == self_addr:
-                    print('skipping', ip_addr)
-                    continue
-                port_bytes = struct.unpack('>H', port_bytes)[0]
-                peers.append((ip_addr, port_bytes))
-            return peers
-
-        def handle_dict(peers):
-            raise NotImplementedError
-
-        handlers = {
-            bytes: handle_bytes,
-            dict: handle_dict
-        }
-        return handlers[type(peers)](peers)
\ No newline at end of file
+    async def close(self):
+        for tracker in self._trackers.values():
+            tracker.close()
+        self._trackers.clear()
+        if self._owns_http_session and self._http_session is not None:
+            await self._http_session.close()
+            self._http_session = None
@@ -1,5 +1,6 @@
 import hashlib
 import logging
+import os
 import random
 import string
 
@@ -9,4 +10,28 @@ PEER_ID = 'SA' + ''.join(
     for i in range(18)
 )
 PEER_ID_HASH = hashlib.sha1(PEER_ID.encode()).digest()
-REQUEST_SIZE = 2**14  # 10 * 1024
\ No newline at end of file
+REQUEST_SIZE = 2**14  # 10 * 1024
+# Largest block we serve, peers asking for more get disconnected
+MAX_REQUEST_SIZE = 2**17
+LISTEN_PORT = 59696
+# Our own public addresses, so trackers can't hand us back to ourselves.
+# Comma separated in BATTORRENT_OWN_ADDRESSES.
+OWN_ADDRESSES = tuple(
+    address.strip()
+    for address in os.environ.get('BATTORRENT_OWN_ADDRESSES', '').split(',')
+    if address.strip()
+)
+# Torrents fetched for magnet links, see metadata.MetadataCache
+METADATA_CACHE_DIR = os.environ.get(
+    'BATTORRENT_METADATA_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'battorrent', 'metadata')
+)
+# Our DHT node id and routing table, see dht.DHTNode
+DHT_STATE_FILE = os.environ.get(
+    'BATTORRENT_DHT_STATE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'battorrent', 'dht.dat')
+)
+# Localhost port to serve metrics on, off unless BATTORRENT_METRICS_PORT
+# is set
+METRICS_PORT = os.environ.get('BATTORRENT_METRICS_PORT')
+METRICS_PORT = int(METRICS_PORT) if METRICS_PORT else None